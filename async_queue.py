@@ -1,18 +1,30 @@
 from __future__ import annotations
 
-from asyncio import Lock, Event
-from collections import deque
-from collections.abc import AsyncIterator, Iterable, Iterator
+from asyncio import Lock, Condition
+from collections import deque, OrderedDict
+from collections.abc import AsyncIterator, Callable, Hashable, Iterable, Iterator
 from contextlib import asynccontextmanager
+from itertools import count, islice
 
 from gadt.standard.__init__ import Maybe
 
+_CLOSED = object()
+
 
 class AsyncQueue[T](Iterable[T]):
+    """
+    Elements are stored in an OrderedDict keyed by key(element) (or by insertion sequence number if there is
+    no key function), which gives O(1) length, appends and pops at both ends and removal by key without tombstones.
+    Closing the queue records a sequence number instead of storing a marker element: consumers see the end of iteration
+    once everything queued before the close has been taken.
+    """
+
     _async_iterator: AsyncIterator[T]
     _iterator_lock: Lock
-    _non_empty_event: Event
-    _queue: deque[Maybe[T]]
+    _condition: Condition
+    _queue: OrderedDict[Hashable, tuple[int, T]]
+    _close_sequences: deque[int]
+    key: Callable[[T], Hashable] | None
 
     class AsyncIterator(AsyncIterator[T]):
         source: AsyncQueue[T]
@@ -21,13 +33,10 @@ class AsyncQueue[T](Iterable[T]):
             self.source = source
 
         async def __anext__(self) -> T:
-            while not self.source:
-                await self.source._non_empty_event.wait()
-            match (await self.source.maybe_popleft()):
-                case Maybe.Just(x):
-                    return x
-                case Maybe.Nothing:
-                    raise StopAsyncIteration
+            out: T | object = await self.source._pop(last=False, wait=True)
+            if out is _CLOSED:
+                raise StopAsyncIteration
+            return out
 
     class DestructiveIterator(Iterator[T]):
         source: AsyncQueue[T]
@@ -37,29 +46,26 @@ class AsyncQueue[T](Iterable[T]):
             self.reverse = reverse
 
         def __next__(self) -> T:
-            if self.source._queue:
-                out: T = self.source._queue.pop() if self.reverse else self.source._queue.popleft()
-                if not self.source._queue:
-                    self.source._non_empty_event.clear()
-                match out:
-                    case Maybe.Just(x):
-                        return x
-                    case Maybe.Nothing:
-                        raise StopIteration
-            else:
+            out: T | object = self.source._take(last=self.reverse)
+            if out is _CLOSED:
                 raise StopIteration
+            return out
 
-    def __init__(self):
-        self._queue = deque()
+    def __init__(self, key: Callable[[T], Hashable] | None = None):
+        self.key = key
+        self._queue = OrderedDict()
+        self._close_sequences = deque()
+        self._left_sequence = count(-1, -1)
+        self._right_sequence = count()
         self._iterator_lock = Lock()
         self.read_lock = Lock()
+        self._condition = Condition(self.read_lock)
         self._async_iterator = AsyncQueue.AsyncIterator(self)
         self._destructive_iterator = AsyncQueue.DestructiveIterator(self)
         self._reverse_destructive_iterator = AsyncQueue.DestructiveIterator(self, reverse=True)
-        self._non_empty_event = Event()
 
-    def __iter__(self):
-        return (x.unwrap() for x in self._queue if x.is_just())
+    def __iter__(self) -> Iterator[T]:
+        return (value for _, value in self._queue.values())
 
     @property
     def destructive_iter(self):
@@ -69,79 +75,133 @@ class AsyncQueue[T](Iterable[T]):
     def reverse_destructive_iter(self):
         return self._reverse_destructive_iterator
 
+    @property
+    def closed(self) -> bool:
+        return bool(self._close_sequences)
+
     @asynccontextmanager
     async def async_iter(self):
-        await self._iterator_lock.acquire()
-        yield self._async_iterator
-        self._iterator_lock.release()
-
-    def __getitem__(self, item) -> T:
-        match self._queue[item]:
-            case Maybe.Just(x):
-                return x
-            case Maybe.Nothing:
-                raise IndexError("Stop iteration element")
-
-    def __setitem__(self, key, value: T) -> None:
-        self._queue[key] = Maybe.Just(value)
+        async with self._iterator_lock:
+            yield self._async_iterator
+
+    def _key_for(self, value: T, sequence: int) -> Hashable:
+        return self.key(value) if self.key is not None else sequence
+
+    def _insert(self, value: T, sequence: int, left: bool) -> None:
+        key: Hashable = self._key_for(value, sequence)
+        if key in self._queue:
+            raise KeyError(f"Duplicate key: {key}")
+        self._queue[key] = (sequence, value)
+        if left:
+            self._queue.move_to_end(key, last=False)
+
+    def _end_key(self, last: bool) -> Hashable:
+        return next(reversed(self._queue)) if last else next(iter(self._queue))
+
+    def _take(self, last: bool = False) -> T | object:
+        if not self._close_sequences:
+            return self._queue.popitem(last=last)[1][1] if self._queue else _CLOSED
+        # A pending close at the front of the queue ends iteration (and is consumed) before any later elements
+        if not last and (not self._queue or self._queue[self._end_key(False)][0] > self._close_sequences[0]):
+            self._close_sequences.popleft()
+            return _CLOSED
+        if not self._queue:
+            return _CLOSED
+        if last and self._queue[self._end_key(True)][0] < self._close_sequences[-1]:
+            self._close_sequences.pop()
+            return _CLOSED
+        return self._queue.popitem(last=last)[1][1]
+
+    async def _pop(self, last: bool, wait: bool) -> T | object:
+        async with self._condition:
+            if wait:
+                await self._condition.wait_for(self._has_next)
+            elif not self._has_next():
+                raise IndexError("pop from an empty AsyncQueue")
+            return self._take(last)
+
+    def _has_next(self) -> bool:
+        return bool(self._queue) or bool(self._close_sequences)
+
+    def __getitem__(self, item: int) -> T:
+        if item < 0:
+            item += len(self._queue)
+        if not 0 <= item < len(self._queue):
+            raise IndexError("AsyncQueue index out of range")
+        return next(islice(self._queue.values(), item, None))[1]
+
+    def __setitem__(self, item: int, value: T) -> None:
+        if item < 0:
+            item += len(self._queue)
+        if not 0 <= item < len(self._queue):
+            raise IndexError("AsyncQueue index out of range")
+        key: Hashable = next(islice(self._queue, item, None))
+        sequence: int = self._queue[key][0]
+        new_key: Hashable = self._key_for(value, sequence)
+        if new_key != key:
+            raise KeyError(f"Replacing {key} would change the element's key to {new_key}")
+        self._queue[key] = (sequence, value)
 
     async def append(self, value: T) -> None:
-        self._queue.append(Maybe.Just(value))
-        self._non_empty_event.set()
+        async with self._condition:
+            self._insert(value, next(self._right_sequence), left=False)
+            self._condition.notify()
 
     async def appendleft(self, value: T) -> None:
-        self._queue.appendleft(Maybe.Just(value))
-        self._non_empty_event.set()
+        async with self._condition:
+            self._insert(value, next(self._left_sequence), left=True)
+            self._condition.notify()
+
+    async def close(self) -> None:
+        async with self._condition:
+            self._close_sequences.append(next(self._right_sequence))
+            self._condition.notify_all()
 
     async def append_stop_iteration(self):
-        self._queue.append(Maybe.Nothing)
-        self._non_empty_event.set()
+        await self.close()
 
     async def appendleft_stop_iteration(self):
-        self._queue.appendleft(Maybe.Nothing)
-        self._non_empty_event.set()
+        async with self._condition:
+            self._close_sequences.appendleft(next(self._left_sequence))
+            self._condition.notify_all()
+
+    async def remove(self, key: Hashable) -> T:
+        async with self._condition:
+            return self._queue.pop(key)[1]
+
+    def get(self, key: Hashable, default: T | None = None) -> T | None:
+        entry: tuple[int, T] | None = self._queue.get(key)
+        return entry[1] if entry is not None else default
+
+    def __contains__(self, item: Hashable | T) -> bool:
+        # Membership is by key for keyed queues and by value otherwise
+        return item in self._queue if self.key is not None else any(value == item for value in self)
 
     async def pop(self) -> T:
-        async with self.read_lock:
-            out: Maybe[T] = self._queue.pop()
-            if not self._queue:
-                self._non_empty_event.clear()
-            match out:
-                case Maybe.Just(value):
-                    return value
-                case Maybe.Nothing:
-                    raise IndexError("Stop iteration element")
+        out: T | object = await self._pop(last=True, wait=False)
+        if out is _CLOSED:
+            raise IndexError("Stop iteration element")
+        return out
 
     async def popleft(self) -> T:
-        async with self.read_lock:
-            out: Maybe[T] = self._queue.popleft()
-            if not self._queue:
-                self._non_empty_event.clear()
-            match out:
-                case Maybe.Just(value):
-                    return value
-                case Maybe.Nothing:
-                    raise IndexError("Close queue element")
-
-    async def maybe_pop(self) -> Maybe[T]:
-        async with self.read_lock:
-            out: Maybe[T] = self._queue.popleft()
-            if not self._queue:
-                self._non_empty_event.clear()
-            return out
+        out: T | object = await self._pop(last=False, wait=False)
+        if out is _CLOSED:
+            raise IndexError("Close queue element")
+        return out
 
-    async def maybe_popleft(self) -> Maybe[T]:
-        async with self.read_lock:
-            out: Maybe[T] = self._queue.popleft()
-            if not self._queue:
-                self._non_empty_event.clear()
-            return out
+    async def maybe_pop(self, wait: bool = False) -> Maybe[T]:
+        out: T | object = await self._pop(last=True, wait=wait)
+        return Maybe.Nothing if out is _CLOSED else Maybe.Just(out)
+
+    async def maybe_popleft(self, wait: bool = False) -> Maybe[T]:
+        out: T | object = await self._pop(last=False, wait=wait)
+        return Maybe.Nothing if out is _CLOSED else Maybe.Just(out)
 
     def __bool__(self) -> bool:
-        return bool(self._queue) and bool(self._queue[0])
+        return bool(self._queue)
 
     def __len__(self) -> int:
-        return len(self._queue) if Maybe.Nothing not in self._queue else self._queue.index(Maybe.Nothing)
+        return len(self._queue)
 
     def __repr__(self) -> str:
-        return f"AsyncQueue([{','.join(map(repr, self._queue))}])"
+        return f"AsyncQueue([{', '.join(repr(value) for _, value in self._queue.values())}])"
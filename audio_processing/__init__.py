@@ -1,5 +1,17 @@
-from dataclasses import dataclass
+from __future__ import annotations
+
+from asyncio import Future, to_thread
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, asdict
+from functools import cache
 from pathlib import Path
+from sys import stderr
+from time import monotonic
+from typing import Any
+
+import metrics
+from audio_processing.beat_analysis import BeatAnalysis, BeatAnalysisIndex
+from process_pool import ProcessPool
 
 
 @dataclass
@@ -9,6 +21,23 @@ class SyncopationSettings:
     pattern: tuple[float, ...] = (2, 1)
 
 
+@dataclass(frozen=True)
+class EchoStage:
+    """
+    Parameters of one ffmpeg aecho pass, delays in milliseconds. aecho only ever delays its input (never its output), so
+    every stage is an FIR filter with h[0] = in_gain * out_gain and h[delay] = decay * out_gain.
+    """
+    in_gain: float
+    out_gain: float
+    delays: tuple[float, ...]
+    decays: tuple[float, ...]
+
+
+ECHO: EchoStage = EchoStage(0.6, 0.3, tuple(100 * i for i in range(1, 4)), tuple(0.5 ** i for i in range(1, 4)))
+METAL: EchoStage = EchoStage(0.8, 0.88, (20, 40), (0.8, 0.4))
+REVERB: EchoStage = EchoStage(0.8, 0.88, tuple(8 * i for i in range(1, 32)), tuple(0.95 ** i for i in range(1, 32)))
+
+
 @dataclass
 class AudioProcessingSettings:
     pitch_shift: float = 0
@@ -19,11 +48,45 @@ class AudioProcessingSettings:
     loop: bool = False
     syncopation: SyncopationSettings | None = None
 
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+    @staticmethod
+    def from_dict(data: dict[str, Any]) -> AudioProcessingSettings:
+        syncopation: dict[str, Any] | None = data.get("syncopation")
+        return AudioProcessingSettings(**data | {
+            "syncopation": SyncopationSettings(**syncopation | {"pattern": tuple(syncopation["pattern"])})
+            if syncopation is not None else None
+        })
+
+    def canonical_dict(self) -> dict[str, Any]:
+        """Only what affects the rendered audio, with floats rounded so that equivalent requests compare equal."""
+        def canonical(value: float) -> float:
+            return round(float(value), 6) + 0.0
+
+        return {
+            "pitch_shift": canonical(self.pitch_shift),
+            "tempo_scale": canonical(self.tempo_scale),
+            "echo": bool(self.echo),
+            "metal": bool(self.metal),
+            "reverb": bool(self.reverb),
+            "syncopation": {
+                "flexible": bool(self.syncopation.flexible),
+                "quantization_scale": int(self.syncopation.quantization_scale),
+                "pattern": [canonical(x) for x in self.syncopation.pattern]
+            } if self.syncopation is not None else None
+        }
+
     @property
     def requires_ffmpeg_processing(self) -> bool:
         return (self.pitch_shift != 0 or self.tempo_scale != 1 or
                 self.echo or self.metal or self.reverb)
 
+    @property
+    def requires_ffmpeg_filters(self) -> bool:
+        # A tempo change on its own is applied by VLC at playback, so it doesn't need the audio to be re-encoded
+        return self.pitch_shift != 0 or self.tempo_scale < 0 or self.echo or self.metal or self.reverb
+
     @property
     def requires_syncopation_processing(self) -> bool:
         return self.syncopation is not None
@@ -32,6 +95,41 @@ class AudioProcessingSettings:
     def requires_audio_processing(self) -> bool:
         return self.requires_ffmpeg_processing or self.requires_syncopation_processing
 
+    @property
+    def requires_rendering(self) -> bool:
+        return self.requires_ffmpeg_filters or self.requires_syncopation_processing
+
+    @property
+    def effect_label(self) -> str:
+        return "+".join(name for name, enabled in (
+            ("syncopation", self.syncopation is not None),
+            ("reverse", self.tempo_scale < 0),
+            ("pitch", self.pitch_shift != 0),
+            ("tempo", abs(self.tempo_scale) != 1),
+            ("echo", self.echo),
+            ("metal", self.metal),
+            ("reverb", self.reverb)
+        ) if enabled) or "none"
+
+    @property
+    def echo_stages(self) -> list[EchoStage]:
+        return [stage for stage, enabled in ((ECHO, self.echo), (METAL, self.metal), (REVERB, self.reverb)) if enabled]
+
+    @property
+    def supports_realtime_effects(self) -> bool:
+        # Reversal and syncopation need the whole track, so only they always have to be rendered offline
+        return self.tempo_scale > 0 and not self.requires_syncopation_processing
+
+    @property
+    def supports_segmented_rendering(self) -> bool:
+        # areverse needs the whole track, and syncopation maps beats across it
+        return self.requires_ffmpeg_filters and not self.requires_syncopation_processing and self.tempo_scale > 0
+
+    @property
+    def supports_stream_processing(self) -> bool:
+        # Syncopation needs the whole track and areverse buffers all of its input before producing any output
+        return self.requires_ffmpeg_filters and not self.requires_syncopation_processing and self.tempo_scale > 0
+
     def __bool__(self) -> bool:
         return (self.pitch_shift != 0 or self.tempo_scale != 1 or
                 self.echo or self.metal or self.reverb or
@@ -68,16 +166,88 @@ class AudioProcessingSettings:
 @dataclass
 class VLCModificationSettings:
     tempo_scale: float = 1
+    # In semitones, applied by VLC's scaletempo_pitch filter
+    pitch_shift: float = 0
 
 
-async def process_audio(source_path: Path, dest_path: Path,
-                        settings: AudioProcessingSettings) -> VLCModificationSettings:
+async def process_audio(source_path: Path, dest_path: Path, settings: AudioProcessingSettings, *,
+                        process_pool: ProcessPool | None = None, timeout: float | None = None,
+                        beat_index: BeatAnalysisIndex | None = None, source_key: str | None = None,
+                        vlc_settings: VLCModificationSettings | None = None, buffered: Future[None] | None = None,
+                        buffer_size: int = 0, duration: float | None = None, parallelism: int = 1,
+                        segment_duration: float = 0) -> tuple[Path, VLCModificationSettings]:
+    """
+    Plans the processing as a single pass: the track is decoded once and encoded at most once. Syncopation streams its
+    raw PCM block by block straight into the ffmpeg encoder, resolving buffered (with vlc_settings already filled in)
+    once buffer_size bytes can be played. Processing that only changes the tempo encodes nothing at all, and the
+    returned path is then the (shared, read-only) source. With a parallelism above 1, tracks longer than
+    segment_duration seconds are rendered as that many segments at once.
+    """
     import audio_processing.ffmpeg
     import audio_processing.syncopation
 
-    vlc_settings = VLCModificationSettings()
+    vlc_settings = vlc_settings if vlc_settings is not None else VLCModificationSettings()
     if settings.requires_syncopation_processing:
-        await audio_processing.syncopation.process_audio(source_path, source_path, settings, vlc_settings)
-    if settings.requires_ffmpeg_processing:
-        await audio_processing.ffmpeg.process_audio(source_path, dest_path, settings, vlc_settings)
-    return vlc_settings
+        native_rate, channels = await to_thread(audio_processing.ffmpeg.probe_audio, source_path)
+        channels = min(channels, 2)
+        encoder_args: list[str] = audio_processing.ffmpeg.pcm_encoder_args(
+            dest_path, settings, vlc_settings, native_rate, channels
+        )
+        use_index: bool = beat_index is not None and source_key is not None
+        analysis: BeatAnalysis | None = \
+            beat_index.get(source_key, audio_processing.syncopation.analysis_duration) if use_index else None
+        start_time: float = monotonic()
+        new_analysis: BeatAnalysis = await audio_processing.syncopation.process_audio(
+            source_path, dest_path, settings, encoder_args, native_rate, channels, process_pool=process_pool,
+            timeout=timeout, analysis=analysis, buffered=buffered, buffer_size=buffer_size
+        )
+        if use_index and new_analysis != analysis:
+            await beat_index.put(source_key, new_analysis)
+        metrics.processing_seconds.labels("syncopation", settings.effect_label).observe(monotonic() - start_time)
+        return dest_path, vlc_settings
+    if not settings.requires_ffmpeg_filters:
+        vlc_settings.tempo_scale = abs(settings.tempo_scale)
+        return source_path, vlc_settings
+    start_time: float = monotonic()
+    if parallelism > 1 and duration is not None and segment_duration > 0 and duration > segment_duration and \
+            settings.supports_segmented_rendering:
+        await audio_processing.ffmpeg.segmented_process_audio(
+            source_path, dest_path, settings, vlc_settings, duration, parallelism, segment_duration
+        )
+        metrics.processing_seconds.labels("ffmpeg_segmented", settings.effect_label).observe(monotonic() - start_time)
+        return dest_path, vlc_settings
+    await audio_processing.ffmpeg.process_audio(source_path, dest_path, settings, vlc_settings)
+    metrics.processing_seconds.labels("ffmpeg", settings.effect_label).observe(monotonic() - start_time)
+    return dest_path, vlc_settings
+
+
+@cache
+def realtime_effects_available() -> bool:
+    """Whether the real-time effects pipeline can run, since it needs numpy and ffmpeg-python."""
+    try:
+        import audio_processing.realtime
+    except ImportError as e:
+        print(f"Warning: real-time effects are unavailable, so they will be rendered offline: {e!r}", file=stderr)
+        return False
+    return True
+
+
+async def draft_process_audio(source_path: Path, dest_path: Path, settings: AudioProcessingSettings,
+                              vlc_settings: VLCModificationSettings, seconds: float) -> None:
+    import audio_processing.ffmpeg
+
+    start_time: float = monotonic()
+    await audio_processing.ffmpeg.draft_process_audio(source_path, dest_path, settings, vlc_settings, seconds)
+    metrics.processing_seconds.labels("ffmpeg_draft", settings.effect_label).observe(monotonic() - start_time)
+
+
+async def stream_process_audio(chunks: AsyncIterator[bytes], dest_path: Path, settings: AudioProcessingSettings,
+                               vlc_settings: VLCModificationSettings, buffered: Future[None],
+                               buffer_size: int, chunk_size: int) -> None:
+    import audio_processing.ffmpeg
+
+    start_time: float = monotonic()
+    await audio_processing.ffmpeg.stream_process_audio(
+        chunks, dest_path, settings, vlc_settings, buffered, buffer_size, chunk_size
+    )
+    metrics.processing_seconds.labels("ffmpeg_stream", settings.effect_label).observe(monotonic() - start_time)
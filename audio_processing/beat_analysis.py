@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import json
+import os
+from asyncio import Lock, to_thread
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from sys import stderr
+from typing import Any
+
+from pipeline_scheduler import PipelineScheduler, PipelineStage
+
+
+@dataclass
+class BeatAnalysis:
+    beat_frames: list[int]
+    tempo: float
+    sample_rate: int
+    hop_length: int
+    # Seconds analysed from the start of the track, or None if the whole track was analysed
+    duration: float | None
+    # Length of the decoded track in seconds, which the time map of a full-length render ends at
+    track_duration: float | None = None
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+    @staticmethod
+    def from_dict(data: dict[str, Any]) -> BeatAnalysis:
+        return BeatAnalysis(**data)
+
+
+class BeatAnalysisIndex:
+    """
+    Persistent index of beat-tracking results keyed by source cache key, so that syncopating a song again with another
+    pattern or quantisation scale only has to compute the time map and stretch. Bounded to max_entries, least recently
+    used first, and written atomically as a single JSON file, in a worker thread so that writing it never stalls
+    playback.
+    """
+
+    path: Path
+    max_entries: int
+    _entries: OrderedDict[str, BeatAnalysis]
+    _save_lock: Lock
+    _unsaved: bool
+
+    def __init__(self, path: os.PathLike | str, max_entries: int):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._save_lock = Lock()
+        self._unsaved = False
+        if self.path.is_file():
+            try:
+                for key, data in json.loads(self.path.read_text()).items():
+                    self._entries[key] = BeatAnalysis.from_dict(data)
+            except (json.JSONDecodeError, TypeError) as e:
+                print(f"Warning: ignoring corrupt beat analysis index: {e}", file=stderr)
+                self._entries.clear()
+
+    def _write(self, entries: list[tuple[str, BeatAnalysis]]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path: Path = self.path.with_suffix(self.path.suffix + ".tmp")
+        partial_path.write_text(json.dumps({key: analysis.to_dict() for key, analysis in entries}))
+        os.replace(partial_path, self.path)
+
+    async def _save(self) -> None:
+        # Puts made while a write is running are all saved by the one write that follows it
+        self._unsaved = True
+        async with self._save_lock:
+            if not self._unsaved:
+                return
+            self._unsaved = False
+            await to_thread(self._write, list(self._entries.items()))
+
+    def get(self, key: str, duration: float | None) -> BeatAnalysis | None:
+        analysis: BeatAnalysis | None = self._entries.get(key)
+        if analysis is None or analysis.duration != duration:
+            return None
+        self._entries.move_to_end(key)
+        return analysis
+
+    async def put(self, key: str, analysis: BeatAnalysis) -> None:
+        self._entries[key] = analysis
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        await self._save()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    async def analyse_when_idle(self, key: str, source_path: Path, scheduler: PipelineScheduler,
+                                timeout: float | None = None) -> None:
+        """
+        Analyses a downloaded track in advance, but only if the processing stage has nothing running or queued when
+        asked, so it never takes a slot that real processing was waiting for.
+        """
+        if not scheduler.idle(PipelineStage.PROCESSING):
+            return
+        import audio_processing.syncopation
+
+        def analysed() -> bool:
+            return self.get(key, audio_processing.syncopation.analysis_duration) is not None
+
+        if analysed():
+            return
+        try:
+            async with scheduler.slot(PipelineStage.PROCESSING):
+                if analysed() or not source_path.exists():
+                    return
+                await self.put(key, await audio_processing.syncopation.analyse_audio(
+                    source_path, scheduler.process_pool, timeout
+                ))
+        except Exception as e:
+            # The download may well have been freed in the meantime; this was only ever speculative
+            print(f"Warning: couldn't analyse beats of {source_path} in advance: {e!r}", file=stderr)
@@ -0,0 +1,89 @@
+from enum import Enum
+from math import isfinite
+
+from audio_processing import AudioProcessingSettings, VLCModificationSettings
+
+
+class ProcessingRoute(Enum):
+    # Played as downloaded, with any tempo change applied by VLC
+    NONE = "none"
+    # Tempo and pitch applied by VLC (rate and scaletempo_pitch), echo stages by the real-time effects pipeline
+    REALTIME = "realtime"
+    # Rendered by ffmpeg (and syncopation) before it can play
+    OFFLINE = "offline"
+
+
+class RenderCostModel:
+    """
+    Estimates how long an offline render takes from the song's duration and its effects. Starts from per-effect priors
+    in seconds of rendering per minute of audio (roughly what benchmarks/effect_chain_benchmark.py measures on one
+    core), and moves towards the rate actually observed for each combination of effects as renders finish.
+    """
+
+    base_cost: float = 0.8
+    effect_costs: dict[str, float] = {
+        "syncopation": 6,
+        "reverse": 0.3,
+        "pitch": 2.5,
+        "tempo": 0.3,
+        "echo": 0.2,
+        "metal": 0.2,
+        "reverb": 0.6
+    }
+    # Weight of each new observation in the moving average
+    smoothing: float = 0.3
+
+    _observed: dict[str, float]
+
+    def __init__(self):
+        self._observed = {}
+
+    def seconds_per_minute(self, settings: AudioProcessingSettings) -> float:
+        observed: float | None = self._observed.get(settings.effect_label)
+        if observed is not None:
+            return observed
+        return RenderCostModel.base_cost + sum(
+            RenderCostModel.effect_costs.get(effect, 0) for effect in settings.effect_label.split("+")
+        )
+
+    def estimate(self, settings: AudioProcessingSettings, duration: float) -> float:
+        if not isfinite(duration):
+            return float("inf")
+        return self.seconds_per_minute(settings) * duration / 60
+
+    def observe(self, settings: AudioProcessingSettings, duration: float, seconds: float) -> None:
+        if not isfinite(duration) or duration <= 0:
+            return
+        rate: float = seconds / (duration / 60)
+        previous: float | None = self._observed.get(settings.effect_label)
+        self._observed[settings.effect_label] = rate if previous is None else \
+            previous + RenderCostModel.smoothing * (rate - previous)
+
+
+render_costs: RenderCostModel = RenderCostModel()
+
+
+def choose_route(settings: AudioProcessingSettings, duration: float, wait: float, realtime_effects: bool,
+                 realtime_pitch: bool, render_budget: float) -> ProcessingRoute:
+    """
+    Renders offline whenever the render is expected to finish before the song's turn comes (or within render_budget
+    seconds of it), since rubberband and ffmpeg sound better than VLC's real-time filters. Otherwise the song is played
+    straight away through the real-time path, as long as everything it asks for can be done there.
+    """
+    if not settings.requires_rendering:
+        return ProcessingRoute.NONE
+    if not settings.supports_realtime_effects or (settings.echo_stages and not realtime_effects) or \
+            (settings.pitch_shift and not realtime_pitch):
+        return ProcessingRoute.OFFLINE
+    if not settings.pitch_shift:
+        # The echo stages cost nothing at all in real time, and can then be toggled while the song plays
+        return ProcessingRoute.REALTIME
+    estimate: float = render_costs.estimate(settings, duration)
+    # Without a known duration there is nothing to weigh, so it renders offline as every song did before routing
+    if not isfinite(estimate) or estimate <= max(wait, 0) + render_budget:
+        return ProcessingRoute.OFFLINE
+    return ProcessingRoute.REALTIME
+
+
+def realtime_vlc_settings(settings: AudioProcessingSettings) -> VLCModificationSettings:
+    return VLCModificationSettings(abs(settings.tempo_scale), settings.pitch_shift)
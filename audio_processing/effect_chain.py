@@ -0,0 +1,110 @@
+import hashlib
+import os
+from array import array
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from pathlib import Path
+from tempfile import gettempdir
+from typing import Any
+
+from audio_processing import AudioProcessingSettings, EchoStage
+
+# Merged echo responses with more taps than this are convolved by FFT (afir) rather than summed tap by tap (aecho)
+fir_min_taps: int = 16
+
+
+def echo_args(in_gain: float, out_gain: float, delays: Sequence[float], decays: Sequence[float]) -> \
+        tuple[float, float, str, str]:
+    return in_gain, out_gain, "|".join(str(delay) for delay in delays), "|".join(str(decay) for decay in decays)
+
+
+def impulse_response(stages: list[EchoStage], sr: int) -> dict[int, float]:
+    """The cascade of aecho stages as one sparse FIR filter, mapping delays in samples to gains."""
+    response: dict[int, float] = {0: 1.0}
+    for stage in stages:
+        stage_response: dict[int, float] = {0: stage.in_gain * stage.out_gain}
+        for delay, decay in zip(stage.delays, stage.decays):
+            # Truncated like aecho does
+            taps: int = int(delay * sr / 1000)
+            stage_response[taps] = stage_response.get(taps, 0) + decay * stage.out_gain
+        cascaded: dict[int, float] = {}
+        for delay, gain in response.items():
+            for stage_delay, stage_gain in stage_response.items():
+                cascaded[delay + stage_delay] = cascaded.get(delay + stage_delay, 0) + gain * stage_gain
+        response = cascaded
+    return response
+
+
+@dataclass
+class FilterStage:
+    name: str
+    args: tuple[Any, ...] = ()
+    kwargs: dict[str, Any] = field(default_factory=dict)
+    # Raw mono float32 PCM at the chain's sample rate, fed to the filter as its second input
+    impulse_response: Path | None = None
+
+
+def impulse_response_file(response: dict[int, float]) -> Path:
+    """Writes the dense impulse response to a file named by its content, so each distinct response is written once."""
+    samples: array = array("f", [0.0] * (max(response) + 1))
+    for delay, gain in response.items():
+        samples[delay] = gain
+    data: bytes = samples.tobytes()
+    path: Path = Path(gettempdir()) / f"further-ir-{hashlib.sha256(data).hexdigest()[:16]}.f32"
+    if not path.exists():
+        partial_path: Path = path.with_suffix(f".{os.getpid()}.tmp")
+        partial_path.write_bytes(data)
+        os.replace(partial_path, path)
+    return path
+
+
+def _echo_stage(response: dict[int, float], sr: int) -> FilterStage:
+    """A single aecho equivalent to the sparse response (aecho accepts any number of delays)."""
+    delays: list[int] = sorted(delay for delay in response if delay > 0)
+    # Half a sample past each tap, so that aecho's truncation lands on it exactly
+    return FilterStage("aecho", echo_args(
+        response.get(0, 0), 1, [round((delay + 0.5) * 1000 / sr, 6) for delay in delays],
+        [response[delay] for delay in delays]
+    ))
+
+
+def compile_chain(settings: AudioProcessingSettings, sample_rate: int, rubberband: bool = False,
+                  afir_options: dict[str, Any] | None = None) -> list[FilterStage]:
+    """
+    Canonicalises the settings into the cheapest filter chain that renders the same effects:
+
+    * pitch and tempo in one rubberband filter when ffmpeg has it, instead of asetrate, aresample and atempo
+    * every echo stage merged into one filter, since they are all FIR filters and cascade into a single response
+    * that response applied by aecho while it is short, and by FFT convolution (afir) once it is long, as reverb's is
+
+    afir_options are the options that keep afir from normalising the response, which differ between ffmpeg versions
+    (None if afir isn't available).
+    """
+    stages: list[FilterStage] = []
+    if settings.tempo_scale < 0:
+        stages.append(FilterStage("areverse"))
+    if settings.pitch_shift:
+        if rubberband:
+            stages.append(FilterStage("rubberband", kwargs={
+                "tempo": abs(settings.tempo_scale), "pitch": settings.pitch_scale
+            }))
+        else:
+            stages.append(FilterStage("asetrate", (sample_rate * settings.pitch_scale,)))
+            stages.append(FilterStage("aresample", (sample_rate,)))
+            stages.append(FilterStage("atempo", (abs(settings.tempo_scale) / settings.pitch_scale,)))
+    if settings.echo_stages:
+        response: dict[int, float] = impulse_response(settings.echo_stages, sample_rate)
+        # aecho's gains are limited to [0, 1]
+        fits_aecho: bool = all(0 <= gain <= 1 for gain in response.values())
+        if afir_options is not None and (len(response) > fir_min_taps or not fits_aecho):
+            # afir needs the input at the response's sample rate
+            stages.append(FilterStage("aresample", (sample_rate,)))
+            stages.append(FilterStage("afir", kwargs=afir_options, impulse_response=impulse_response_file(response)))
+        elif fits_aecho:
+            stages.append(_echo_stage(response, sample_rate))
+        else:
+            stages.extend(
+                FilterStage("aecho", echo_args(stage.in_gain, stage.out_gain, stage.delays, stage.decays))
+                for stage in settings.echo_stages
+            )
+    return stages
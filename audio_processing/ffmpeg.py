@@ -1,44 +1,200 @@
-from asyncio import to_thread
+import subprocess
+from asyncio import to_thread, create_subprocess_exec, Future, TaskGroup, Semaphore
+from asyncio.subprocess import Process, PIPE, DEVNULL
+from collections.abc import AsyncIterator
+from functools import cache, reduce
+from math import ceil
 from pathlib import Path
+from typing import Any
 
 import ffmpeg
 from ffmpeg import Stream
 
 from audio_processing import AudioProcessingSettings, VLCModificationSettings
+from audio_processing.effect_chain import FilterStage, compile_chain
 
 
-def echo_args(in_gain: float, out_gain: float, delays: list[float], decays: list[float]) -> \
-        tuple[float, float, str, str]:
-    return in_gain, out_gain, "|".join(str(delay) for delay in delays), "|".join(str(decay) for decay in decays)
+@cache
+def available_filters() -> frozenset[str]:
+    try:
+        listing: str = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-filters"], capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return frozenset()
+    # Each filter is listed as " <flags> <name> <pads> <description>"
+    return frozenset(line.split()[1] for line in listing.splitlines() if len(line.split()) > 2 and "->" in line)
+
+
+@cache
+def afir_options() -> dict[str, Any] | None:
+    """Options that make afir apply the impulse response as it is, or None if this ffmpeg has no afir."""
+    if "afir" not in available_filters():
+        return None
+    help_text: str = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-h", "filter=afir"], capture_output=True, text=True
+    ).stdout
+    # irnorm replaced gtype in ffmpeg 5.1
+    if "irnorm" in help_text:
+        return {"irnorm": -1}
+    return {"gtype": "none"} if "gtype" in help_text else {}
+
+
+def apply_filters(stream: Stream, settings: AudioProcessingSettings, vlc_settings: VLCModificationSettings,
+                  frame_rate: int = 44100, draft: bool = False) -> Stream:
+    """Applies the compiled effect chain; a draft chain only uses ffmpeg's cheapest filters (no rubberband or afir)."""
+    stages: list[FilterStage] = compile_chain(
+        settings, frame_rate, "rubberband" in available_filters() and not draft, None if draft else afir_options()
+    )
+    if not settings.pitch_shift:
+        vlc_settings.tempo_scale = abs(settings.tempo_scale)
+    for stage in stages:
+        if stage.impulse_response is not None:
+            impulse_response: Stream = ffmpeg.input(str(stage.impulse_response), format="f32le", ar=frame_rate, ac=1)
+            stream = ffmpeg.filter([stream, impulse_response], stage.name, *stage.args, **stage.kwargs)
+        else:
+            stream = stream.filter(stage.name, *stage.args, **stage.kwargs)
+    return stream
 
 
 async def process_audio(source_path: Path, dest_path: Path,
                         settings: AudioProcessingSettings, vlc_settings: VLCModificationSettings) -> None:
-    stream: Stream = ffmpeg.input(source_path)
-    if settings.tempo_scale < 0:
-        stream = stream.filter("areverse")
-    if settings.pitch_shift:
-        frame_rate: int = 44100
-        stream = stream.filter("asetrate", frame_rate * settings.pitch_scale)
-        stream = stream.filter("aresample", frame_rate)
-        stream = stream.filter("atempo", abs(settings.tempo_scale) / settings.pitch_scale)
-    else:
-        vlc_settings.tempo_scale = abs(settings.tempo_scale)
-    if settings.echo:
-        stream = stream.filter("aecho", *echo_args(
-            0.6,
-            0.3,
-            [100 * i for i in range(1, 4)],
-            [0.5 ** i for i in range(1, 4)]
-        ))
-    if settings.metal:
-        stream = stream.filter("aecho", *echo_args(0.8, 0.88, [20, 40], [0.8, 0.4]))
-    if settings.reverb:
-        stream = stream.filter("aecho", *echo_args(
-            0.8,
-            0.88,
-            [8 * i for i in range(1, 32)],
-            [0.95 ** i for i in range(1, 32)]
-        ))
+    stream: Stream = apply_filters(ffmpeg.input(source_path), settings, vlc_settings)
     stream = stream.output(str(dest_path))
     await to_thread(stream.run)
+
+
+async def draft_process_audio(source_path: Path, dest_path: Path, settings: AudioProcessingSettings,
+                              vlc_settings: VLCModificationSettings, seconds: float) -> None:
+    """
+    Quickly renders the first seconds of the processed track, to play while the full render is still running. A
+    reversed track starts with the end of its source.
+    """
+    input_options: dict[str, float] = {"sseof": -seconds} if settings.tempo_scale < 0 else {"t": seconds}
+    stream: Stream = apply_filters(ffmpeg.input(str(source_path), **input_options), settings, vlc_settings, draft=True)
+    # The fastest (and lowest quality) LAME setting
+    await _run(stream.output(str(dest_path), compression_level=9).overwrite_output().compile())
+
+
+async def _run(args: list[str]) -> None:
+    process: Process = await create_subprocess_exec(*args, stdout=DEVNULL, stderr=DEVNULL)
+    try:
+        if await process.wait():
+            raise ffmpeg.Error("ffmpeg", None, None)
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+async def segmented_process_audio(source_path: Path, dest_path: Path, settings: AudioProcessingSettings,
+                                  vlc_settings: VLCModificationSettings, duration: float, parallelism: int,
+                                  segment_duration: float, overlap: float = 1, warmup: float = 2) -> None:
+    """
+    Renders a long track as consecutive segments, parallelism of them at a time, and stitches them back together with
+    acrossfade. Segment i covers [i * segment_duration, (i + 1) * segment_duration + overlap), so that each crossfade
+    joins two renders of the same audio. Each segment is also decoded from warmup seconds earlier and trimmed after the
+    filters, so that echoes and the pitch shifter have their history by the time the segment is heard.
+    """
+    # The pitch path changes the tempo within ffmpeg, which shortens or lengthens everything after the filters
+    time_scale: float = 1 / abs(settings.tempo_scale) if settings.pitch_shift else 1
+    segment_count: int = ceil(duration / segment_duration)
+    segment_paths: list[Path] = [dest_path.with_name(f"{dest_path.stem}.segment{i}.wav") for i in range(segment_count)]
+    running: Semaphore = Semaphore(parallelism)
+
+    async def render_segment(i: int) -> None:
+        start: float = i * segment_duration
+        input_start: float = max(0.0, start - warmup)
+        input_options: dict[str, float] = {"ss": input_start} if input_start else {}
+        if i < segment_count - 1:
+            input_options["t"] = start + segment_duration + overlap - input_start
+        stream: Stream = apply_filters(ffmpeg.input(str(source_path), **input_options), settings, vlc_settings)
+        stream = stream.filter("atrim", start=(start - input_start) * time_scale).filter("asetpts", "PTS-STARTPTS")
+        async with running:
+            await _run(stream.output(str(segment_paths[i]), acodec="pcm_f32le").overwrite_output().compile())
+
+    try:
+        async with TaskGroup() as renders:
+            for i in range(segment_count):
+                renders.create_task(render_segment(i))
+        stitched: Stream = reduce(
+            lambda joined, segment: ffmpeg.filter([joined, segment], "acrossfade", d=overlap * time_scale),
+            (ffmpeg.input(str(path)) for path in segment_paths)
+        )
+        await _run(stitched.output(str(dest_path)).overwrite_output().compile())
+    finally:
+        for path in segment_paths:
+            path.unlink(missing_ok=True)
+
+
+def pcm_encoder_args(dest_path: Path, settings: AudioProcessingSettings, vlc_settings: VLCModificationSettings,
+                     sample_rate: int, channels: int = 1) -> list[str]:
+    """
+    Command line for an ffmpeg process that reads raw float32 PCM on stdin, applies the effects and encodes the result
+    once, so that a stage which has already decoded the audio doesn't need a lossless file in between.
+    """
+    stream: Stream = ffmpeg.input("pipe:0", format="f32le", ar=sample_rate, ac=channels)
+    stream = apply_filters(stream, settings, vlc_settings, sample_rate)
+    return stream.output(str(dest_path)).overwrite_output().compile()
+
+
+def pcm_decoder_args(source_path: Path, sample_rate: int, channels: int, start: float = 0) -> list[str]:
+    """
+    Command line for an ffmpeg process that decodes (and if need be resamples) source_path to float32 PCM on stdout,
+    from start seconds in.
+    """
+    stream: Stream = ffmpeg.input(str(source_path), ss=start) if start else ffmpeg.input(str(source_path))
+    return stream.output("pipe:1", format="f32le", ar=sample_rate, ac=channels).compile()
+
+
+def probe_audio(source_path: Path) -> tuple[int, int]:
+    """Returns the sample rate and channel count of the first audio stream of source_path."""
+    stream: dict = next(stream for stream in ffmpeg.probe(str(source_path))["streams"]
+                        if stream["codec_type"] == "audio")
+    return int(stream["sample_rate"]), int(stream["channels"])
+
+
+async def stream_process_audio(chunks: AsyncIterator[bytes], dest_path: Path, settings: AudioProcessingSettings,
+                               vlc_settings: VLCModificationSettings, buffered: Future[None],
+                               buffer_size: int, chunk_size: int) -> None:
+    """
+    Pipes the downloaded chunks through an ffmpeg subprocess and appends its output to dest_path as it is produced,
+    resolving buffered once buffer_size bytes are available for playback. Awaiting drain() on ffmpeg's stdin applies
+    back-pressure to the download whenever the encoder falls behind.
+    """
+    stream: Stream = apply_filters(ffmpeg.input("pipe:0"), settings, vlc_settings)
+    stream = stream.output("pipe:1", format="mp3", flush_packets=1)
+    process: Process = await create_subprocess_exec(
+        *stream.compile(), stdin=PIPE, stdout=PIPE, stderr=DEVNULL
+    )
+
+    async def feed() -> None:
+        try:
+            async for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        finally:
+            process.stdin.close()
+
+    async def drain_output() -> None:
+        written: int = 0
+        with open(dest_path, "wb") as dest:
+            while chunk := await process.stdout.read(chunk_size):
+                dest.write(chunk)
+                dest.flush()
+                written += len(chunk)
+                if written >= buffer_size and not buffered.done():
+                    buffered.set_result(None)
+
+    try:
+        async with TaskGroup() as pipeline:
+            pipeline.create_task(feed())
+            pipeline.create_task(drain_output())
+        if await process.wait():
+            raise ffmpeg.Error("ffmpeg", None, None)
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if not buffered.done():
+        buffered.set_result(None)
@@ -0,0 +1,119 @@
+import os
+import subprocess
+from asyncio import to_thread, get_event_loop, Task
+from pathlib import Path
+
+import numpy as np
+
+from audio_processing import AudioProcessingSettings
+from audio_processing.effect_chain import impulse_response
+from audio_processing.ffmpeg import pcm_decoder_args
+
+sample_rate: int = 44100
+channels: int = 2
+# About 93 ms per block, which (with VLC's own buffering) bounds how long an effect toggle takes to be heard
+block_samples: int = 4096
+
+
+class EffectsFilter:
+    """
+    Applies the echo stages of AudioProcessingSettings to consecutive blocks of audio, sample for sample what ffmpeg's
+    aecho chain would render. The filter keeps the input history its longest delay needs, so the effects can be changed
+    between any two blocks without a discontinuity.
+    """
+
+    sr: int
+    _delays: np.ndarray
+    _gains: np.ndarray
+    _history: np.ndarray
+
+    def __init__(self, settings: AudioProcessingSettings, sr: int = sample_rate, num_channels: int = channels):
+        self.sr = sr
+        self._history = np.zeros((0, num_channels), dtype=np.float32)
+        self.set_effects(settings)
+
+    def set_effects(self, settings: AudioProcessingSettings) -> None:
+        response: dict[int, float] = impulse_response(settings.echo_stages, self.sr)
+        self._delays = np.fromiter(response.keys(), dtype=np.int64, count=len(response))
+        self._gains = np.fromiter(response.values(), dtype=np.float32, count=len(response))
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        max_delay: int = int(self._delays.max())
+        if len(self._history) < max_delay:
+            self._history = np.concatenate((
+                np.zeros((max_delay - len(self._history), block.shape[1]), dtype=np.float32), self._history
+            ))
+        extended: np.ndarray = np.concatenate((self._history, block))
+        start: int = len(self._history)
+        output: np.ndarray = np.zeros_like(block)
+        for delay, gain in zip(self._delays, self._gains):
+            output += gain * extended[start - delay:start - delay + len(block)]
+        self._history = extended[len(extended) - max_delay:] if max_delay else extended[:0]
+        return output
+
+
+class RealtimeEffects:
+    """
+    Decodes a local file, filters it block by block and writes the raw PCM into a FIFO that VLC plays (with
+    media_options), so that echo effects cost no rendering before playback and can be toggled while the song is playing.
+    The FIFO's back-pressure paces decoding to playback.
+    """
+
+    source_path: Path
+    fifo_path: Path
+    start: float
+    effects: EffectsFilter
+    _decoder: subprocess.Popen | None = None
+    _closed: bool = False
+    _task: Task | None = None
+
+    def __init__(self, source_path: Path, fifo_path: Path, settings: AudioProcessingSettings, start: float = 0):
+        self.source_path = source_path
+        self.fifo_path = fifo_path
+        self.start = start
+        self.effects = EffectsFilter(settings)
+        self.fifo_path.unlink(missing_ok=True)
+        os.mkfifo(self.fifo_path)
+        self._task = get_event_loop().create_task(to_thread(self._pump))
+
+    @staticmethod
+    def media_options() -> list[str]:
+        return [":demux=rawaud", f":rawaud-channels={channels}", f":rawaud-samplerate={sample_rate}",
+                ":rawaud-fourcc=f32l"]
+
+    def set_effects(self, settings: AudioProcessingSettings) -> None:
+        self.effects.set_effects(settings)
+
+    def _pump(self) -> None:
+        self._decoder = subprocess.Popen(
+            pcm_decoder_args(self.source_path, sample_rate, channels, self.start),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        block_bytes: int = block_samples * channels * 4
+        try:
+            # Blocks until VLC opens the FIFO (or close() opens it instead)
+            with open(self.fifo_path, "wb", buffering=0) as fifo:
+                while not self._closed and (data := self._decoder.stdout.read(block_bytes)):
+                    block: np.ndarray = np.frombuffer(
+                        data[:len(data) - len(data) % (channels * 4)], dtype=np.float32
+                    ).reshape(-1, channels)
+                    fifo.write(self.effects.process(block).tobytes())
+        except (BrokenPipeError, ValueError):
+            # The player closed the FIFO (the song was skipped, or reopened elsewhere)
+            pass
+        finally:
+            self._decoder.stdout.close()
+            if self._decoder.poll() is None:
+                self._decoder.kill()
+            self._decoder.wait()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            # Unblocks a pump still waiting for a reader to open the FIFO
+            os.close(os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+        self.fifo_path.unlink(missing_ok=True)
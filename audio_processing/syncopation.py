@@ -1,82 +1,296 @@
-from collections.abc import Iterable, Sequence
-from itertools import accumulate
+import subprocess
+from asyncio import to_thread, Future, Task, create_task, wait
+from collections.abc import Iterable, Iterator, Sequence
+from itertools import islice
 from pathlib import Path
+from typing import IO
 
 import librosa
 import numpy as np
-import soundfile as sf
 from pyrubberband.pyrb import timemap_stretch
 
 from audio_processing import AudioProcessingSettings, VLCModificationSettings
-from util import interpolate_index
+from audio_processing.beat_analysis import BeatAnalysis
+from audio_processing.ffmpeg import pcm_decoder_args
+from process_pool import ProcessPool
 
+# Beat tracking runs on a mono copy resampled by ffmpeg; the track itself is stretched at its native rate
+sample_rate: int = 22050
+hop_length: int = 512
+n_fft: int = 2048
+# The whole track is analysed and syncopated
+analysis_duration: float | None = None
+# Seconds of audio decoded, stretched and encoded at a time, which bounds memory whatever the length of the track
+block_duration: float = 30
+# Seconds each block is stretched past its end and crossfaded into the next, hiding the seams at block edges
+block_overlap: float = 0.1
+buffer_poll_interval: float = 0.25
 
-def even_syncopation(beats: list[float], num_samples: int, pattern: Iterable[float] = (2, 1)) -> \
-        list[tuple[float, float]]:
-    pattern_integral: list[float] = list(accumulate(pattern))
-    pattern_len: int = len(pattern_integral)
-    pattern_sum = pattern_integral[-1]
-    pattern_integral.insert(0, 0)
 
-    beat_start = beats[0]
-    beat_duration = beats[-1] - beats[0]
+def interpolate_indices(seq: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """Linear interpolation of seq at the fractional indices x, evaluated in the same order as the scalar original."""
+    i: np.ndarray = x.astype(np.int64)
+    following: np.ndarray = seq[np.minimum(i + 1, len(seq) - 1)]
+    return np.where(x == i, seq[i], seq[i] * (i - x + 1) + following * (x - i))
 
-    syncopation: list[float] = [
-        pattern_sum * (i // pattern_len) + pattern_integral[i % pattern_len]
-        for i in range(len(beats))
-    ]
 
-    max_syncopation_space_value = max(syncopation)
+def _with_ends(sources: np.ndarray, dests: np.ndarray, num_samples: int) -> list[tuple[int, int]]:
+    return [(0, 0)] + list(zip(sources.tolist(), dests.tolist())) + [(num_samples, num_samples)]
+
+
+def even_syncopation(beats: Sequence[float] | np.ndarray, num_samples: int, pattern: Iterable[float] = (2, 1)) -> \
+        list[tuple[int, int]]:
+    beats = np.asarray(beats, dtype=np.float64)
+    pattern_integral: np.ndarray = np.concatenate(([0], np.cumsum(tuple(pattern), dtype=np.float64)))
+    pattern_len: int = len(pattern_integral) - 1
+    pattern_sum: float = pattern_integral[-1]
+
+    beat_start: float = beats[0]
+    beat_duration: float = beats[-1] - beats[0]
+
+    indices: np.ndarray = np.arange(len(beats))
+    syncopation: np.ndarray = pattern_sum * (indices // pattern_len) + pattern_integral[indices % pattern_len]
 
-    return (
-            [(0, 0)] +
-            [(round(beats[n]), round(syncopation[n] * beat_duration / max_syncopation_space_value + beat_start))
-             for n in range(len(beats))] +
-            [(num_samples, num_samples)]
+    return _with_ends(
+        np.round(beats).astype(np.int64),
+        np.round(syncopation * beat_duration / syncopation.max() + beat_start).astype(np.int64),
+        num_samples
     )
 
 
-def flexible_syncopation(beats: list[float], num_samples: int, pattern: Sequence[float] = (2, 1)) -> \
-        list[tuple[float, float]]:
+def flexible_syncopation(beats: Sequence[float] | np.ndarray, num_samples: int, pattern: Sequence[float] = (2, 1)) -> \
+        list[tuple[int, int]]:
+    beats = np.asarray(beats, dtype=np.float64)
     pattern_len: int = len(pattern)
-    pattern_integral: list[float] = [0] + list(x / sum(pattern) for x in accumulate(pattern))
+    pattern_integral: np.ndarray = np.cumsum(pattern, dtype=np.float64)[:-1] / sum(pattern)
+
+    measure_starts: np.ndarray = np.arange(len(beats) // pattern_len) * pattern_len
+    starts: np.ndarray = beats[measure_starts]
+    following: np.ndarray = measure_starts + pattern_len
+    # The last full measure lasts as long as the one before it (wrapping around, like a negative list index, if it is
+    # also the first)
+    durations: np.ndarray = np.where(
+        following < len(beats),
+        beats[np.minimum(following, len(beats) - 1)] - starts,
+        starts - beats[measure_starts - pattern_len]
+    )
+
+    return _with_ends(
+        np.round(beats[:len(measure_starts) * pattern_len]).astype(np.int64),
+        np.round(
+            starts[:, np.newaxis] + durations[:, np.newaxis] * np.concatenate(([0], pattern_integral))
+        ).astype(np.int64).ravel(),
+        num_samples
+    )
 
-    time_map = [(0, 0)]
-    for measure in range(len(beats) // pattern_len):
-        measure_start: float = beats[measure * pattern_len]
 
-        measure_duration: float = (
-            beats[(measure + 1) * pattern_len] - beats[measure * pattern_len]
-            if (measure + 1) * pattern_len < len(beats) else
-            beats[measure * pattern_len] - beats[(measure - 1) * pattern_len]
-        )
+def _read_blocks(stream: IO[bytes], block_samples: int, channels: int = 1) -> Iterator[np.ndarray]:
+    block_bytes: int = block_samples * channels * 4
+    while data := stream.read(block_bytes):
+        yield np.frombuffer(data[:len(data) - len(data) % (channels * 4)], dtype=np.float32).reshape(-1, channels)
 
-        for i in range(pattern_len):
-            time_map.append((
-                round(beats[measure * pattern_len + i]),
-                round(measure_start + measure_duration * pattern_integral[i])
-            ))
-    time_map.append((num_samples, num_samples))
-    return time_map
+
+def _onset_envelope(blocks: Iterable[np.ndarray], sr: int) -> tuple[np.ndarray, int]:
+    """
+    librosa.onset.onset_strength (centred, with its default lag and max_size of 1) computed a block at a time, so that
+    only the envelope of the whole track is held in memory rather than its samples. Returns the envelope and the number
+    of samples read.
+
+    Unlike onset_strength, the spectrum is not clipped to 80 dB below its peak: that peak is only known once the whole
+    track has been read, and clipping against each block's own peak would make the envelope depend on where the blocks
+    fall. Only near-silent bins are affected.
+    """
+    # Centring pads both ends of the signal with n_fft // 2 zeros
+    pending: np.ndarray = np.zeros(n_fft // 2, dtype=np.float32)
+    previous: np.ndarray | None = None
+    differences: list[np.ndarray] = []
+    num_samples: int = 0
+    frames: int = 0
+
+    def consume() -> None:
+        nonlocal pending, previous, frames
+        if len(pending) < n_fft:
+            return
+        block_frames: int = 1 + (len(pending) - n_fft) // hop_length
+        spectrum: np.ndarray = librosa.power_to_db(librosa.feature.melspectrogram(
+            y=pending[:(block_frames - 1) * hop_length + n_fft], sr=sr, n_fft=n_fft, hop_length=hop_length,
+            center=False
+        ), top_db=None)
+        if previous is not None:
+            spectrum = np.concatenate((previous, spectrum), axis=1)
+        differences.append(np.mean(np.maximum(0, spectrum[:, 1:] - spectrum[:, :-1]), axis=0))
+        previous = spectrum[:, -1:]
+        pending = pending[block_frames * hop_length:]
+        frames += block_frames
+
+    for block in blocks:
+        num_samples += len(block)
+        pending = np.concatenate((pending, block[:, 0]))
+        consume()
+    pending = np.concatenate((pending, np.zeros(n_fft // 2, dtype=np.float32)))
+    consume()
+    # onset_strength pads the differences with lag + n_fft // (2 * hop_length) leading zeros, then trims to the frames
+    envelope: np.ndarray = np.concatenate([np.zeros(1 + n_fft // (2 * hop_length))] + differences)[:frames]
+    return envelope, num_samples
+
+
+def analyse(source_path: Path) -> BeatAnalysis:
+    decoder: subprocess.Popen = subprocess.Popen(
+        pcm_decoder_args(source_path, sample_rate, 1), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    try:
+        envelope, num_samples = _onset_envelope(_read_blocks(decoder.stdout, int(block_duration * sample_rate)),
+                                                sample_rate)
+    finally:
+        decoder.stdout.close()
+        decoder.kill()
+        decoder.wait()
+    tempo, frame_space_beats = librosa.beat.beat_track(onset_envelope=envelope, sr=sample_rate, hop_length=hop_length)
+    return BeatAnalysis(
+        [int(frame) for frame in frame_space_beats], float(np.atleast_1d(tempo)[0]), sample_rate, hop_length,
+        analysis_duration, num_samples / sample_rate
+    )
 
 
-async def process_audio(source_path: Path, dest_path: Path,
-                        settings: AudioProcessingSettings, _: VLCModificationSettings) -> None:
-    y, sr = librosa.load(source_path, duration=20)
+def time_map(analysis: BeatAnalysis, settings: AudioProcessingSettings, sr: int) -> list[tuple[int, int]]:
+    """The syncopation time map, in samples at sr, from the analysis of the whole track."""
+    num_samples: int = round(analysis.track_duration * sr)
+    if len(analysis.beat_frames) < 2:
+        return [(0, 0), (num_samples, num_samples)]
+    sample_space_beats: np.ndarray = \
+        np.asarray(analysis.beat_frames, dtype=np.float64) * analysis.hop_length * sr / analysis.sample_rate
 
     quantization_scale = settings.syncopation.quantization_scale
     pattern = settings.syncopation.pattern
 
-    tempo, frame_space_beats = librosa.beat.beat_track(y=y, sr=sr)
-    sample_space_beats = librosa.frames_to_samples(frame_space_beats)
+    rescaled_beats: np.ndarray = interpolate_indices(
+        sample_space_beats, np.linspace(0, len(sample_space_beats) - 1, len(sample_space_beats) * quantization_scale)
+    )
+
+    syncopation_generator = flexible_syncopation if settings.syncopation.flexible else even_syncopation
+    return syncopation_generator(rescaled_beats, num_samples, pattern)
+
+
+def _split_time_map(anchors: list[tuple[float, float]], block_samples: int) -> list[list[tuple[float, float]]]:
+    """Splits the time map at beats at least block_samples apart, so that every block is stretched on its own."""
+    segments: list[list[tuple[float, float]]] = [[anchors[0]]]
+    for anchor in anchors[1:]:
+        segments[-1].append(anchor)
+        if anchor[0] - segments[-1][0][0] >= block_samples and anchor is not anchors[-1]:
+            segments.append([anchor])
+    return segments
 
-    rescaled_beats: list[float] = [
-        float(interpolate_index(sample_space_beats, x))
-        for x in np.linspace(0, len(sample_space_beats) - 1, len(sample_space_beats) * quantization_scale)
+
+def _local_map(anchors: list[tuple[float, float]], length: int) -> list[tuple[int, int]]:
+    """The time map relative to its first anchor, clipped or extended to the length actually decoded."""
+    source_start, dest_start = anchors[0]
+    local: list[tuple[int, int]] = [
+        (round(source - source_start), round(dest - dest_start))
+        for source, dest in anchors if source - source_start < length
     ]
+    # Samples past the last anchor kept are stretched like the stretch they fall in, or the final one
+    following: int = min(len(local), len(anchors) - 1)
+    (previous_source, previous_dest), (end_source, end_dest) = anchors[following - 1], anchors[following]
+    ratio: float = (end_dest - previous_dest) / (end_source - previous_source) if end_source > previous_source else 1
+    last_source, last_dest = local[-1]
+    local.append((length, round(last_dest + (length - last_source) * ratio)))
+    return local
 
-    syncopation_generator = flexible_syncopation if settings.syncopation.flexible else even_syncopation
 
-    y_stretched = timemap_stretch(y, sr, syncopation_generator(rescaled_beats, len(y), pattern))
+def _crossfade(tail: np.ndarray, head: np.ndarray) -> np.ndarray:
+    """head with the previous block's tail faded out over its start."""
+    n: int = min(len(tail), len(head))
+    if n == 0:
+        return head
+    fade: np.ndarray = np.linspace(0, 1, n, endpoint=False, dtype=np.float32)[:, np.newaxis]
+    head = head.copy()
+    head[:n] = head[:n] * fade + tail[:n] * (1 - fade)
+    return head
+
+
+def render(source_path: Path, dest_path: Path, settings: AudioProcessingSettings, encoder_args: list[str],
+           native_rate: int, channels: int, analysis: BeatAnalysis | None = None) -> BeatAnalysis:
+    """
+    Syncopates the whole track a block at a time: each block is decoded at the native rate, stretched with its part of
+    the time map and piped into the encoder, so peak memory stays flat and the start of the output is written (and can
+    be played) long before the end is rendered. Each block is stretched block_overlap past its end and overlap-added
+    onto the start of the next.
+    """
+    if analysis is None or analysis.sample_rate != sample_rate or analysis.track_duration is None:
+        analysis = analyse(source_path)
+    segments: list[list[tuple[float, float]]] = _split_time_map(
+        time_map(analysis, settings, native_rate), int(block_duration * native_rate)
+    )
+
+    decoder: subprocess.Popen = subprocess.Popen(
+        pcm_decoder_args(source_path, native_rate, channels), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    encoder: subprocess.Popen = subprocess.Popen(
+        encoder_args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    overlap: int = round(block_overlap * native_rate)
+    # Samples decoded for the previous block that also start this one, and the previous block's output past its end
+    carry: np.ndarray = np.zeros((0, channels), dtype=np.float32)
+    tail: np.ndarray = np.zeros((0, channels), dtype=np.float32)
+    try:
+        for i, segment in enumerate(segments):
+            last: bool = i == len(segments) - 1
+            length: int = round(segment[-1][0]) - round(segment[0][0])
+            # The decoded length can differ slightly from the analysed one, so the last block takes whatever is left
+            y: np.ndarray = np.concatenate(
+                [carry, *_read_blocks(decoder.stdout, native_rate, channels)] if last else
+                [carry, *islice(_read_blocks(decoder.stdout, max(length + overlap - len(carry), 0), channels), 1)]
+            )
+            carry = y[length:]
+            if len(y) == 0:
+                continue
+            # The overlap is stretched as the next block will stretch it, so that the two line up in the crossfade
+            local_map: list[tuple[int, int]] = _local_map(segment if last else segment + segments[i + 1][1:], len(y))
+            if any(source != dest for source, dest in local_map):
+                y = np.asarray(
+                    timemap_stretch(y[:, 0] if channels == 1 else y, native_rate, local_map), dtype=np.float32
+                ).reshape(-1, channels)
+            y = _crossfade(tail, y)
+            dest_length: int = len(y) if last else round(segment[-1][1]) - round(segment[0][1])
+            tail = y[dest_length:]
+            encoder.stdin.write(y[:dest_length].tobytes())
+        encoder.stdin.close()
+        if encoder.wait():
+            raise subprocess.CalledProcessError(encoder.returncode, encoder_args)
+    finally:
+        decoder.stdout.close()
+        for process in (decoder, encoder):
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+    return analysis
+
+
+async def process_audio(source_path: Path, dest_path: Path, settings: AudioProcessingSettings,
+                        encoder_args: list[str], native_rate: int, channels: int, *,
+                        process_pool: ProcessPool | None = None, timeout: float | None = None,
+                        analysis: BeatAnalysis | None = None, buffered: Future[None] | None = None,
+                        buffer_size: int = 0) -> BeatAnalysis:
+    """
+    Renders in the process pool (beat tracking and stretching are CPU-bound for many seconds, so they must stay off the
+    event loop), resolving buffered once buffer_size bytes of the output have been written.
+    """
+    args: tuple = (source_path, dest_path, settings, encoder_args, native_rate, channels, analysis)
+    job: Task[BeatAnalysis] = create_task(
+        process_pool.run(render, *args, timeout=timeout) if process_pool is not None else to_thread(render, *args)
+    )
+    try:
+        while buffered is not None and not buffered.done() and not job.done():
+            await wait({job}, timeout=buffer_poll_interval)
+            if dest_path.exists() and dest_path.stat().st_size >= buffer_size and not buffered.done():
+                buffered.set_result(None)
+        return await job
+    finally:
+        job.cancel()
+
 
-    sf.write(dest_path, y_stretched, sr)
+async def analyse_audio(source_path: Path, process_pool: ProcessPool | None = None,
+                        timeout: float | None = None) -> BeatAnalysis:
+    if process_pool is not None:
+        return await process_pool.run(analyse, source_path, timeout=timeout)
+    return await to_thread(analyse, source_path)
@@ -1,91 +1,397 @@
+from __future__ import annotations
+
 import traceback
-from asyncio import sleep, get_event_loop, Future, CancelledError, Task, TaskGroup, to_thread
+from asyncio import get_event_loop, Future, CancelledError, Task, TaskGroup, sleep, Event
+from collections import deque
 from collections.abc import Callable, Coroutine, Iterable
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
+from datetime import timedelta
 from enum import Enum
+from math import inf, isfinite, isnan
 from os import PathLike
 from pathlib import Path
 from sys import stderr
+from time import monotonic
+from typing import TYPE_CHECKING
 
-from vlc import Instance, MediaPlayer, Media
+from vlc import Instance, MediaPlayer, Media, MediaParseFlag
 from vlc import State as VLCState
 
-from async_queue import AsyncQueue
-from audio_processing import AudioProcessingSettings, process_audio, VLCModificationSettings
+import metrics
+from audio_processing import AudioProcessingSettings, process_audio, stream_process_audio, VLCModificationSettings, \
+    draft_process_audio, realtime_effects_available
+from audio_processing.beat_analysis import BeatAnalysisIndex
+from audio_processing.cost_model import ProcessingRoute, choose_route, render_costs, realtime_vlc_settings
 from audio_sources import AudioSource
+from download_cache import DownloadCache
 from duration import Duration
+from fair_share import FairShare, FairShareMode
+from indexed_queue import IndexedQueue
 from message_edit_status_callback import MessageEditStatusCallback
-from quiet_hours import is_quiet_hours
+from pipeline_scheduler import PipelineScheduler, PipelineStage
+from player_events import PlayerEvents
+from processed_cache import ProcessedAudioCache
+from queue_journal import QueueJournal
+from quiet_hours import is_quiet_hours, seconds_until_quiet_hours
 from resource_handler import ResourceHandler
 from settings import Settings
 
+if TYPE_CHECKING:
+    # Imported where it's used, since it needs numpy and ffmpeg-python
+    from audio_processing.realtime import RealtimeEffects
+
+
+class QueueFull(Exception):
+    reason: str
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
 
 @dataclass
 class AudioQueueElement:
     element_id: int
-    resource: ResourceHandler.Resource
     audio_source: AudioSource
     processing: AudioProcessingSettings
     message_setter: MessageEditStatusCallback
     path: Future[PathLike | None]
     download_task: Future[Task]
+    resource: ResourceHandler.Resource | None = None
     active: bool = False
     skipped: bool = False
     vlc_settings: VLCModificationSettings | None = None
+    on_skip: Callable[[], None] | None = None
+    expected_start: Callable[[], Duration] | None = None
+    early_path: Future[PathLike | None] = field(default_factory=Future)
+    journal: QueueJournal | None = None
+    resource_path: Path | None = None
+    downloaded_path: Path | None = None
+    ready_path: Path | None = None
+    start_position: int = 0
+    enqueued_at: float = field(default_factory=monotonic)
+    metadata_at: float = field(default_factory=monotonic)
+    started_at: float | None = None
+    download_cache: DownloadCache | None = None
+    download_key: str | None = None
+    requester_id: int | None = None
+    effects: RealtimeEffects | None = None
+    reopen: bool = False
+    route: ProcessingRoute | None = None
+    draft_path: Path | None = None
+
+    @property
+    def materialised(self) -> bool:
+        return self.resource is not None
 
     @property
     def freed(self) -> bool:
-        return not self.resource.is_open
+        return not self.resource.is_open if self.materialised else self.skipped
+
+    @property
+    def restored_files(self) -> bool:
+        return self.downloaded_path is not None or self.ready_path is not None
+
+    @property
+    def streamable(self) -> bool:
+        return Settings.stream_unprocessed and not self.processing.requires_rendering and \
+            self.audio_source.stream_url is not None and not self.restored_files
+
+    @property
+    def pipelined(self) -> bool:
+        return Settings.stream_processing and self.processing.supports_stream_processing and \
+            self.audio_source.stream_url is not None and not self.restored_files and not self.realtime_effects
+
+    @property
+    def realtime_effects(self) -> bool:
+        """Whether the effects are applied while the song plays, instead of being rendered beforehand."""
+        return self.route == ProcessingRoute.REALTIME
+
+    @property
+    def requires_rendering(self) -> bool:
+        return self.route == ProcessingRoute.OFFLINE
+
+    @property
+    def uses_effects_pipeline(self) -> bool:
+        return self.realtime_effects and bool(self.processing.echo_stages)
+
+    @property
+    def progressive(self) -> bool:
+        """Whether playback can start on a partial (or draft) render while the rest of it is still being processed."""
+        return self.pipelined or self.drafts or Settings.stream_syncopation and \
+            self.processing.requires_syncopation_processing and self.processing.tempo_scale > 0 and \
+            not self.restored_files
+
+    @property
+    def drafts(self) -> bool:
+        """Whether a slow offline render may be preceded by a quick draft of its start."""
+        return Settings.draft_render_min_seconds is not None and self.requires_rendering and \
+            not self.processing.requires_syncopation_processing
+
+    def record(self, event: str, **data) -> None:
+        if self.journal is not None:
+            self.journal.record(event, self.element_id, **data)
 
-    async def set_message(self, message: str, skippable: bool = True) -> None:
+    async def set_message(self, message: str, skippable: bool = True, with_eta: bool = False) -> None:
+        if with_eta and self.expected_start is not None:
+            message = f"{message} (starts in {self.expected_start().approximate})"
         try:
             await self.message_setter(message, self.element_id if skippable else None, self.audio_source.url)
         except Exception as e:
             print("Caught exception in audio_queue/set_message")
             traceback.print_exception(type(e), e, e.__traceback__, file=stderr)
 
-    async def download(self):
+    async def set_pending_message(self, message: str) -> None:
+        """Reports progress towards playing the song, unless it's already playing (from a stream or partial render)."""
+        if not self.active:
+            await self.set_message(message, with_eta=True)
+
+    @property
+    def processed_cache_key(self) -> str | None:
+        return self.audio_source.cache_key if self.processing.requires_rendering else None
+
+    def _choose_route(self, processed_cache: ProcessedAudioCache | None) -> ProcessingRoute:
+        if not self.processing.requires_rendering:
+            return ProcessingRoute.NONE
+        if self.ready_path is not None and self.ready_path.exists() or processed_cache is not None and \
+                self.processed_cache_key is not None and (self.processed_cache_key, self.processing) in processed_cache:
+            # Already rendered
+            return ProcessingRoute.OFFLINE
+        wait: float = self.expected_start().total_seconds() if self.expected_start is not None else 0
+        return choose_route(
+            self.processing, self.duration.total_seconds(), wait if isfinite(wait) else 0,
+            Settings.realtime_effects and realtime_effects_available(), Settings.realtime_pitch,
+            Settings.offline_render_budget
+        )
+
+    @property
+    def queued_message(self) -> str:
+        return "Queued (effects applied live)" if self.realtime_effects else "Queued"
+
+    async def download(self, download_cache: DownloadCache, priority: Callable[[], float],
+                       processed_cache: ProcessedAudioCache | None = None, beat_index: BeatAnalysisIndex | None = None):
+        scheduler: PipelineScheduler = download_cache.scheduler
+        self.route = self._choose_route(processed_cache)
+        metrics.processing_routes.labels(self.route.value, self.processing.effect_label).inc()
         try:
-            await self.set_message("Downloading")
-            path: Path = await self.audio_source.download(self.resource)
-            # path: Path = await to_thread(self.audio_source.download, self.resource)
-            if self.processing.requires_audio_processing:
-                await self.set_message("Processing")  # Can be removed if Telegram throttling is too bad
-                processed_path: Path = self.resource.path / "processed.mp3"
-                self.vlc_settings = await process_audio(path, processed_path, self.processing)
-                path = processed_path
+            if self.ready_path is not None and self.ready_path.exists():
+                path: Path | None = self.ready_path
             else:
-                self.vlc_settings = VLCModificationSettings()
-            await self.set_message("Queued", True)
+                path = self._from_processed_cache(processed_cache)
+                if path is None:
+                    if not scheduler.has_capacity(PipelineStage.DOWNLOAD):
+                        await self.set_pending_message("Waiting to download")
+                    path = await self._stream_process(scheduler, priority) if self.pipelined else None
+                    if path is None:
+                        path = await self._download_then_process(download_cache, priority, beat_index)
+                    if processed_cache is not None and self.processed_cache_key is not None and \
+                            self.requires_rendering:
+                        processed_cache.put(self.processed_cache_key, self.processing, path, self.vlc_settings)
+                if self.requires_rendering:
+                    self.record(
+                        "processed", resource=str(self.resource.path), path=str(path),
+                        tempo_scale=self.vlc_settings.tempo_scale
+                    )
+            await self.set_pending_message(self.queued_message)
             self.path.set_result(path)
         except CancelledError:
-            assert self.skipped
-            self.path.set_result(None)
+            if not self.path.done():
+                self.path.set_result(None)
             raise
         except Exception as e:
             self.path.set_exception(e)
+        finally:
+            if not self.early_path.done():
+                self.early_path.set_result(None)
+
+    def _from_processed_cache(self, processed_cache: ProcessedAudioCache | None) -> Path | None:
+        if processed_cache is None or self.processed_cache_key is None or not self.requires_rendering:
+            return None
+        processed_path: Path = self.resource.path / "processed.mp3"
+        vlc_settings: VLCModificationSettings | None = \
+            processed_cache.get(self.processed_cache_key, self.processing, processed_path)
+        metrics.processed_cache_lookups.labels("miss" if vlc_settings is None else "hit").inc()
+        if vlc_settings is None:
+            return None
+        self.vlc_settings = vlc_settings
+        return processed_path
+
+    async def _download_then_process(self, download_cache: DownloadCache, priority: Callable[[], float],
+                                     beat_index: BeatAnalysisIndex | None = None) -> Path:
+        key: str = self.audio_source.cache_key or f"element:{self.element_id}"
+        if self.downloaded_path is not None and self.downloaded_path.exists():
+            path: Path = download_cache.adopt(key, self.downloaded_path)
+        else:
+            path = await download_cache.acquire(
+                key, self.audio_source, priority, lambda: self.set_pending_message("Downloading")
+            )
+            metrics.metadata_to_downloaded_seconds.observe(monotonic() - self.metadata_at)
+            self.record("downloaded", path=str(path))
+        self.download_cache = download_cache
+        self.download_key = key
+        if Settings.beat_analysis_prefetch and beat_index is not None and self.audio_source.cache_key is not None \
+                and not self.processing.requires_syncopation_processing:
+            # So that syncopating this song later on only has to stretch it
+            get_event_loop().create_task(beat_index.analyse_when_idle(
+                self.audio_source.cache_key, path, download_cache.scheduler, Settings.processing_job_timeout
+            ))
+        if self.requires_rendering:
+            return await self._render(path, download_cache.scheduler, priority, beat_index)
+        # Plays the download as it is, with any tempo or pitch change applied by VLC
+        self.vlc_settings = realtime_vlc_settings(self.processing)
+        return path
+
+    async def _render(self, path: Path, scheduler: PipelineScheduler, priority: Callable[[], float],
+                      beat_index: BeatAnalysisIndex | None = None) -> Path:
+        processed_path: Path = self.resource.path / "processed.mp3"
+        buffered: Future[None] | None = None
+        if self.progressive and self.processing.requires_syncopation_processing:
+            buffered = get_event_loop().create_future()
+            buffered.add_done_callback(
+                lambda future: self.early_path.set_result(processed_path)
+                if not future.cancelled() and not self.early_path.done() else None
+            )
+        self.vlc_settings = VLCModificationSettings()
+        duration: float = self.duration.total_seconds()
+        segmented: bool = Settings.segment_render_threshold is not None and isfinite(duration) and \
+            duration >= Settings.segment_render_threshold and self.processing.supports_segmented_rendering
+        estimate: float = render_costs.estimate(self.processing, duration)
+        async with scheduler.slot(PipelineStage.PROCESSING, priority):
+            # Can be removed if Telegram throttling is too bad
+            await self.set_pending_message(
+                f"Processing offline (takes {Duration.from_seconds(estimate).approximate})"
+                if isfinite(estimate) else "Processing offline"
+            )
+            # Rendered alongside the full render rather than before it, so that it delays nothing
+            draft_task: Task | None = \
+                get_event_loop().create_task(self._render_draft(path)) if self._wants_draft(estimate) else None
+            start_time: float = monotonic()
+            # A long track also takes whichever other processing slots are idle, to render its segments in
+            with scheduler.spare_slots(
+                    PipelineStage.PROCESSING, Settings.segment_render_max_parallelism - 1 if segmented else 0
+            ) as spare_slots:
+                try:
+                    path, self.vlc_settings = await process_audio(
+                        path, processed_path, self.processing,
+                        process_pool=scheduler.process_pool,
+                        timeout=Settings.processing_job_timeout,
+                        beat_index=beat_index,
+                        source_key=self.audio_source.cache_key,
+                        vlc_settings=self.vlc_settings,
+                        buffered=buffered,
+                        buffer_size=Settings.stream_processing_buffer_size,
+                        duration=duration,
+                        parallelism=1 + spare_slots,
+                        segment_duration=Settings.segment_render_seconds
+                    )
+                finally:
+                    if draft_task is not None and not draft_task.done():
+                        # No use for a draft once the full render is ready
+                        draft_task.cancel()
+            render_costs.observe(self.processing, duration, monotonic() - start_time)
+        return path
+
+    async def render_offline(self, source_path: Path) -> Path:
+        """Renders the downloaded song after all, when its effects can't be applied in real time."""
+        self.route = ProcessingRoute.OFFLINE
+        metrics.processing_routes.labels(self.route.value, self.processing.effect_label).inc()
+        return await self._render(source_path, self.download_cache.scheduler, lambda: -1)
+
+    def _wants_draft(self, estimate: float) -> bool:
+        if not self.drafts or self.active or not isfinite(estimate) or estimate < Settings.draft_render_min_seconds:
+            return False
+        wait: float = self.expected_start().total_seconds() if self.expected_start is not None else 0
+        # Otherwise the full render is ready before the song is due anyway
+        return estimate > wait
+
+    async def _render_draft(self, source_path: Path) -> None:
+        draft_path: Path = self.resource.path / "draft.mp3"
+        try:
+            await draft_process_audio(
+                source_path, draft_path, self.processing, self.vlc_settings, Settings.draft_render_seconds
+            )
+        except Exception as e:
+            # The full render is still on its way
+            print(f"Warning: couldn't render a draft of {source_path}: {e!r}", file=stderr)
+            return
+        self.draft_path = draft_path
+        if not self.early_path.done():
+            self.early_path.set_result(draft_path)
+
+    async def _stream_process(self, scheduler: PipelineScheduler, priority: Callable[[], float]) -> Path | None:
+        processed_path: Path = self.resource.path / "processed.mp3"
+        buffered: Future[None] = get_event_loop().create_future()
+        buffered.add_done_callback(
+            lambda future: self.early_path.set_result(processed_path) if not future.cancelled() else None
+        )
+        self.vlc_settings = VLCModificationSettings()
+        try:
+            async with scheduler.slot(PipelineStage.DOWNLOAD, priority), \
+                    scheduler.slot(PipelineStage.PROCESSING, priority):
+                await self.set_pending_message("Processing")
+                await stream_process_audio(
+                    self.audio_source.stream(Settings.stream_processing_chunk_size),
+                    processed_path,
+                    self.processing,
+                    self.vlc_settings,
+                    buffered,
+                    Settings.stream_processing_buffer_size,
+                    Settings.stream_processing_chunk_size
+                )
+        except Exception as e:
+            if buffered.done():
+                raise
+            buffered.cancel()
+            processed_path.unlink(missing_ok=True)
+            print("Streaming pipeline failed, falling back to download then process", file=stderr)
+            traceback.print_exception(type(e), e, e.__traceback__, file=stderr)
+            return None
+        metrics.metadata_to_downloaded_seconds.observe(monotonic() - self.metadata_at)
+        return processed_path
 
     async def skip(self, username: str) -> bool:
         if self.skipped or self.freed:
             return False
         self.skipped = True
         self.active = False
+        self.record("skipped")
+        if self.on_skip is not None:
+            self.on_skip()
         if not self.active:
-            download_task = await self.download_task
-            download_task.cancel()
-        self.resource.close()
+            self.cancel_download()
+        self.free_resources()
         await self.set_message(f"Skipped by {username}", skippable=False)
 
-    async def finish(self):
-        if not self.freed:
+    def free_resources(self) -> None:
+        if self.effects is not None:
+            self.effects.close()
+            self.effects = None
+        if self.materialised and self.resource.is_open:
             self.resource.close()
+        if self.download_key is not None:
+            self.download_cache.release(self.download_key)
+            self.download_key = None
+
+    def cancel_download(self) -> None:
+        if self.download_task.done():
+            self.download_task.result().cancel()
+        elif not self.path.done():
+            self.path.set_result(None)
+
+    async def finish(self):
+        if not self.path.done():
+            # Still downloading in the background after streaming playback
+            self.cancel_download()
+        self.free_resources()
         self.active = False
         if not self.skipped:
+            self.record("played")
             await self.set_message(f"Played", skippable=False)
 
     @property
     def duration(self) -> Duration:
-        return self.audio_source.duration / self.processing.tempo_scale
+        # Reversing a song doesn't change how long it plays for
+        return self.audio_source.duration / abs(self.processing.tempo_scale)
 
 
 class AudioQueue(Iterable[AudioQueueElement]):
@@ -112,23 +418,146 @@ class AudioQueue(Iterable[AudioQueueElement]):
                 case AudioQueue.State.VLC_ERROR:
                     return "VLC Error"
 
-    queue: AsyncQueue[AudioQueueElement]
+    queue: IndexedQueue[int, AudioQueueElement]
+    fair_share: FairShare[int]
+    _queue_nonempty: Event
+    _space_freed: Event
     instance: Instance
     player: MediaPlayer
+    player_events: PlayerEvents
+    standby_player: MediaPlayer
+    standby_player_events: PlayerEvents
+    scheduler: PipelineScheduler
+    resource_handler: ResourceHandler
+    journal: QueueJournal | None
+    processed_cache: ProcessedAudioCache | None
+    beat_index: BeatAnalysisIndex | None
     current: AudioQueueElement | None = None
+    track_gaps: deque[float]
+    gap_listeners: list[Callable[[float], None]]
+    _staged: AudioQueueElement | None = None
+    _crossfaded_into: AudioQueueElement | None = None
+    _crossfade_task: Task | None = None
+    _silence_start: float | None = None
+    _absolute_volume: int = 100
     _next_id: int = 0
 
-    def __init__(self):
-        self.queue = AsyncQueue()
+    def __init__(self, zone: str, download_cache: DownloadCache, journal: QueueJournal | None = None,
+                 audio_device: str | None = None, processed_cache: ProcessedAudioCache | None = None,
+                 beat_index: BeatAnalysisIndex | None = None):
+        self.queue = IndexedQueue(
+            lambda element: element.element_id,
+            weight=AudioQueue._queue_weight
+        )
+        self.fair_share = FairShare(FairShareMode(Settings.fair_share_mode))
+        self._queue_nonempty = Event()
+        self._space_freed = Event()
+        self.zone = zone
+        self.download_cache = download_cache
+        self.resource_handler = download_cache.resource_handler
+        self.scheduler = download_cache.scheduler
+        self.journal = journal
+        self.processed_cache = processed_cache
+        self.beat_index = beat_index
         self.instance = Instance()
         self.player = self.instance.media_player_new()
+        self.player_events = PlayerEvents(self.player)
+        self.standby_player = self.instance.media_player_new()
+        self.standby_player_events = PlayerEvents(self.standby_player)
+        if audio_device is not None:
+            self.player.audio_output_device_set(None, audio_device)
+            self.standby_player.audio_output_device_set(None, audio_device)
+        self.player_events.listeners.append(self._on_player_state)
+        self.standby_player_events.listeners.append(self._on_player_state)
+        self.track_gaps = deque(maxlen=Settings.track_gap_history_length)
+        self.gap_listeners = [metrics.track_gap_seconds.labels(zone).observe]
+        self._register_metrics()
         get_event_loop().create_task(self.play_queue())
 
-    async def add(self, element: AudioQueueElement):
-        await self.queue.append(element)
-        download_task = get_event_loop().create_task(element.download())
+    def _register_metrics(self) -> None:
+        metrics.queue_depth.labels(self.zone).set_function(lambda: len(self.queue))
+
+    async def add(self, element: AudioQueueElement, limit: bool = False, wait: bool = False) -> None:
+        """
+        With limit, the admission limits are enforced here, with nothing awaited between the check and the insertion,
+        so concurrent requests can't overshoot them. A song that doesn't fit raises QueueFull, or, with wait, waits
+        until enough of the queue has been played or skipped.
+        """
+        waiting: bool = False
+        while limit and (reason := self.admission_refusal(element.requester_id, element.duration)) is not None:
+            if not wait:
+                raise QueueFull(reason)
+            if not waiting:
+                waiting = True
+                await element.set_message(f"Waiting for room in the queue ({reason})")
+                # The limits may have been lifted while the message was being sent
+                continue
+            self._space_freed.clear()
+            await self._space_freed.wait()
+        if self.journal is not None and element.journal is None:
+            self._journal_add(element)
+        AudioQueue._next_id = max(AudioQueue._next_id, element.element_id + 1)
+        element.expected_start = lambda: self.expected_start(element)
+        self.queue.append(element, self.fair_share.admit(
+            element.element_id, element.requester_id, element.duration.total_seconds()
+        ))
+        if self.queue.position(element.element_id) < len(self.queue) - 1:
+            # Everything queued after it moved back, so downloads and renders waiting for a slot need their priorities
+            # (queue positions) recomputed
+            self.scheduler.reprioritise()
+        if self._staged is not None and self.queue.peek() is element:
+            # Fair ordering put the new element ahead of the one already loaded into the standby player
+            self._staged = None
+            self._stage_next()
+        self._queue_nonempty.set()
+        element.path.add_done_callback(lambda _: self._stage_next())
+        if not element.materialised and self.processed_cache is not None and \
+                element.processed_cache_key is not None and \
+                (element.processed_cache_key, element.processing) in self.processed_cache:
+            # Already rendered, so it costs neither bandwidth nor processing and needn't wait for the horizon
+            self._materialise(element)
+        self._advance_horizon()
+        if not element.materialised:
+            await element.set_pending_message("Waiting to download")
+
+    def _journal_add(self, element: AudioQueueElement) -> None:
+        source: dict | None = element.audio_source.serialise()
+        status: dict | None = element.message_setter.serialise()
+        if source is None or status is None:
+            return
+        self.journal.record(
+            "add", element.element_id, zone=self.zone, source=source, processing=element.processing.to_dict(),
+            status=status
+        )
+        element.journal = self.journal
+
+    def _materialise(self, element: AudioQueueElement) -> None:
+        element.resource = self.resource_handler.claim(element.resource_path)
+        download_task = get_event_loop().create_task(
+            element.download(
+                self.download_cache, lambda: self.position_of(element), self.processed_cache, self.beat_index
+            )
+        )
         element.download_task.set_result(download_task)
 
+    def _advance_horizon(self) -> None:
+        horizon_seconds: float = (
+            Settings.download_horizon_minutes * 60 if Settings.download_horizon_minutes is not None else inf
+        )
+        horizon_tracks: float = (
+            Settings.download_horizon_tracks if Settings.download_horizon_tracks is not None else inf
+        )
+        start_offset: float = 0
+        for position, element in enumerate(self.queue):
+            if position > 0 and not (position < horizon_tracks and start_offset < horizon_seconds):
+                break
+            if not element.materialised:
+                self._materialise(element)
+            duration: float = element.duration.total_seconds()
+            # A song of unknown length doesn't push the rest out of the horizon, while a live stream (infinite) does
+            if not isnan(duration):
+                start_offset += duration
+
     # TODO return this when there is a FileAudioSource
     # async def play_without_queue(self, element: AudioQueueElement) -> None:
     #     if element.skipped:
@@ -185,100 +614,487 @@ class AudioQueue(Iterable[AudioQueueElement]):
         instance: Instance = Instance()
         player: MediaPlayer = instance.media_player_new()
 
-        player.audio_set_volume(self.player.audio_get_volume())
+        player.audio_set_volume(self._absolute_volume)
 
         player.set_rate(1)
 
         media: Media = instance.media_new_path(Settings.hampter_path)
         player.set_media(media)
 
-        player.play()
+        player_events: PlayerEvents = PlayerEvents(player)
+        player_events.play()
 
-        while player.get_state() not in (VLCState.Ended, VLCState.Stopped) and not is_quiet_hours():
-            await sleep(Settings.async_sleep_refresh_rate)
+        while not player_events.finished and not is_quiet_hours():
+            await player_events.wait(seconds_until_quiet_hours())
 
-        if player.get_state() not in (VLCState.Ended, VLCState.Stopped):
-            player.stop()
+        player_events.stop()
+
+    async def _next_element(self) -> AudioQueueElement:
+        while not self.queue:
+            self._queue_nonempty.clear()
+            await self._queue_nonempty.wait()
+        element: AudioQueueElement
+        if self._crossfaded_into is not None and self._crossfaded_into.element_id in self.queue:
+            # Already fading in on the other player, even if something has been ordered ahead of it since
+            element = self.queue.remove(self._crossfaded_into.element_id)
+        else:
+            element = self.queue.popleft()
+        self.fair_share.release(element.element_id, served=True)
+        self._space_freed.set()
+        return element
 
     async def play_queue(self) -> None:
-        async with self.queue.async_iter() as async_iterator:
-            async for element in async_iterator:
-                if element.skipped:
-                    continue
-                self.current = element
-                try:
-                    path: Path | None = await element.path
-                except Exception as e:
-                    self.current.skipped = True
-                    self.current.active = False
-                    self.current.resource.close()
-                    await self.current.set_message(f"An error occured during download", skippable=False)
-                    print("Caught exception during audio download")
-                    traceback.print_exception(type(e), e, e.__traceback__, file=stderr)
-                    continue
-                if path is None:
-                    assert element.skipped
-                    self.current = None
-                    continue
+        while True:
+            element: AudioQueueElement = await self._next_element()
+            self.current = element
+            try:
+                await self._play_element(element)
+            except Exception as e:
+                # One song failing to play mustn't stop the rest of the queue
+                print("Caught exception during playback")
+                traceback.print_exception(type(e), e, e.__traceback__, file=stderr)
+                self.player_events.stop()
+                if not element.skipped:
+                    element.skipped = True
+                    element.active = False
+                    element.record("skipped")
+                    if not element.path.done():
+                        element.cancel_download()
+                    element.free_resources()
+                    await element.set_message("An error occured during playback", skippable=False)
+            self.current = None
+            # Its remaining time no longer counts against queue_max_minutes
+            self._space_freed.set()
 
-                if is_quiet_hours():
-                    await self.skip_all("@GoToBedFroshDitchDayIsTomorrow (quiet hours)")
-                    continue
+    async def _play_element(self, element: AudioQueueElement) -> None:
+        element.on_skip = self._wake_player
+        self._advance_horizon()
+        streaming: bool = element.streamable and not element.path.done()
+        rendering: bool = False
+        path: Path | None = None
+        if streaming:
+            element.vlc_settings = VLCModificationSettings(abs(element.processing.tempo_scale))
+        else:
+            if element.progressive and not element.path.done():
+                # Start on the partial render once enough of it has been buffered
+                path = await element.early_path
+                rendering = path is not None and not element.path.done()
+            if path is None:
+                path = await self._await_path(element)
+            if path is None:
+                return
+        # Playing the draft, to be swapped for the full render as soon as it's ready
+        refining: bool = rendering and path == element.draft_path
+        resume_time: int = element.start_position
+        played_time: int = 0
 
-                while not element.skipped:
-                    media: Media = self.instance.media_new_path(path)
-                    self.player.set_media(media)
+        if is_quiet_hours():
+            await self.skip_all("@GoToBedFroshDitchDayIsTomorrow (quiet hours)")
+            return
 
+        while not element.skipped:
+            if self._crossfaded_into is element:
+                self._crossfaded_into = None
+            else:
+                if self._staged is element:
+                    self._swap_players()
+                else:
+                    if streaming:
+                        media: Media = self._stream_media(element)
+                    elif element.uses_effects_pipeline:
+                        try:
+                            media = self._effects_media(element, path, resume_time)
+                            resume_time = 0
+                        except (ImportError, OSError) as e:
+                            element.effects = None
+                            print(f"Couldn't start the effects pipeline, rendering offline instead: {e!r}", file=stderr)
+                            path = await element.render_offline(path)
+                            media = self.instance.media_new_path(path)
+                    else:
+                        media = self.instance.media_new_path(path)
+                    if resume_time:
+                        media.add_option(f":start-time={resume_time / 1000}")
+                        resume_time = 0
+                    AudioQueue._add_pitch_options(media, element.vlc_settings)
+                    self.player.set_media(media)
                     self.player.set_rate(element.vlc_settings.tempo_scale)
+                self._staged = None
+                self.player_events.play()
+            element.active = True
+            self._stage_next()
 
-                    await element.set_message("Playing")
+            await element.set_message("Playing")
 
-                    self.player.play()
-                    element.active = True
+            while not self.player_events.finished and not element.skipped and not is_quiet_hours() and \
+                    not self._crossfade_due(element) and not element.reopen and \
+                    not (refining and element.path.done()):
+                if rendering:
+                    played_time = max(played_time, self.player.get_time())
+                if element.journal is not None and self.player.get_time() > 0:
+                    element.record("position", position=self._playback_time(element))
+                await self.player_events.wait(self._next_wakeup(element, self._poll_interval(element, rendering)))
 
-                    while self.player.get_state() not in (VLCState.Ended, VLCState.Stopped) and \
-                            not element.skipped and not is_quiet_hours():
-                        # TODO: Wait for the duration or skip or quiet hours (whichever first)
-                        await sleep(Settings.async_sleep_refresh_rate)
+            if is_quiet_hours():
+                await self.skip_all("@GoToBedFroshDitchDayIsTomorrow (quiet hours)")
+
+            if streaming and not element.skipped and self.player_events.state == VLCState.Error:
+                print("Stream playback failed, falling back to the downloaded file", file=stderr)
+                resume_time = max(self.player.get_time(), 0)
+                streaming = False
+                path = await self._await_path(element)
+                if path is None:
+                    break
+                continue
 
-                    if is_quiet_hours():
-                        await self.skip_all("@GoToBedFroshDitchDayIsTomorrow (quiet hours)")
+            if refining and not element.skipped and not self.player_events.finished and element.path.done():
+                rendering = refining = False
+                path = await self._await_path(element)
+                if path is None:
+                    break
+                if self._crossfade_task is None:
+                    self._start_refinement(element, path)
+                else:
+                    # The standby player is still fading out the previous song, so reopen in place instead
+                    resume_time = max(self.player.get_time(), 0)
+                continue
 
-                    if self.player.get_state() not in (VLCState.Ended, VLCState.Stopped):
-                        self.player.stop()
+            if rendering and not element.skipped and self.player_events.finished:
+                # VLC only sees the part of the growing file that existed when it was opened
+                rendering = False
+                path = await self._await_path(element)
+                if path is None:
+                    break
+                if played_time < (element.duration.total_seconds() * element.vlc_settings.tempo_scale - 1) * 1000:
+                    print("Playback caught up with the streaming render, resuming from the finished file",
+                          file=stderr)
+                    resume_time = played_time
+                    continue
 
-                    if not element.processing.loop:
+            if element.reopen and not element.skipped:
+                # An effect was toggled on, so the song continues through the effects pipeline
+                element.reopen = False
+                resume_time = self._playback_time(element)
+                if streaming:
+                    # The pipeline decodes the downloaded file, which toggle_effect made sure is there
+                    streaming = False
+                    path = await self._await_path(element)
+                    if path is None:
                         break
+                continue
+
+            if not self.player_events.finished and not element.skipped and self._crossfade_due(element):
+                self._start_crossfade()
+                break
+
+            self._mark_silence_start()
+            self.player_events.stop()
+
+            if not element.processing.loop:
+                break
+
+        if element.skipped:
+            self.player_events.stop()
+
+        # TODO: release() media if needed
+        await element.finish()
+
+    async def _await_path(self, element: AudioQueueElement) -> Path | None:
+        try:
+            path: Path | None = await element.path
+        except Exception as e:
+            element.skipped = True
+            element.active = False
+            element.record("skipped")
+            element.free_resources()
+            await element.set_message(f"An error occured during download", skippable=False)
+            print("Caught exception during audio download")
+            traceback.print_exception(type(e), e, e.__traceback__, file=stderr)
+            return None
+        if path is None:
+            assert element.skipped
+        return path
+
+    def _stream_media(self, element: AudioQueueElement) -> Media:
+        media: Media = self.instance.media_new(element.audio_source.stream_url)
+        media.add_option(f":network-caching={Settings.stream_network_caching}")
+        for header, value in element.audio_source.stream_headers.items():
+            match header.lower():
+                case "user-agent":
+                    media.add_option(f":http-user-agent={value}")
+                case "referer":
+                    media.add_option(f":http-referrer={value}")
+        return media
+
+    def _effects_media(self, element: AudioQueueElement, path: Path, start_time: int) -> Media:
+        from audio_processing.realtime import RealtimeEffects
+
+        if element.effects is not None:
+            element.effects.close()
+        # VLC can't seek in the FIFO, so the pipeline starts decoding where playback should
+        element.effects = RealtimeEffects(path, element.resource.path / "effects.pcm", element.processing,
+                                          start_time / 1000)
+        media: Media = self.instance.media_new_path(str(element.effects.fifo_path))
+        for option in RealtimeEffects.media_options():
+            media.add_option(option)
+        return media
+
+    @staticmethod
+    def _add_pitch_options(media: Media, vlc_settings: VLCModificationSettings) -> None:
+        if vlc_settings.pitch_shift:
+            media.add_option(":audio-filter=scaletempo_pitch")
+            media.add_option(f":pitch-shift={vlc_settings.pitch_shift}")
+
+    def _playback_time(self, element: AudioQueueElement) -> int:
+        offset: int = round(element.effects.start * 1000) if element.effects is not None else 0
+        return max(self.player.get_time(), 0) + offset
+
+    def _swap_players(self) -> None:
+        self.player, self.standby_player = self.standby_player, self.player
+        self.player_events, self.standby_player_events = self.standby_player_events, self.player_events
+
+    def _stage_next(self) -> None:
+        if self.current is None or not self.current.active or self._crossfade_task is not None:
+            return
+        if self._staged is not None and not self._staged.skipped:
+            return
+        self._staged = None
+        upcoming: AudioQueueElement | None = self.queue.peek() if self.queue else None
+        if upcoming is None or not upcoming.path.done() or upcoming.path.cancelled() or \
+                upcoming.path.exception() is not None or upcoming.path.result() is None:
+            return
+        if upcoming.uses_effects_pipeline:
+            # Its pipeline only starts when it plays, and a raw PCM stream has no length to crossfade by anyway
+            return
+        media: Media = self.instance.media_new_path(upcoming.path.result())
+        AudioQueue._add_pitch_options(media, upcoming.vlc_settings)
+        media.parse_with_options(MediaParseFlag.local, -1)
+        self.standby_player.set_media(media)
+        self.standby_player.set_rate(upcoming.vlc_settings.tempo_scale)
+        self._staged = upcoming
+        if Settings.crossfade_duration > 0:
+            self.player_events.wake()
+
+    def _seconds_until_crossfade(self, element: AudioQueueElement) -> float | None:
+        if Settings.crossfade_duration <= 0 or element.processing.loop or self._staged is None or \
+                self._staged.skipped or (element.progressive and not element.path.done()):
+            return None
+        length: int = self.player.get_length()
+        if length <= 0:
+            return None
+        remaining: float = (length - self.player.get_time()) / 1000 / element.vlc_settings.tempo_scale
+        return remaining - Settings.crossfade_duration
+
+    def _crossfade_due(self, element: AudioQueueElement) -> bool:
+        seconds_until_crossfade: float | None = self._seconds_until_crossfade(element)
+        return seconds_until_crossfade is not None and seconds_until_crossfade <= 0
+
+    def _next_wakeup(self, element: AudioQueueElement, poll: float | None = None) -> float | None:
+        return min(
+            (
+                timeout for timeout in (seconds_until_quiet_hours(), self._seconds_until_crossfade(element), poll)
+                if timeout is not None
+            ),
+            default=None
+        )
+
+    @staticmethod
+    def _poll_interval(element: AudioQueueElement, rendering: bool) -> float | None:
+        return min(
+            (
+                interval for interval, enabled in (
+                    (Settings.async_sleep_refresh_rate, rendering),
+                    (Settings.queue_journal_position_interval, element.journal is not None)
+                )
+                if enabled
+            ),
+            default=None
+        )
 
-                if element.skipped and self.player.get_state() not in (VLCState.Ended, VLCState.Stopped):
-                    self.player.stop()
+    def _start_crossfade(self, duration: float | None = None, line_up: bool = False) -> None:
+        fading_player: MediaPlayer = self.player
+        fading_player_events: PlayerEvents = self.player_events
+        self._crossfaded_into = self._staged
+        self._staged = None
+        self._swap_players()
+        self.player.audio_set_volume(0)
+        self.player_events.play()
+        self._crossfade_task = get_event_loop().create_task(self._crossfade(
+            fading_player, fading_player_events, duration if duration is not None else Settings.crossfade_duration,
+            line_up
+        ))
 
-                # TODO: release() media if needed
-                await element.finish()
-                self.current = None
+    async def _crossfade(self, fading_player: MediaPlayer, fading_player_events: PlayerEvents, duration: float,
+                         line_up: bool = False) -> None:
+        steps: int = max(1, round(duration / Settings.crossfade_step_duration))
+        try:
+            if line_up:
+                # The new player takes a moment to open its file; once it's playing (still silently), it jumps to
+                # wherever the old one has got to, so that the two are in step for the fade
+                while self.player_events.state != VLCState.Playing and not self.player_events.finished:
+                    await sleep(Settings.crossfade_step_duration)
+                if not self.player_events.finished:
+                    self.player.set_time(max(fading_player.get_time(), 0))
+            for step in range(1, steps + 1):
+                await sleep(duration / steps)
+                fading_player.audio_set_volume(round(self._absolute_volume * (steps - step) / steps))
+                self.player.audio_set_volume(round(self._absolute_volume * step / steps))
+        finally:
+            fading_player_events.stop()
+            fading_player.audio_set_volume(self._absolute_volume)
+            self.player.audio_set_volume(self._absolute_volume)
+            self._crossfade_task = None
+            self._stage_next()
+
+    def _start_refinement(self, element: AudioQueueElement, path: Path) -> None:
+        """
+        Switches from the draft to the full render without a gap: the full render is pre-rolled on the standby player
+        from the draft's position, and crossfaded in once it's playing in step with the draft.
+        """
+        media: Media = self.instance.media_new_path(path)
+        media.add_option(f":start-time={max(self.player.get_time(), 0) / 1000}")
+        AudioQueue._add_pitch_options(media, element.vlc_settings)
+        self.standby_player.set_media(media)
+        self.standby_player.set_rate(element.vlc_settings.tempo_scale)
+        # Takes the place of whichever song was staged next, which is staged again once the switch is done
+        self._staged = element
+        self._start_crossfade(Settings.draft_switch_crossfade_duration, line_up=True)
+
+    def _mark_silence_start(self) -> None:
+        if not self.queue:
+            self._silence_start = None
+        elif self.player_events.state == VLCState.Ended:
+            self._silence_start = self.player_events.state_time
+        else:
+            self._silence_start = monotonic()
+
+    def _on_player_state(self, player_events: PlayerEvents, state: VLCState, time: float) -> None:
+        if state != VLCState.Playing or player_events is not self.player_events:
+            return
+        element: AudioQueueElement | None = self._crossfaded_into if self._crossfaded_into is not None else self.current
+        if element is not None and element.started_at is None:
+            element.started_at = time
+            metrics.time_to_first_sound_seconds.observe(time - element.enqueued_at)
+        if self._silence_start is None:
+            return
+        gap: float = time - self._silence_start
+        self._silence_start = None
+        self.track_gaps.append(gap)
+        for listener in self.gap_listeners:
+            listener(gap)
 
     async def skip(self, username: str) -> bool:
         if self.current is None:
             return False
         await self.current.skip(username)
+        self._advance_horizon()
         return True
 
     async def skip_all(self, username: str) -> bool:
         if self.state == AudioQueue.State.EMPTY:
             return False
+        if self._crossfaded_into is not None:
+            # Already fading in on the other player, which skip_specific would stop too
+            self._crossfaded_into = None
+            self.player_events.stop()
         async with TaskGroup() as skip_tasks:
-            for element in self.queue.reverse_destructive_iter:
+            self.fair_share.clear()
+            for element in reversed(self.queue.clear()):
                 skip_tasks.create_task(element.skip(username))
-            skip_tasks.create_task(self.current.skip(username))
+            self._space_freed.set()
+            if self.current is not None:
+                skip_tasks.create_task(self.current.skip(username))
+        return True
 
     async def skip_specific(self, username: str, element_id: int) -> bool:
         if self.current is not None and self.current.element_id == element_id:
             return await self.skip(username)
-        for element in self.queue:
-            if element.element_id == element_id:
-                await element.skip(username)
-                return True
-        return False
+        if element_id not in self.queue:
+            return False
+        element: AudioQueueElement = self.queue.remove(element_id)
+        self.fair_share.release(element_id)
+        self._space_freed.set()
+        if self._crossfaded_into is element:
+            self._crossfaded_into = None
+            self.player_events.stop()
+        await element.skip(username)
+        self.scheduler.reprioritise()
+        self._advance_horizon()
+        return True
+
+    def get(self, element_id: int) -> AudioQueueElement | None:
+        if self.current is not None and self.current.element_id == element_id:
+            return self.current
+        return self.queue.get(element_id)
+
+    def position_of(self, element: AudioQueueElement) -> float:
+        if element is self.current:
+            return -1
+        if element.element_id not in self.queue:
+            return inf
+        return self.queue.position(element.element_id)
+
+    @staticmethod
+    def _queue_weight(element: AudioQueueElement) -> float:
+        # A song of unknown length counts for nothing in the ETAs, rather than making all of them unknown
+        seconds: float = element.duration.total_seconds()
+        return 0 if isnan(seconds) else seconds
+
+    def admission_refusal(self, requester_id: int | None, duration: Duration) -> str | None:
+        """The reason a song of the given duration can't be queued for this requester right now, if any."""
+        if Settings.queue_max_length is not None and len(self.queue) >= Settings.queue_max_length:
+            return f"the queue already has {len(self.queue)} songs"
+        if Settings.queue_max_songs_per_user is not None and \
+                self.fair_share.queued_count(requester_id) >= Settings.queue_max_songs_per_user:
+            return f"you already have {self.fair_share.queued_count(requester_id)} songs queued"
+        if Settings.queue_max_minutes is not None:
+            seconds: float = duration.total_seconds()
+            # A song of unknown length only has to fit the queue as it is, while a live stream never fits
+            if self.remaining_time().total_seconds() + (0 if isnan(seconds) else seconds) > \
+                    Settings.queue_max_minutes * 60:
+                return f"the queue is limited to {Duration.from_seconds(Settings.queue_max_minutes * 60).approximate}"
+        return None
+
+    def current_remaining_time(self) -> Duration:
+        if self.current is None or self.current.skipped or not self.current.active or \
+                isnan(self.current.duration.total_seconds()):
+            # A song of unknown length counts for nothing, as it does in the queue's weights
+            return Duration.zero()
+        elapsed: Duration = Duration.from_timedelta(
+            timedelta(milliseconds=self._playback_time(self.current))
+        ) / self.current.vlc_settings.tempo_scale
+        return self.current.duration - elapsed
+
+    def remaining_time(self) -> Duration:
+        return self.current_remaining_time() + Duration.from_seconds(self.queue.total_weight())
+
+    def expected_start(self, element: AudioQueueElement) -> Duration:
+        if element is self.current:
+            return Duration.zero()
+        if element.element_id not in self.queue:
+            return Duration.NAN
+        return self.current_remaining_time() + Duration.from_seconds(self.queue.prefix_weight(element.element_id))
+
+    def _wake_player(self) -> None:
+        self.player_events.wake()
+
+    async def toggle_effect(self, effect: str) -> bool:
+        """Turns echo, metal or reverb on or off for the song that is playing, with nothing to render."""
+        element: AudioQueueElement | None = self.current
+        if element is None or element.skipped or not element.active or not Settings.realtime_effects or \
+                not realtime_effects_available() or \
+                element.route == ProcessingRoute.OFFLINE or not element.processing.supports_realtime_effects or \
+                not element.path.done() or element.path.cancelled() or element.path.exception() is not None or \
+                element.path.result() is None:
+            return False
+        element.processing = replace(element.processing, **{effect: not getattr(element.processing, effect)})
+        if element.processing.requires_rendering:
+            element.route = ProcessingRoute.REALTIME
+        if element.effects is not None:
+            element.effects.set_effects(element.processing)
+        elif element.uses_effects_pipeline:
+            element.reopen = True
+            self._wake_player()
+        return True
 
     async def pause(self) -> None:
         self.player.set_pause(True)
@@ -289,22 +1105,28 @@ class AudioQueue(Iterable[AudioQueueElement]):
     async def set_digital_volume(self, volume: float) -> bool:
         absolute_volume: float = volume * Settings.hundred_percent_volume_value
         if 0 <= absolute_volume <= Settings.max_absolute_volume * 100:
-            return self.player.audio_set_volume(round(absolute_volume)) + 1
+            return self._set_absolute_volume(round(absolute_volume))
         else:
             return False
 
     async def set_clamped_digital_volume(self, volume: float) -> bool:
         absolute_volume: float = volume * Settings.hundred_percent_volume_value
         absolute_volume = min(max(absolute_volume, 0), Settings.max_absolute_volume * 100)
-        return self.player.audio_set_volume(round(absolute_volume)) + 1
+        return self._set_absolute_volume(round(absolute_volume))
+
+    def _set_absolute_volume(self, absolute_volume: int) -> bool:
+        self._absolute_volume = absolute_volume
+        result: int = self.player.audio_set_volume(absolute_volume)
+        if self._crossfade_task is None:
+            result |= self.standby_player.audio_set_volume(absolute_volume)
+        return result + 1
 
     async def get_digital_volume(self) -> float:
-        scaled_volume = self.player.audio_get_volume()
-        return scaled_volume / Settings.hundred_percent_volume_value
+        return self._absolute_volume / Settings.hundred_percent_volume_value
 
     @property
     def state(self) -> State:
-        match (self.player.get_state(), bool(self.queue), self.current is not None and not self.current.skipped):
+        match (self.player_events.state, bool(self.queue), self.current is not None and not self.current.skipped):
             case (VLCState.Playing, _, True):
                 return AudioQueue.State.PLAYING
             case (VLCState.Paused, _, True):
@@ -321,7 +1143,7 @@ class AudioQueue(Iterable[AudioQueueElement]):
                 return AudioQueue.State.LOADING
             case (player_state, queue_nonempty, current_set):
                 print(f"Unknown audio queue state error:\n"
-                      f"\tself.player.get_state(): {player_state}\n"
+                      f"\tself.player_events.state: {player_state}\n"
                       f"\tbool(self.queue): {queue_nonempty}\n"
                       f"\tself.current is not None: {current_set}"
                       f"\tself.queue: {self.queue}"
@@ -329,9 +1151,11 @@ class AudioQueue(Iterable[AudioQueueElement]):
                       f"\tself.current.skipped: {self.current.skipped}")
                 return AudioQueue.State.UNKNOWN_ERROR
 
-    def get_id(self) -> int:
-        out: int = self._next_id
-        self._next_id += 1
+    @staticmethod
+    def get_id() -> int:
+        # Shared by every zone, so element ids (and skip buttons) are unique across the whole process
+        out: int = AudioQueue._next_id
+        AudioQueue._next_id += 1
         return out
 
     def __iter__(self):
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
+from asyncio import to_thread
+from collections.abc import AsyncIterator
 from datetime import timedelta
 from pathlib import Path
+from typing import Any
+from urllib.request import Request, urlopen
 
 from duration import Duration
 from resource_handler import ResourceHandler
@@ -27,3 +31,26 @@ class AudioSource(ABC):
     @property
     @abstractmethod
     def url(self) -> str | None: ...
+
+    def serialise(self) -> dict[str, Any] | None:
+        return None
+
+    @property
+    def cache_key(self) -> str | None:
+        return None
+
+    @property
+    def stream_url(self) -> str | None:
+        return None
+
+    @property
+    def stream_headers(self) -> dict[str, str]:
+        return {}
+
+    async def stream(self, chunk_size: int) -> AsyncIterator[bytes]:
+        response = await to_thread(urlopen, Request(self.stream_url, headers=self.stream_headers))
+        try:
+            while chunk := await to_thread(response.read, chunk_size):
+                yield chunk
+        finally:
+            response.close()
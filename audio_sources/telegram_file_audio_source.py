@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from datetime import timedelta
 from pathlib import Path
+from typing import Any
 
 from telegram import Audio, File
 
@@ -18,6 +19,13 @@ class TelegramAudioSource(AudioSource):
         self.output_path = None
         self.telegram_audio = telegram_audio
 
+    def serialise(self) -> dict[str, Any]:
+        return {"type": "telegram", "audio": self.telegram_audio.to_dict()}
+
+    @property
+    def cache_key(self) -> str:
+        return f"telegram:{self.telegram_audio.file_unique_id}"
+
     async def download(self, resource: ResourceHandler.Resource) -> Path:
         file: File = await self.telegram_audio.get_file()
         default_path: Path = Path(file.file_path)
@@ -35,6 +43,8 @@ class TelegramAudioSource(AudioSource):
 
     @property
     def duration(self) -> Duration:
+        if self.telegram_audio.duration is None:
+            return Duration.NAN
         return Duration.from_timedelta(timedelta(seconds=self.telegram_audio.duration))
 
     @property
@@ -47,7 +47,11 @@ class YtDLPAudioSource(AudioSource):
 
     def __init__(self, query: Query):
         self.output_path = Future()
+        self.metadata = YtDLPAudioSource.extract_metadata(query)
 
+    @staticmethod
+    def extract_metadata(query: Query) -> dict[str, Any]:
+        """Blocking, but touches no asyncio state, so it can run in a worker thread."""
         ydl_opts = {
             # "extract_flat": "in_playlist",
             # "noprogress": True
@@ -56,10 +60,26 @@ class YtDLPAudioSource(AudioSource):
         with YoutubeDL(ydl_opts) as ydl:
             match query:
                 case Query.URL(url):
-                    self.metadata = ydl.extract_info(url, download=False)
+                    return ydl.extract_info(url, download=False)
                 case Query.YTSearch(search_query):
                     # TODO: Complain if nothing is found (extract_info()["entries"] is empty)
-                    self.metadata = ydl.extract_info(f"ytsearch:{search_query}", download=False)["entries"][0]
+                    return ydl.extract_info(f"ytsearch:{search_query}", download=False)["entries"][0]
+
+    @staticmethod
+    def from_metadata(metadata: dict[str, Any]) -> YtDLPAudioSource:
+        audio_source: YtDLPAudioSource = YtDLPAudioSource.__new__(YtDLPAudioSource)
+        audio_source.output_path = Future()
+        audio_source.metadata = metadata
+        return audio_source
+
+    def serialise(self) -> dict[str, Any]:
+        return {"type": "yt_dlp", "metadata": YoutubeDL.sanitize_info(self.metadata)}
+
+    @property
+    def cache_key(self) -> str | None:
+        if "id" not in self.metadata:
+            return None
+        return f"yt_dlp:{self.metadata.get('extractor_key', '')}:{self.metadata['id']}"
 
     async def download(self, resource: ResourceHandler.Resource) -> Path:
         # download_queue: AsyncQueue =
@@ -134,7 +154,33 @@ class YtDLPAudioSource(AudioSource):
 
     @property
     def duration(self) -> Duration:
-        return Duration.from_timedelta(timedelta(seconds=self.metadata["duration"]))
+        seconds: float | None = self.metadata.get("duration")
+        if seconds is None:
+            # Live streams have no end, and some extractors just don't know
+            return Duration.Infinite if self.metadata.get("is_live") else Duration.NAN
+        return Duration.from_timedelta(timedelta(seconds=seconds))
+
+    @property
+    def stream_format(self) -> dict[str, Any] | None:
+        return max(
+            (
+                audio_format for audio_format in self.metadata.get("formats", [])
+                if audio_format.get("url") and audio_format.get("protocol") in ("http", "https") and
+                audio_format.get("acodec", "none") != "none" and audio_format.get("vcodec", "none") == "none"
+            ),
+            key=lambda audio_format: audio_format.get("abr") or 0,
+            default=None
+        )
+
+    @property
+    def stream_url(self) -> str | None:
+        stream_format: dict[str, Any] | None = self.stream_format
+        return stream_format["url"] if stream_format is not None else None
+
+    @property
+    def stream_headers(self) -> dict[str, str]:
+        stream_format: dict[str, Any] | None = self.stream_format
+        return stream_format.get("http_headers", {}) if stream_format is not None else {}
 
     @property
     def url(self) -> str:
@@ -0,0 +1,86 @@
+"""
+Compares AsyncQueue against the previous Maybe-based implementation (frozen in benchmarks/legacy_async_queue.py).
+
+Run from the repository root with: python -m benchmarks.async_queue_benchmark
+"""
+
+from asyncio import run
+from collections.abc import Callable, Coroutine
+from time import perf_counter
+from typing import Any
+
+from async_queue import AsyncQueue
+from benchmarks.legacy_async_queue import AsyncQueue as LegacyAsyncQueue
+
+SIZES: tuple[int, ...] = (10, 1_000, 100_000)
+LEN_CALLS: int = 100
+
+
+async def fill(queue_type: type, size: int):
+    queue = queue_type()
+    for i in range(size):
+        await queue.append(i)
+    return queue
+
+
+async def bench_append(queue_type: type, size: int) -> float:
+    start: float = perf_counter()
+    await fill(queue_type, size)
+    return (perf_counter() - start) / size
+
+
+async def bench_popleft(queue_type: type, size: int) -> float:
+    queue = await fill(queue_type, size)
+    start: float = perf_counter()
+    for _ in range(size):
+        await queue.popleft()
+    return (perf_counter() - start) / size
+
+
+async def bench_len(queue_type: type, size: int) -> float:
+    queue = await fill(queue_type, size)
+    start: float = perf_counter()
+    for _ in range(LEN_CALLS):
+        len(queue)
+    return (perf_counter() - start) / LEN_CALLS
+
+
+async def bench_iter(queue_type: type, size: int) -> float:
+    queue = await fill(queue_type, size)
+    start: float = perf_counter()
+    for _ in queue:
+        pass
+    return (perf_counter() - start) / size
+
+
+async def bench_async_iter(queue_type: type, size: int) -> float:
+    # Consumes exactly size elements rather than draining to a close: the legacy iterator spins forever once only its
+    # in-band Maybe.Nothing is left, because the queue is then falsy while its non-empty event stays set
+    queue = await fill(queue_type, size)
+    start: float = perf_counter()
+    async with queue.async_iter() as iterator:
+        for _ in range(size):
+            await anext(iterator)
+    return (perf_counter() - start) / size
+
+
+BENCHMARKS: dict[str, Callable[[type, int], Coroutine[Any, Any, float]]] = {
+    "append": bench_append,
+    "popleft": bench_popleft,
+    "len": bench_len,
+    "iter": bench_iter,
+    "async_iter": bench_async_iter,
+}
+
+
+async def main() -> None:
+    print(f"{'operation':<12}{'size':>9}{'legacy (µs/op)':>17}{'new (µs/op)':>14}{'speed-up':>11}")
+    for name, benchmark in BENCHMARKS.items():
+        for size in SIZES:
+            legacy: float = await benchmark(LegacyAsyncQueue, size)
+            new: float = await benchmark(AsyncQueue, size)
+            print(f"{name:<12}{size:>9}{legacy * 1e6:>17.3f}{new * 1e6:>14.3f}{legacy / new:>10.1f}x")
+
+
+if __name__ == "__main__":
+    run(main())
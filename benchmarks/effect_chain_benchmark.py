@@ -0,0 +1,58 @@
+"""
+Compares the compiled effect chain (audio_processing.effect_chain) against the previous filter-per-effect chain (frozen
+in benchmarks/legacy_effects.py), reporting ffmpeg's CPU seconds per minute of audio. Output is discarded with the null
+muxer, so only decoding and filtering are measured.
+
+Run from the repository root with: python -m benchmarks.effect_chain_benchmark path/to/track.m4a [repeats]
+"""
+
+import resource
+import sys
+from collections.abc import Callable
+from pathlib import Path
+
+import ffmpeg
+from ffmpeg import Stream
+
+import audio_processing.ffmpeg
+import benchmarks.legacy_effects
+from audio_processing import AudioProcessingSettings, VLCModificationSettings
+
+CASES: dict[str, AudioProcessingSettings] = {
+    "echo": AudioProcessingSettings(echo=True),
+    "metal": AudioProcessingSettings(metal=True),
+    "reverb": AudioProcessingSettings(reverb=True),
+    "echo+metal+reverb": AudioProcessingSettings(echo=True, metal=True, reverb=True),
+    "nightcore": AudioProcessingSettings(pitch_shift=5.12, tempo_scale=1.35),
+    "pitch+reverb": AudioProcessingSettings(pitch_shift=-3, reverb=True),
+}
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(apply_filters: Callable[[Stream, AudioProcessingSettings, VLCModificationSettings, int], Stream],
+            source_path: Path, settings: AudioProcessingSettings, sample_rate: int, repeats: int) -> float:
+    stream: Stream = apply_filters(ffmpeg.input(str(source_path)), settings, VLCModificationSettings(), sample_rate)
+    start: float = children_cpu_seconds()
+    for _ in range(repeats):
+        stream.output("-", format="null").run(quiet=True)
+    return (children_cpu_seconds() - start) / repeats
+
+
+def main(source_path: Path, repeats: int) -> None:
+    sample_rate, _ = audio_processing.ffmpeg.probe_audio(source_path)
+    minutes: float = float(ffmpeg.probe(str(source_path))["format"]["duration"]) / 60
+    print(f"rubberband: {'rubberband' in audio_processing.ffmpeg.available_filters()}, "
+          f"afir options: {audio_processing.ffmpeg.afir_options()}")
+    print(f"{'case':<20}{'legacy cpu/min':>16}{'compiled cpu/min':>18}{'speedup':>9}")
+    for name, settings in CASES.items():
+        legacy: float = measure(benchmarks.legacy_effects.apply_filters, source_path, settings, sample_rate, repeats)
+        compiled: float = measure(audio_processing.ffmpeg.apply_filters, source_path, settings, sample_rate, repeats)
+        print(f"{name:<20}{legacy / minutes:>15.2f}s{compiled / minutes:>17.2f}s{legacy / compiled:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main(Path(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 3)
@@ -0,0 +1,81 @@
+"""
+Compares the single-pass processing plan against the previous chain, which wrote the syncopated audio to a WAV file for
+ffmpeg to decode again, and re-encoded tempo-only changes that VLC applies at playback anyway. Reports wall time and CPU
+seconds (this process and its ffmpeg/rubberband children) per track.
+
+Run from the repository root with: python -m benchmarks.processing_benchmark path/to/track.m4a [repeats]
+"""
+
+import resource
+import sys
+from asyncio import run
+from collections.abc import Callable, Coroutine
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any
+
+import audio_processing.ffmpeg
+import audio_processing.syncopation
+from audio_processing import AudioProcessingSettings, SyncopationSettings, VLCModificationSettings, process_audio
+
+CASES: dict[str, AudioProcessingSettings] = {
+    "tempo": AudioProcessingSettings(tempo_scale=1.25),
+    "nightcore": AudioProcessingSettings(pitch_shift=5.12, tempo_scale=1.35),
+    "reverb": AudioProcessingSettings(reverb=True),
+    "syncopation": AudioProcessingSettings(syncopation=SyncopationSettings()),
+    "syncopation+echo": AudioProcessingSettings(echo=True, syncopation=SyncopationSettings()),
+}
+
+
+async def legacy_chain(source_path: Path, dest_path: Path, settings: AudioProcessingSettings) -> None:
+    vlc_settings: VLCModificationSettings = VLCModificationSettings()
+    if settings.requires_syncopation_processing:
+        syncopated_path: Path = dest_path.with_name("syncopated.wav") if settings.requires_ffmpeg_processing else \
+            dest_path
+        native_rate, channels = audio_processing.ffmpeg.probe_audio(source_path)
+        wav_args: list[str] = audio_processing.ffmpeg.pcm_encoder_args(
+            syncopated_path, AudioProcessingSettings(), VLCModificationSettings(), native_rate, min(channels, 2)
+        )
+        audio_processing.syncopation.render(source_path, syncopated_path, settings, wav_args, native_rate,
+                                            min(channels, 2))
+        source_path = syncopated_path
+    if settings.requires_ffmpeg_processing:
+        await audio_processing.ffmpeg.process_audio(source_path, dest_path, settings, vlc_settings)
+
+
+async def fused(source_path: Path, dest_path: Path, settings: AudioProcessingSettings) -> None:
+    await process_audio(source_path, dest_path, settings)
+
+
+def cpu_seconds() -> float:
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    )
+
+
+async def measure(chain: Callable[[Path, Path, AudioProcessingSettings], Coroutine[Any, Any, None]],
+                  source_path: Path, settings: AudioProcessingSettings, repeats: int) -> tuple[float, float]:
+    wall: float = 0
+    cpu: float = 0
+    for _ in range(repeats):
+        with TemporaryDirectory() as directory:
+            start_wall: float = perf_counter()
+            start_cpu: float = cpu_seconds()
+            await chain(source_path, Path(directory) / "processed.mp3", settings)
+            wall += perf_counter() - start_wall
+            cpu += cpu_seconds() - start_cpu
+    return wall / repeats, cpu / repeats
+
+
+async def main(source_path: Path, repeats: int) -> None:
+    print(f"{'case':<18}{'legacy wall':>13}{'fused wall':>12}{'legacy cpu':>12}{'fused cpu':>11}")
+    for name, settings in CASES.items():
+        legacy_wall, legacy_cpu = await measure(legacy_chain, source_path, settings, repeats)
+        fused_wall, fused_cpu = await measure(fused, source_path, settings, repeats)
+        print(f"{name:<18}{legacy_wall:>12.2f}s{fused_wall:>11.2f}s{legacy_cpu:>11.2f}s{fused_cpu:>10.2f}s")
+
+
+if __name__ == "__main__":
+    run(main(Path(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 3))
@@ -0,0 +1,47 @@
+"""
+Compares the speed of the vectorised time-map construction in audio_processing.syncopation against the previous
+pure-Python implementation (frozen in tests/test_syncopation.py, which checks that both produce the same time maps) at
+realistic beat counts.
+
+Run from the repository root with: python -m benchmarks.syncopation_benchmark
+"""
+
+import random
+from collections.abc import Callable
+from time import perf_counter
+
+from tests.test_syncopation import legacy_time_map, random_beats, vectorised_time_map
+
+# A 4-minute song and an hour-long mix at around 120 BPM
+BEAT_COUNTS: tuple[int, ...] = (480, 7_200)
+QUANTIZATION_SCALES: tuple[int, ...] = (1, 4, 16)
+REPEATS: int = 5
+
+
+def measure(time_map: Callable[..., list], *args) -> float:
+    start: float = perf_counter()
+    for _ in range(REPEATS):
+        time_map(*args)
+    return (perf_counter() - start) / REPEATS
+
+
+def main() -> None:
+    random.seed(0)
+    print(f"{'beats':>6}{'scale':>7}{'mode':>10}{'legacy':>12}{'vectorised':>12}{'speedup':>9}")
+    for beat_count in BEAT_COUNTS:
+        beats: list[float] = random_beats(beat_count)
+        num_samples: int = round(beats[-1]) + 44100
+        for quantization_scale in QUANTIZATION_SCALES:
+            for flexible in (False, True):
+                args = (beats, num_samples, quantization_scale, (2, 1), flexible)
+                legacy_seconds: float = measure(legacy_time_map, *args)
+                vectorised_seconds: float = measure(vectorised_time_map, *args)
+                print(
+                    f"{beat_count:>6}{quantization_scale:>7}{'flexible' if flexible else 'even':>10}"
+                    f"{legacy_seconds * 1000:>10.2f}ms{vectorised_seconds * 1000:>10.2f}ms"
+                    f"{legacy_seconds / vectorised_seconds:>8.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
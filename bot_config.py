@@ -64,7 +64,7 @@ def guard_permissions(f, *_args, permissions: UserSelector | None = None,
 
 class BotConfig:
     def __init__(self, bot_token_path: str, persistence_file: str | None, resource_dir: str | None = None,
-                 default_permissions: UserSelector | None = None) -> None:
+                 default_permissions: UserSelector | None = None, preserve_resources: bool = False) -> None:
         logging.basicConfig(
             format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
         )
@@ -81,7 +81,7 @@ class BotConfig:
 
         self.resource_dir: None | str = resource_dir
         if resource_dir is not None:
-            self.resource_handler: ResourceHandler = ResourceHandler(resource_dir)
+            self.resource_handler: ResourceHandler = ResourceHandler(resource_dir, preserve_resources)
 
         self.default_permissions: UserSelector = \
             default_permissions if default_permissions is not None else UserSelector.Always
@@ -96,6 +96,7 @@ class BotConfig:
 
         self.handlers: list[BaseHandler] = []
         self.post_init_handler = None
+        self.post_shutdown_handler = None
 
         self._run_data = dict()
 
@@ -107,6 +108,10 @@ class BotConfig:
     def add_post_init_handler(self, f):
         self.post_init_handler = f
 
+    @method_decorator(map_first_arg_decorator(map_all_args_decorator(ApplicationHandlerContext)))
+    def add_post_shutdown_handler(self, f):
+        self.post_shutdown_handler = f
+
     @method_decorator(
         compose(
             arg_decorator,
@@ -157,6 +162,7 @@ class BotConfig:
         (builder
          .token(self.bot_token)
          .post_init(self.post_init_handler)
+         .post_shutdown(self.post_shutdown_handler)
          .arbitrary_callback_data(True))
         if self.persistence_file is not None:
             builder.persistence(PicklePersistence(filepath="store/further_persistence_store"))
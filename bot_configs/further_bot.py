@@ -1,18 +1,21 @@
 from __future__ import annotations
 
-from asyncio import Future
+from asyncio import Future, get_event_loop
 from datetime import timedelta, datetime
 from math import log
+from sys import stderr
+from time import monotonic
 from typing import cast
 
-from telegram import User, Message, CallbackQuery, ChatPermissions, Audio
+from telegram import User, Message, CallbackQuery, ChatPermissions, Audio, Bot
 from telegram.constants import ParseMode
 from telegram.ext import filters
 
 import debugging
+import metrics
 import opinions
-from audio_processing import AudioProcessingSettings
-from audio_queue import AudioQueue, AudioQueueElement
+from audio_processing import AudioProcessingSettings, VLCModificationSettings
+from audio_queue import AudioQueue, AudioQueueElement, QueueFull
 from audio_sources import AudioSource, yt_dlp_audio_source
 from audio_sources.telegram_file_audio_source import TelegramAudioSource
 from audio_sources.yt_dlp_audio_source import YtDLPAudioSource
@@ -21,6 +24,8 @@ from duration import Duration
 from handler_context import UpdateHandlerContext, ApplicationHandlerContext
 from message_edit_status_callback import format_add_video_status
 from message_edit_status_callback.standard import StandardMessageEditStatusCallback
+from queue_journal import QueueJournal, JournalEntry
+from queue_registry import QueueRegistry, zone_chat_ids
 from settings import Settings
 from tree_message import TreeMessage
 from user_selector import UserSelector, ChatTypeFlag, MembershipStatusFlag
@@ -30,20 +35,95 @@ BOT_TOKEN_FILE = Settings.further_bot_token_path
 bot_config = BotConfig(
     BOT_TOKEN_FILE,
     persistence_file="store/further_persistence_store",
-    resource_dir="downloads"
+    resource_dir="downloads",
+    preserve_resources=True
 )
 
 
 @bot_config.add_post_init_handler
 async def post_init(context: ApplicationHandlerContext):
     context.bot_data.defaults.digital_volume = 30.0
-    context.run_data.queue = AudioQueue()
-    await context.run_data.queue.set_clamped_digital_volume(context.bot_data.digital_volume)
+    context.bot_data.defaults.zone_digital_volumes = {}
+    journal: QueueJournal | None = QueueJournal(
+        Settings.queue_journal_path, Settings.queue_journal_compact_bytes
+    ) if Settings.queue_journal_path is not None else None
+    journal_entries: list[JournalEntry] = journal.replay() if journal is not None else []
+    context.run_data.queues = QueueRegistry(bot_config.resource_handler, journal)
+    for queue in context.run_data.queues:
+        await queue.set_clamped_digital_volume(
+            context.bot_data.zone_digital_volumes.get(queue.zone, context.bot_data.digital_volume)
+        )
+    for entry in journal_entries:
+        await restore_queue_element(context.run_data.queues.get(entry.zone), entry, context.application.bot)
+    bot_config.resource_handler.free_unused(
+        {entry.resource_path for entry in journal_entries if entry.resource_path is not None} |
+        {entry.downloaded_path.parent for entry in journal_entries if entry.downloaded_path is not None}
+    )
+
+    metrics.resource_directory_bytes.set_function(lambda: metrics.directory_size(bot_config.resource_dir))
+    if Settings.metrics_port is not None:
+        try:
+            await metrics.registry.serve(Settings.metrics_host, Settings.metrics_port)
+        except OSError as e:
+            print(f"Warning: couldn't serve metrics on port {Settings.metrics_port}: {e!r}", file=stderr)
+    if Settings.metrics_dump_path is not None:
+        get_event_loop().create_task(
+            metrics.registry.dump_periodically(Settings.metrics_dump_path, Settings.metrics_dump_interval)
+        )
 
     debugging.listen()
     await bot_config.start_connection_listener()
 
 
+@bot_config.add_post_shutdown_handler
+async def post_shutdown(context: ApplicationHandlerContext):
+    queues: QueueRegistry = context.run_data.queues
+    if queues.scheduler.process_pool is not None:
+        queues.scheduler.process_pool.shutdown()
+    if queues.journal is not None:
+        queues.journal.close()
+
+
+async def restore_queue_element(queue: AudioQueue, entry: JournalEntry, bot: Bot) -> None:
+    audio_source: AudioSource
+    match entry.source:
+        case {"type": "yt_dlp", "metadata": metadata}:
+            audio_source = YtDLPAudioSource.from_metadata(metadata)
+        case {"type": "telegram", "audio": audio}:
+            audio_source = TelegramAudioSource(Audio.de_json(audio, bot))
+        case _:
+            print(f"Warning: can't restore queue element {entry.element_id} from journal")
+            queue.journal.record("skipped", entry.element_id)
+            return
+    postprocessing: AudioProcessingSettings = AudioProcessingSettings.from_dict(entry.processing)
+    user: User = User.de_json(entry.status["user"], bot)
+    message_edit_status_callback = StandardMessageEditStatusCallback(
+        Message.de_json(entry.status["message"], bot),
+        audio_source,
+        user,
+        postprocessing
+    )
+    await queue.add(AudioQueueElement(
+        element_id=entry.element_id,
+        audio_source=audio_source,
+        processing=postprocessing,
+        message_setter=message_edit_status_callback,
+        path=Future(),
+        download_task=Future(),
+        vlc_settings=VLCModificationSettings(entry.tempo_scale) if entry.processed_path is not None else None,
+        journal=queue.journal,
+        resource_path=entry.resource_path,
+        downloaded_path=entry.downloaded_path,
+        ready_path=entry.processed_path,
+        start_position=entry.position,
+        requester_id=user.id
+    ))
+
+
+def zone_queue(context: UpdateHandlerContext) -> AudioQueue:
+    return context.run_data.queues.for_chat(context.chat.id)
+
+
 # def format_add_playlist_status(playlist: Playlist, user: User, postprocessing: AudioProcessingSettings,
 #                                status: str) -> TreeMessage:
 #     return TreeMessage.Sequence([
@@ -58,28 +138,20 @@ async def post_init(context: ApplicationHandlerContext):
 
 
 def format_get_queue(queue: AudioQueue) -> TreeMessage:
-    songs: list[AudioQueueElement] = [element for element in queue if not element.freed]
+    start_time: Duration = queue.current_remaining_time()
+    queued_songs: list[TreeMessage] = []
+    for element in queue:
+        queued_songs.append(TreeMessage.Sequence([
+            format_add_video_status(
+                element.audio_source, None, element.processing, f"Starts in {start_time.approximate}"
+            )
+        ]))
+        start_time += element.duration
     return TreeMessage.Sequence([
         TreeMessage.Sequence([
             TreeMessage.Named("State", TreeMessage.Text(str(queue.state))),
-            TreeMessage.Named("Songs", TreeMessage.Text(str(len(songs)))),
-            TreeMessage.Named(
-                "Remaining play time",
-                TreeMessage.Text(str(
-                    sum((element.duration for element in songs), start=Duration.zero()) + (
-                        (
-                                queue.current.duration -
-                                Duration.from_timedelta(
-                                    timedelta(milliseconds=queue.player.get_time())
-                                ) / queue.current.processing.tempo_scale
-                        )
-                        if queue.state in [AudioQueue.State.PLAYING, AudioQueue.State.PAUSED] else
-                        Duration.zero()
-
-                    )
-                )
-                )
-            )
+            TreeMessage.Named("Songs", TreeMessage.Text(str(len(queued_songs)))),
+            TreeMessage.Named("Remaining play time", TreeMessage.Text(str(queue.remaining_time())))
         ]),
         TreeMessage.Named(
             "Current",
@@ -89,12 +161,14 @@ def format_get_queue(queue: AudioQueue) -> TreeMessage:
         ),
         TreeMessage.Named(
             "Queue",
+            TreeMessage.Sequence(queued_songs) if queued_songs else TreeMessage.Text("&lt;Empty&gt;")
+        ),
+        TreeMessage.Named(
+            "Pipeline",
             TreeMessage.Sequence([
-                TreeMessage.Sequence([
-                    format_add_video_status(element.audio_source, None, element.processing, None)
-                ])
-                for element in queue if not element.skipped
-            ]) if queue.queue else TreeMessage.Text("&lt;Empty&gt;")
+                TreeMessage.Named(str(stage), TreeMessage.Text(f"{active} active, {waiting} waiting"))
+                for stage, (active, waiting) in queue.scheduler.queue_depths().items()
+            ])
         )
     ])
 
@@ -129,7 +203,7 @@ async def get_queue(context: UpdateHandlerContext):
     query_message: Message = context.message
     query_message_id: int = query_message.message_id
     await context.send_message(
-        str(format_get_queue(context.run_data.queue)),
+        str(format_get_queue(zone_queue(context))),
         parse_mode=ParseMode.HTML,
         reply_to_message_id=query_message_id)
 
@@ -228,7 +302,11 @@ async def parse_query(context: UpdateHandlerContext, query_message_id: int) -> \
     audio_source: AudioSource
 
     if query_audio is None:
-        audio_source = YtDLPAudioSource(yt_dlp_audio_source.Query.from_query_text(query_text))
+        audio_source = YtDLPAudioSource.from_metadata(await context.run_data.queues.resolve_metadata(
+            query_text,
+            YtDLPAudioSource.extract_metadata,
+            yt_dlp_audio_source.Query.from_query_text(query_text)
+        ))
     else:
         audio_source = TelegramAudioSource(query_audio)
 
@@ -236,28 +314,31 @@ async def parse_query(context: UpdateHandlerContext, query_message_id: int) -> \
 
 
 async def queue_video(context: UpdateHandlerContext, audio_source: AudioSource, user: User, query_message_id: int,
-                      postprocessing: AudioProcessingSettings):
+                      postprocessing: AudioProcessingSettings, enqueued_at: float):
     # TODO: Make audio_source a future so that the bot replies immediately/
     message: Message = await context.send_message(str(
         format_add_video_status(audio_source, user, postprocessing, "Searching")),
         parse_mode=ParseMode.HTML,
         reply_to_message_id=query_message_id
     )
-    download_resource = bot_config.resource_handler.claim()
-
     # TODO: Option for if it's part of a playlist
     message_edit_status_callback = StandardMessageEditStatusCallback(message, audio_source, user, postprocessing)
 
     queue_element: AudioQueueElement = AudioQueueElement(
-        element_id=context.run_data.queue.get_id(),
-        resource=download_resource,
+        element_id=AudioQueue.get_id(),
         audio_source=audio_source,
         processing=postprocessing,
         message_setter=message_edit_status_callback,
         path=Future(),
-        download_task=Future()
+        download_task=Future(),
+        enqueued_at=enqueued_at,
+        requester_id=user.id
     )
-    await context.run_data.queue.add(queue_element)
+    try:
+        await zone_queue(context).add(queue_element, limit=True, wait=Settings.queue_wait_when_full)
+    except QueueFull as e:
+        # Another request took the room left since the early check
+        await queue_element.set_message(f"Queue full: {e.reason}", skippable=False)
 
 
 # @protect_from_telegram_flood_control(bot_config.connection_listener)
@@ -277,20 +358,46 @@ async def queue_video(context: UpdateHandlerContext, audio_source: AudioSource,
 #     )
 
 
+async def reply_if_queue_full(context: UpdateHandlerContext, user: User, duration: Duration,
+                              query_message_id: int) -> bool:
+    # Refuses early, before anything is spent on the song; AudioQueue.add enforces the limits again when it's added
+    if Settings.queue_wait_when_full:
+        return False
+    reason: str | None = zone_queue(context).admission_refusal(user.id, duration)
+    if reason is None:
+        return False
+    await context.send_message(
+        f"Queue full: {reason}",
+        parse_mode=ParseMode.HTML,
+        reply_to_message_id=query_message_id
+    )
+    return True
+
+
 async def enqueue_impl(context: UpdateHandlerContext):
     user: User = context.update.effective_user
     query_message_id: int = context.message.message_id
+    enqueued_at: float = monotonic()
+
+    # Length and per-user limits don't depend on the song, so check them before spending a metadata lookup on it
+    if await reply_if_queue_full(context, user, Duration.zero(), query_message_id):
+        return
 
     parsed_query: tuple[AudioSource, AudioProcessingSettings] | None = await parse_query(context, query_message_id)
 
     if parsed_query is None:
         return
+    metrics.enqueue_to_metadata_seconds.observe(monotonic() - enqueued_at)
 
     audio_source, postprocessing = parsed_query
 
     if audio_source is not None:
+        if await reply_if_queue_full(
+                context, user, audio_source.duration / abs(postprocessing.tempo_scale), query_message_id
+        ):
+            return
         await opinions.be_opinionated(audio_source.title, context)
-        await queue_video(context, audio_source, user, query_message_id, postprocessing)
+        await queue_video(context, audio_source, user, query_message_id, postprocessing, enqueued_at)
     else:
         await context.send_message(
             "Couldn't find video or playlist",
@@ -303,7 +410,7 @@ async def enqueue_impl(context: UpdateHandlerContext):
     ["q", "queue", "add", "enqueue"],
     filters=~filters.UpdateType.EDITED_MESSAGE,
     has_args=True,
-    permissions=UserSelector.ChatIDIsIn([Settings.registered_primary_chat_id])
+    permissions=UserSelector.ChatIDIsIn(list(zone_chat_ids().values()))
 )
 async def enqueue(context: UpdateHandlerContext):
     """Add a song to the queue
@@ -329,13 +436,13 @@ async def enqueue(context: UpdateHandlerContext):
     ["hampter"],
     filters=~filters.UpdateType.EDITED_MESSAGE,
     has_args=False,
-    permissions=UserSelector.ChatIDIsIn([Settings.registered_primary_chat_id])
+    permissions=UserSelector.ChatIDIsIn(list(zone_chat_ids().values()))
 )
 async def hampter(context: UpdateHandlerContext):
     """Hampter"""
     query_message: Message = context.message
 
-    await context.run_data.queue.hampter()
+    await zone_queue(context).hampter()
     await query_message.set_reaction("👍")
 
 
@@ -347,19 +454,19 @@ async def callback_query_handler(context: UpdateHandlerContext):
     if button_name != "skip_button":
         return
     user: User = context.update.effective_user
-    await context.run_data.queue.skip_specific(user.name, skippable_element_index)
+    await zone_queue(context).skip_specific(user.name, skippable_element_index)
 
 
 @bot_config.add_command_handler(
     ["pause", "stop"],
     filters=~filters.UpdateType.EDITED_MESSAGE,
     has_args=False,
-    permissions=UserSelector.ChatIDIsIn([Settings.registered_primary_chat_id])
+    permissions=UserSelector.ChatIDIsIn(list(zone_chat_ids().values()))
 )
 async def pause(context: UpdateHandlerContext):
     """Pause playback"""
     query_message: Message = context.message
-    await context.run_data.queue.pause()
+    await zone_queue(context).pause()
     await query_message.set_reaction("👍")
 
 
@@ -367,12 +474,12 @@ async def pause(context: UpdateHandlerContext):
     ["play", "resume", "unpause"],
     filters=~filters.UpdateType.EDITED_MESSAGE,
     has_args=False,
-    permissions=UserSelector.ChatIDIsIn([Settings.registered_primary_chat_id])
+    permissions=UserSelector.ChatIDIsIn(list(zone_chat_ids().values()))
 )
 async def resume(context: UpdateHandlerContext):
     """Resume (unpause) playback"""
     query_message: Message = context.message
-    await context.run_data.queue.resume()
+    await zone_queue(context).resume()
     await query_message.set_reaction("👍")
 
 
@@ -380,13 +487,13 @@ async def resume(context: UpdateHandlerContext):
     "skip",
     filters=~filters.UpdateType.EDITED_MESSAGE,
     has_args=False,
-    permissions=UserSelector.ChatIDIsIn([Settings.registered_primary_chat_id])
+    permissions=UserSelector.ChatIDIsIn(list(zone_chat_ids().values()))
 )
 async def skip(context: UpdateHandlerContext):
     """Skip the currently playing (or paused) song"""
     query_message: Message = context.message
     user: User = context.update.effective_user
-    result: bool = await context.run_data.queue.skip(user.name)
+    result: bool = await zone_queue(context).skip(user.name)
     await query_message.set_reaction("👍" if result else "🤷")
 
 
@@ -394,21 +501,40 @@ async def skip(context: UpdateHandlerContext):
     ["skip_all", "clear", "skipall"],
     filters=~filters.UpdateType.EDITED_MESSAGE,
     has_args=False,
-    permissions=UserSelector.ChatIDIsIn([Settings.registered_primary_chat_id])
+    permissions=UserSelector.ChatIDIsIn(list(zone_chat_ids().values()))
 )
 async def skip_all(context: UpdateHandlerContext):
     """Skip all songs currently playing or in the queue"""
     query_message: Message = context.message
     user: User = context.update.effective_user
-    await context.run_data.queue.skip_all(user.name)
+    await zone_queue(context).skip_all(user.name)
     await query_message.set_reaction("👍")
 
 
+@bot_config.add_command_handler(
+    ["effect", "fx"],
+    filters=~filters.UpdateType.EDITED_MESSAGE,
+    has_args=1,
+    permissions=UserSelector.ChatIDIsIn(list(zone_chat_ids().values()))
+)
+async def toggle_effect(context: UpdateHandlerContext):
+    """Toggle an effect on the currently playing song
+    The effect can be "echo", "metal" or "reverb". Songs with pitch shifts, reversal or syncopation can't be changed.
+    """
+    query_message: Message = context.message
+    effect: str = context.args[0].lower()
+    if effect not in ("echo", "metal", "reverb"):
+        await query_message.set_reaction(opinions.lol_emoji())
+        return
+    result: bool = await zone_queue(context).toggle_effect(effect)
+    await query_message.set_reaction("👍" if result else "🤷")
+
+
 @bot_config.add_command_handler(
     ["volume", "vol", "v"],
     filters=~filters.UpdateType.EDITED_MESSAGE,
     has_args=1,
-    permissions=UserSelector.ChatIDIsIn([Settings.registered_primary_chat_id])
+    permissions=UserSelector.ChatIDIsIn(list(zone_chat_ids().values()))
 )
 async def set_volume(context: UpdateHandlerContext):
     """Set the (digital) output volume (in percent)
@@ -426,10 +552,11 @@ async def set_volume(context: UpdateHandlerContext):
     if new_volume < 0.0:
         await query_message.set_reaction(opinions.lol_emoji())
     else:
-        result = await context.run_data.queue.set_digital_volume(new_volume)
+        queue: AudioQueue = zone_queue(context)
+        result = await queue.set_digital_volume(new_volume)
         if result:
             await query_message.set_reaction("👍")
-            context.bot_data.digital_volume = new_volume
+            context.bot_data.zone_digital_volumes = context.bot_data.zone_digital_volumes | {queue.zone: new_volume}
         else:
             await query_message.set_reaction("🙉")
 
@@ -445,7 +572,7 @@ async def get_volume(context: UpdateHandlerContext):
     query_message: Message = context.message
     query_message_id: int = query_message.message_id
     await context.send_message(
-        f"Current volume: {round(await context.run_data.queue.get_digital_volume())}",
+        f"Current volume: {round(await zone_queue(context).get_digital_volume())}",
         parse_mode=ParseMode.HTML,
         reply_to_message_id=query_message_id)
 
@@ -463,7 +590,7 @@ async def get_volume(context: UpdateHandlerContext):
 #     except ValueError:
 #         await query_message.set_reaction(opinions.lol_emoji())
 #         return
-#     context.run_data.queue.set_sys_volume(new_volume)
+#     zone_queue(context).set_sys_volume(new_volume)
 #     await query_message.set_reaction("👍")
 #
 #
@@ -476,7 +603,7 @@ async def get_volume(context: UpdateHandlerContext):
 #     query_message: Message = context.message
 #     query_message_id: int = query_message.message_id
 #     await context.send_message(
-#         f"Current volume: {context.run_data.queue.get_sys_volume()}",
+#         f"Current volume: {zone_queue(context).get_sys_volume()}",
 #         parse_mode=ParseMode.HTML,
 #         reply_to_message_id=query_message_id)
 
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+from asyncio import Future, get_event_loop, shield
+from collections.abc import Callable, Coroutine
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from audio_sources import AudioSource
+from pipeline_scheduler import PipelineScheduler, PipelineStage
+from resource_handler import ResourceHandler
+
+
+class DownloadCache:
+    """
+    Downloads shared between every queue element (in any zone) with the same source. Each download lives in its own
+    resource, which is freed once the last element using it releases it.
+    """
+
+    @dataclass
+    class _Entry:
+        resource: ResourceHandler.Resource
+        task: Future[Path]
+        users: int = 0
+
+    resource_handler: ResourceHandler
+    scheduler: PipelineScheduler
+    _entries: dict[str, _Entry]
+
+    def __init__(self, resource_handler: ResourceHandler, scheduler: PipelineScheduler):
+        self.resource_handler = resource_handler
+        self.scheduler = scheduler
+        self._entries = {}
+
+    async def acquire(self, key: str, audio_source: AudioSource, priority: Callable[[], float],
+                      on_start: Callable[[], Coroutine[Any, Any, None]]) -> Path:
+        entry: DownloadCache._Entry | None = self._entries.get(key)
+        if entry is None:
+            resource: ResourceHandler.Resource = self.resource_handler.claim()
+            entry = self._entries[key] = DownloadCache._Entry(
+                resource,
+                get_event_loop().create_task(self._download(audio_source, resource, priority, on_start))
+            )
+        elif not entry.task.done():
+            await on_start()
+        entry.users += 1
+        try:
+            # Shielded so that one element being skipped doesn't cancel the download for everyone else
+            return await shield(entry.task)
+        except BaseException:
+            self.release(key)
+            raise
+
+    def adopt(self, key: str, path: Path) -> Path:
+        entry: DownloadCache._Entry | None = self._entries.get(key)
+        if entry is None:
+            task: Future[Path] = get_event_loop().create_future()
+            task.set_result(path)
+            entry = self._entries[key] = DownloadCache._Entry(self.resource_handler.claim(path.parent), task)
+        entry.users += 1
+        return entry.task.result()
+
+    def release(self, key: str) -> None:
+        entry: DownloadCache._Entry = self._entries[key]
+        entry.users -= 1
+        if entry.users > 0:
+            return
+        del self._entries[key]
+        entry.task.cancel()
+        if entry.resource.is_open:
+            entry.resource.close()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    async def _download(self, audio_source: AudioSource, resource: ResourceHandler.Resource,
+                        priority: Callable[[], float], on_start: Callable[[], Coroutine[Any, Any, None]]) -> Path:
+        async with self.scheduler.slot(PipelineStage.DOWNLOAD, priority):
+            await on_start()
+            return await audio_source.download(resource)
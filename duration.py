@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from collections.abc import Callable
 from datetime import timedelta
+from math import inf, nan, isinf, isnan
 
 from gadt import GADT
 
@@ -18,10 +19,28 @@ class Duration(metaclass=GADT):
         else:
             return Duration.NAN
 
+    @staticmethod
+    def from_seconds(seconds: float) -> Duration:
+        if isnan(seconds):
+            return Duration.NAN
+        elif isinf(seconds):
+            return Duration.Infinite if seconds > 0 else Duration.NAN
+        else:
+            return Duration.from_timedelta(timedelta(seconds=seconds))
+
     @staticmethod
     def zero():
         return Duration.Finite(timedelta())
 
+    def total_seconds(self) -> float:
+        match self:
+            case Duration.Finite(a):
+                return a.total_seconds()
+            case Duration.Infinite:
+                return inf
+            case Duration.NAN:
+                return nan
+
     def __add__(self, other: Duration) -> Duration:
         match self, other:
             case Duration.Finite(a), Duration.Finite(b):
@@ -60,6 +79,16 @@ class Duration(metaclass=GADT):
             case _:
                 return Duration.NAN
 
+    @property
+    def approximate(self) -> str:
+        match self:
+            case Duration.Finite(a) if a < timedelta(minutes=1):
+                return "<1 min"
+            case Duration.Finite(a):
+                return f"~{round(a / timedelta(minutes=1))} min"
+            case _:
+                return str(self)
+
     def __str__(self) -> str:
         match self:
             case Duration.Finite(a):
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+from collections.abc import Hashable
+from enum import Enum
+from math import isfinite
+
+
+class FairShareMode(Enum):
+    FIFO = "fifo"
+    ROUND_ROBIN = "round_robin"
+    DURATION = "duration"
+
+
+class FairShare[K: Hashable]:
+    """
+    Start-time fair queuing over requesters. Each element is tagged with the virtual time at which its requester's
+    previous element finishes (or the current virtual time, if that is later), and the queue is ordered by these tags.
+    A requester's cost per element is 1 in round-robin mode and the element's duration in seconds in duration mode, so
+    someone who queues 30 songs at once gets every other slot rather than the next 30.
+
+    The tags are handed to IndexedQueue as its order, so insertion and selection stay O(log n); the per-requester
+    bookkeeping here is O(1).
+    """
+
+    mode: FairShareMode
+    _virtual_time: float
+    _finish_tags: dict[Hashable, float]
+    _queued_counts: dict[Hashable, int]
+    _entries: dict[K, tuple[Hashable, float]]
+
+    def __init__(self, mode: FairShareMode = FairShareMode.FIFO):
+        self.mode = mode
+        self._virtual_time = 0
+        self._finish_tags = {}
+        self._queued_counts = {}
+        self._entries = {}
+
+    def admit(self, key: K, requester: Hashable, seconds: float) -> float:
+        """Records a new element and returns its order (0 in FIFO mode, so insertion order is kept)."""
+        if not isfinite(seconds):
+            # Unknown or unbounded (live stream) durations are charged like a one-second track
+            seconds = 0
+        start: float = 0
+        if self.mode != FairShareMode.FIFO:
+            start = max(self._virtual_time, self._finish_tags.get(requester, 0))
+            cost: float = 1 if self.mode == FairShareMode.ROUND_ROBIN else max(seconds, 1)
+            self._finish_tags[requester] = start + cost
+        self._entries[key] = (requester, start)
+        self._queued_counts[requester] = self._queued_counts.get(requester, 0) + 1
+        return start
+
+    def release(self, key: K, served: bool = False) -> None:
+        """Forgets an element that has left the queue, advancing virtual time if it left to be played."""
+        entry: tuple[Hashable, float] | None = self._entries.pop(key, None)
+        if entry is None:
+            return
+        requester, start = entry
+        if served:
+            self._virtual_time = max(self._virtual_time, start)
+        self._queued_counts[requester] -= 1
+        if self._queued_counts[requester] <= 0:
+            # An idle requester starts again from the current virtual time rather than banking credit
+            del self._queued_counts[requester]
+            self._finish_tags.pop(requester, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._queued_counts.clear()
+        self._finish_tags.clear()
+
+    def queued_count(self, requester: Hashable) -> int:
+        return self._queued_counts.get(requester, 0)
@@ -80,6 +80,9 @@
                     python3Packages.yt-dlp
                     python3Packages.python-vlc
                     python3Packages.validators
+                    python3Packages.numpy
+                    python3Packages.ffmpeg-python
+                    ffmpeg
                 ] ++ pkgs.python3Packages.python-telegram-bot.optional-dependencies.callback-data;
                 enterShell = ''
                 '';
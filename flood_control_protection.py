@@ -5,6 +5,7 @@ from functools import wraps
 
 from telegram.error import RetryAfter, TimedOut
 
+import metrics
 from bot_communication import UpwardsCommunication, ConnectionListener
 from decorator_tools import arg_decorator
 from settings import Settings
@@ -35,6 +36,8 @@ def protect_from_telegram_flood_control[** P, T](f: Callable[P, Coroutine[None,
                       f"\tWill automatically recover.\n", file=sys.stderr)
                 next_recovery_id += 1
                 await connection_listener.send(UpwardsCommunication.FloodControlIssues(e.retry_after))
+                metrics.flood_control_waits.inc()
+                metrics.flood_control_wait_seconds.inc(e.retry_after + Settings.flood_control_buffer_time)
                 await sleep(e.retry_after + Settings.flood_control_buffer_time)
         return await f(*args, **kwargs)
 
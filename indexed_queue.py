@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+from collections.abc import Callable, Hashable, Iterable, Iterator
+from itertools import count
+from math import isnan
+from random import random
+from typing import Any
+
+
+class IndexedQueue[K: Hashable, T](Iterable[T]):
+    class _Node:
+        __slots__ = ("order", "value", "priority", "left", "right", "size", "weight", "total")
+
+        def __init__(self, order: tuple[Any, int], value: Any, weight: float):
+            self.order = order
+            self.value = value
+            self.priority: float = random()
+            self.left: IndexedQueue._Node | None = None
+            self.right: IndexedQueue._Node | None = None
+            self.size: int = 1
+            self.weight: float = weight
+            self.total: float = weight
+
+        def update(self) -> None:
+            self.size = 1
+            self.total = self.weight
+            if self.left is not None:
+                self.size += self.left.size
+                self.total += self.left.total
+            if self.right is not None:
+                self.size += self.right.size
+                self.total += self.right.total
+
+    key: Callable[[T], K]
+    weight: Callable[[T], float] | None
+    _root: _Node | None
+    _nodes: dict[K, _Node]
+
+    def __init__(self, key: Callable[[T], K], values: Iterable[T] = (), weight: Callable[[T], float] | None = None):
+        self.key = key
+        self.weight = weight
+        self._root = None
+        self._nodes = {}
+        self._sequence = count()
+        for value in values:
+            self.append(value)
+
+    @staticmethod
+    def _merge(left: _Node | None, right: _Node | None) -> _Node | None:
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = IndexedQueue._merge(left.right, right)
+            left.update()
+            return left
+        else:
+            right.left = IndexedQueue._merge(left, right.left)
+            right.update()
+            return right
+
+    @staticmethod
+    def _split(node: _Node | None, order: tuple[Any, int]) -> tuple[_Node | None, _Node | None]:
+        if node is None:
+            return None, None
+        if node.order < order:
+            node.right, right = IndexedQueue._split(node.right, order)
+            node.update()
+            return node, right
+        else:
+            left, node.left = IndexedQueue._split(node.left, order)
+            node.update()
+            return left, node
+
+    @staticmethod
+    def _remove(node: _Node, order: tuple[Any, int]) -> _Node | None:
+        if node.order == order:
+            return IndexedQueue._merge(node.left, node.right)
+        if order < node.order:
+            node.left = IndexedQueue._remove(node.left, order)
+        else:
+            node.right = IndexedQueue._remove(node.right, order)
+        node.update()
+        return node
+
+    def _weigh(self, value: T) -> float:
+        weight: float = self.weight(value) if self.weight is not None else 0
+        # A single NaN would spread through every subtree total above it
+        if isnan(weight):
+            raise ValueError(f"Weight of {self.key(value)} is NaN")
+        return weight
+
+    def append(self, value: T, order: Any = 0) -> None:
+        key: K = self.key(value)
+        if key in self._nodes:
+            raise KeyError(f"Duplicate key: {key}")
+        node: IndexedQueue._Node = IndexedQueue._Node((order, next(self._sequence)), value, self._weigh(value))
+        self._nodes[key] = node
+        left, right = IndexedQueue._split(self._root, node.order)
+        self._root = IndexedQueue._merge(IndexedQueue._merge(left, node), right)
+
+    def remove(self, key: K) -> T:
+        node: IndexedQueue._Node = self._nodes.pop(key)
+        self._root = IndexedQueue._remove(self._root, node.order)
+        node.left = node.right = None
+        return node.value
+
+    def get[X](self, key: K, default: X = None) -> T | X:
+        node: IndexedQueue._Node | None = self._nodes.get(key)
+        return node.value if node is not None else default
+
+    def peek(self) -> T:
+        if self._root is None:
+            raise IndexError("peek from an empty IndexedQueue")
+        node: IndexedQueue._Node = self._root
+        while node.left is not None:
+            node = node.left
+        return node.value
+
+    def popleft(self) -> T:
+        return self.remove(self.key(self.peek()))
+
+    def clear(self) -> list[T]:
+        out: list[T] = list(self)
+        self._root = None
+        self._nodes.clear()
+        return out
+
+    def position(self, key: K) -> int:
+        order: tuple[Any, int] = self._nodes[key].order
+        position: int = 0
+        node: IndexedQueue._Node | None = self._root
+        while node is not None:
+            if order < node.order:
+                node = node.left
+            else:
+                position += node.left.size if node.left is not None else 0
+                if order == node.order:
+                    return position
+                position += 1
+                node = node.right
+        raise KeyError(key)
+
+    def total_weight(self) -> float:
+        return self._root.total if self._root is not None else 0
+
+    def prefix_weight(self, key: K) -> float:
+        order: tuple[Any, int] = self._nodes[key].order
+        total: float = 0
+        node: IndexedQueue._Node | None = self._root
+        while node is not None:
+            if order < node.order:
+                node = node.left
+            else:
+                total += node.left.total if node.left is not None else 0
+                if order == node.order:
+                    return total
+                total += node.weight
+                node = node.right
+        raise KeyError(key)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._nodes
+
+    def __iter__(self) -> Iterator[T]:
+        stack: list[IndexedQueue._Node] = []
+        node: IndexedQueue._Node | None = self._root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.value
+            node = node.right
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __bool__(self) -> bool:
+        return bool(self._nodes)
+
+    def __repr__(self) -> str:
+        return f"IndexedQueue([{', '.join(map(repr, self))}])"
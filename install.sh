@@ -14,7 +14,7 @@ source ./.venv/bin/activate
 pip install --upgrade pip
 pip install --upgrade certifi
 pip install --upgrade yt_dlp
-pip install "python-telegram-bot[all]" python-vlc validators
+pip install "python-telegram-bot[all]" python-vlc validators numpy ffmpeg-python
 
 if { command -v brew 2>&1; } > /dev/null
 then
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from typing import Any
 
 from telegram import User
 
@@ -26,3 +27,6 @@ def format_add_video_status(audio_source: AudioSource | None, user: User | None,
 class MessageEditStatusCallback(ABC):
     @abstractmethod
     async def __call__(self, status: str, skip_index: int | None, url: str | None) -> None: ...
+
+    def serialise(self) -> dict[str, Any] | None:
+        return None
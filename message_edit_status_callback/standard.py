@@ -1,3 +1,5 @@
+from typing import Any
+
 from telegram import Message, User, InlineKeyboardButton, InlineKeyboardMarkup, LinkPreviewOptions
 from telegram.constants import ParseMode
 from telegram.error import BadRequest
@@ -20,6 +22,9 @@ class StandardMessageEditStatusCallback(MessageEditStatusCallback):
         self.user = user
         self.postprocessing = postprocessing
 
+    def serialise(self) -> dict[str, Any]:
+        return {"message": self.message.to_dict(), "user": self.user.to_dict()}
+
     async def __call__(self, status: str, skip_index: int | None, url: str | None) -> None:
         keyboard = [
             [InlineKeyboardButton("Skip", callback_data=("skip_button", skip_index))]
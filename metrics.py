@@ -0,0 +1,287 @@
+from __future__ import annotations
+
+import os
+from abc import ABC, abstractmethod
+from asyncio import StreamReader, StreamWriter, start_server, sleep, Server
+from bisect import bisect_left
+from collections.abc import Callable, Iterable
+from math import inf, isinf
+from pathlib import Path
+from sys import stderr
+
+
+def _format_value(value: float) -> str:
+    if isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f"{name}=\"{_escape_label_value(str(value))}\"" for name, value in labels.items()) + "}"
+
+
+class Metric[C](ABC):
+    """
+    A named family of samples, one child per combination of label values. Children are created on first use and
+    cached, so recording a sample is a dict lookup plus an addition.
+    """
+
+    type_name: str
+
+    name: str
+    documentation: str
+    label_names: tuple[str, ...]
+    _children: dict[tuple[str, ...], C]
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._children = {}
+
+    @abstractmethod
+    def _new_child(self) -> C: ...
+
+    @abstractmethod
+    def _samples(self, labels: dict[str, str], child: C) -> Iterable[tuple[str, dict[str, str], float]]: ...
+
+    def labels(self, *label_values: str) -> C:
+        child: C | None = self._children.get(label_values)
+        if child is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(f"{self.name} expects labels {self.label_names}, got {label_values}")
+            child = self._children[label_values] = self._new_child()
+        return child
+
+    def expose(self) -> str:
+        lines: list[str] = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for label_values, child in list(self._children.items()):
+            for name, labels, value in self._samples(dict(zip(self.label_names, label_values)), child):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric["Counter.Child"]):
+    type_name = "counter"
+
+    class Child:
+        __slots__ = ("value",)
+
+        def __init__(self):
+            self.value: float = 0
+
+        def inc(self, amount: float = 1) -> None:
+            self.value += amount
+
+    def _new_child(self) -> Counter.Child:
+        return Counter.Child()
+
+    def _samples(self, labels: dict[str, str], child: Counter.Child) -> Iterable[tuple[str, dict[str, str], float]]:
+        yield f"{self.name}_total", labels, child.value
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(Metric["Gauge.Child"]):
+    type_name = "gauge"
+
+    class Child:
+        __slots__ = ("value", "function")
+
+        def __init__(self):
+            self.value: float = 0
+            self.function: Callable[[], float] | None = None
+
+        def set(self, value: float) -> None:
+            self.value = value
+
+        def inc(self, amount: float = 1) -> None:
+            self.value += amount
+
+        def dec(self, amount: float = 1) -> None:
+            self.value -= amount
+
+        def set_function(self, function: Callable[[], float]) -> None:
+            # Evaluated only when the metrics are collected, so nothing has to be kept up to date on the hot path
+            self.function = function
+
+        def get(self) -> float:
+            return self.function() if self.function is not None else self.value
+
+    def _new_child(self) -> Gauge.Child:
+        return Gauge.Child()
+
+    def _samples(self, labels: dict[str, str], child: Gauge.Child) -> Iterable[tuple[str, dict[str, str], float]]:
+        yield self.name, labels, child.get()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self.labels().set_function(function)
+
+
+class Histogram(Metric["Histogram.Child"]):
+    type_name = "histogram"
+
+    default_buckets: tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    buckets: tuple[float, ...]
+
+    class Child:
+        __slots__ = ("buckets", "counts", "sum")
+
+        def __init__(self, buckets: tuple[float, ...]):
+            self.buckets: tuple[float, ...] = buckets
+            self.counts: list[int] = [0] * (len(buckets) + 1)
+            self.sum: float = 0
+
+        def observe(self, value: float) -> None:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] | None = None):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets if buckets is not None else Histogram.default_buckets))
+
+    def _new_child(self) -> Histogram.Child:
+        return Histogram.Child(self.buckets)
+
+    def _samples(self, labels: dict[str, str], child: Histogram.Child) -> Iterable[tuple[str, dict[str, str], float]]:
+        cumulative: int = 0
+        for bound, count in zip(self.buckets + (inf,), child.counts):
+            cumulative += count
+            yield f"{self.name}_bucket", labels | {"le": _format_value(bound)}, cumulative
+        yield f"{self.name}_sum", labels, child.sum
+        yield f"{self.name}_count", labels, cumulative
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+
+class MetricsRegistry:
+    _metrics: dict[str, Metric]
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _get_or_create[M: Metric](self, metric_type: type[M], name: str, *args, **kwargs) -> M:
+        metric: Metric | None = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = metric_type(name, *args, **kwargs)
+        elif not isinstance(metric, metric_type):
+            raise TypeError(f"Metric {name} is already registered as a {metric.type_name}")
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, label_names)
+
+    def gauge(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, label_names)
+
+    def histogram(self, name: str, documentation: str, label_names: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] | None = None) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, label_names, buckets)
+
+    def expose(self) -> str:
+        return "\n".join(metric.expose() for metric in list(self._metrics.values())) + "\n"
+
+    def dump(self, path: os.PathLike | str) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path: Path = path.with_suffix(path.suffix + ".tmp")
+        partial_path.write_text(self.expose())
+        os.replace(partial_path, path)
+
+    async def _handle_request(self, reader: StreamReader, writer: StreamWriter) -> None:
+        try:
+            request_line: bytes = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            match request_line.decode(errors="replace").split():
+                case ["GET", "/metrics" | "/", *_]:
+                    status, body = "200 OK", self.expose().encode()
+                case _:
+                    status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> Server:
+        return await start_server(self._handle_request, host, port)
+
+    async def dump_periodically(self, path: os.PathLike | str, interval: float) -> None:
+        while True:
+            await sleep(interval)
+            try:
+                self.dump(path)
+            except Exception as e:
+                # Keep dumping; the next interval may well succeed
+                print(f"Warning: couldn't dump metrics to {path}: {e!r}", file=stderr)
+
+
+registry: MetricsRegistry = MetricsRegistry()
+
+enqueue_to_metadata_seconds: Histogram = registry.histogram(
+    "further_enqueue_to_metadata_seconds", "Time from receiving a queue request to resolving its metadata"
+)
+metadata_to_downloaded_seconds: Histogram = registry.histogram(
+    "further_metadata_to_downloaded_seconds", "Time from resolving a song's metadata to having it downloaded"
+)
+processing_seconds: Histogram = registry.histogram(
+    "further_processing_seconds", "Time spent processing a song, by processing step and effects", ("step", "effects")
+)
+time_to_first_sound_seconds: Histogram = registry.histogram(
+    "further_time_to_first_sound_seconds", "Time from receiving a queue request to the song starting to play"
+)
+track_gap_seconds: Histogram = registry.histogram(
+    "further_track_gap_seconds", "Silence between consecutive tracks", ("zone",),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+queue_depth: Gauge = registry.gauge("further_queue_depth", "Number of songs waiting in each zone's queue", ("zone",))
+pipeline_active: Gauge = registry.gauge("further_pipeline_active", "Jobs running in each pipeline stage", ("stage",))
+pipeline_waiting: Gauge = registry.gauge(
+    "further_pipeline_waiting", "Jobs waiting for a slot in each pipeline stage", ("stage",)
+)
+flood_control_waits: Counter = registry.counter(
+    "further_flood_control_waits", "Telegram flood control exceptions that were waited out"
+)
+flood_control_wait_seconds: Counter = registry.counter(
+    "further_flood_control_wait_seconds", "Total time spent waiting out Telegram flood control"
+)
+processed_cache_lookups: Counter = registry.counter(
+    "further_processed_cache_lookups", "Processed audio cache lookups, by whether they hit", ("result",)
+)
+processing_routes: Counter = registry.counter(
+    "further_processing_routes", "Songs by where their effects are applied, and by effects", ("route", "effects")
+)
+processed_cache_bytes: Gauge = registry.gauge("further_processed_cache_bytes", "Size of the processed audio cache")
+resource_directory_bytes: Gauge = registry.gauge(
+    "further_resource_directory_bytes", "Size of the downloads directory on disk"
+)
+
+
+def directory_size(path: os.PathLike | str) -> int:
+    total: int = 0
+    for directory, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.lstat(os.path.join(directory, file_name)).st_size
+            except OSError:
+                # Renamed or deleted since it was listed, e.g. a finished download
+                pass
+    return total
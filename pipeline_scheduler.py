@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+from asyncio import Future, CancelledError, get_event_loop
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from enum import Enum
+from heapq import heappush, heappop, heapify
+from itertools import count
+from math import inf
+
+from process_pool import ProcessPool
+
+
+class PipelineStage(Enum):
+    METADATA = 0
+    DOWNLOAD = 1
+    PROCESSING = 2
+
+    def __str__(self):
+        match self:
+            case PipelineStage.METADATA:
+                return "Metadata"
+            case PipelineStage.DOWNLOAD:
+                return "Download"
+            case PipelineStage.PROCESSING:
+                return "Processing"
+
+
+class PipelineScheduler:
+    @dataclass(order=True)
+    class _Waiter:
+        priority: float
+        sequence: int
+        future: Future[None] = field(compare=False)
+        priority_key: Callable[[], float] | None = field(compare=False)
+
+    budgets: dict[PipelineStage, int]
+    _active: dict[PipelineStage, int]
+    _waiting: dict[PipelineStage, list[_Waiter]]
+    _executors: dict[PipelineStage, ThreadPoolExecutor]
+    process_pool: ProcessPool | None
+
+    def __init__(self, budgets: dict[PipelineStage, int], process_pool: ProcessPool | None = None):
+        self.budgets = budgets
+        self.process_pool = process_pool
+        self._active = {stage: 0 for stage in PipelineStage}
+        self._waiting = {stage: [] for stage in PipelineStage}
+        self._executors = {
+            stage: ThreadPoolExecutor(max_workers=budget, thread_name_prefix=f"{stage}Worker")
+            for stage, budget in budgets.items()
+        }
+        self._sequence = count()
+
+    def has_capacity(self, stage: PipelineStage) -> bool:
+        return self._active[stage] < self.budgets[stage] and not self.waiting(stage)
+
+    def idle(self, stage: PipelineStage) -> bool:
+        return not self._active[stage] and not self.waiting(stage)
+
+    def active(self, stage: PipelineStage) -> int:
+        return self._active[stage]
+
+    def waiting(self, stage: PipelineStage) -> int:
+        return sum(1 for waiter in self._waiting[stage] if not waiter.future.done())
+
+    def queue_depths(self) -> dict[PipelineStage, tuple[int, int]]:
+        return {stage: (self.active(stage), self.waiting(stage)) for stage in PipelineStage}
+
+    @asynccontextmanager
+    async def slot(self, stage: PipelineStage, priority: Callable[[], float] | None = None):
+        await self._acquire(stage, priority)
+        try:
+            yield
+        finally:
+            self._release(stage)
+
+    @contextmanager
+    def spare_slots(self, stage: PipelineStage, wanted: int):
+        """
+        Claims up to wanted slots that are free right now, without waiting or jumping ahead of any waiter, for a job
+        that already holds a slot and can use more parallelism while the stage is otherwise idle.
+        """
+        granted: int = 0
+        while granted < wanted and self.has_capacity(stage):
+            self._active[stage] += 1
+            granted += 1
+        try:
+            yield granted
+        finally:
+            for _ in range(granted):
+                self._release(stage)
+
+    async def run_in_thread[T](self, stage: PipelineStage, func: Callable[..., T], *args,
+                               priority: Callable[[], float] | None = None) -> T:
+        async with self.slot(stage, priority):
+            return await get_event_loop().run_in_executor(self._executors[stage], func, *args)
+
+    def reprioritise(self) -> None:
+        for stage, waiters in self._waiting.items():
+            waiters[:] = [waiter for waiter in waiters if not waiter.future.done()]
+            for waiter in waiters:
+                waiter.priority = waiter.priority_key() if waiter.priority_key is not None else inf
+            heapify(waiters)
+
+    async def _acquire(self, stage: PipelineStage, priority: Callable[[], float] | None) -> None:
+        if self.has_capacity(stage):
+            self._active[stage] += 1
+            return
+        waiter: PipelineScheduler._Waiter = PipelineScheduler._Waiter(
+            priority() if priority is not None else inf,
+            next(self._sequence),
+            get_event_loop().create_future(),
+            priority
+        )
+        heappush(self._waiting[stage], waiter)
+        try:
+            await waiter.future
+        except CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # The slot was granted just before the cancellation arrived
+                self._release(stage)
+            raise
+
+    def _release(self, stage: PipelineStage) -> None:
+        self._active[stage] -= 1
+        waiters: list[PipelineScheduler._Waiter] = self._waiting[stage]
+        while waiters and self._active[stage] < self.budgets[stage]:
+            waiter: PipelineScheduler._Waiter = heappop(waiters)
+            if waiter.future.done():
+                continue
+            self._active[stage] += 1
+            waiter.future.set_result(None)
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+from asyncio import AbstractEventLoop, Future, get_event_loop, wait
+from collections.abc import Callable
+from time import monotonic
+
+from vlc import EventType, MediaPlayer
+from vlc import State as VLCState
+
+
+class PlayerEvents:
+    _event_states: dict[EventType, VLCState] = {
+        EventType.MediaPlayerNothingSpecial: VLCState.NothingSpecial,
+        EventType.MediaPlayerOpening: VLCState.Opening,
+        EventType.MediaPlayerPlaying: VLCState.Playing,
+        EventType.MediaPlayerPaused: VLCState.Paused,
+        EventType.MediaPlayerStopped: VLCState.Stopped,
+        EventType.MediaPlayerEndReached: VLCState.Ended,
+        EventType.MediaPlayerEncounteredError: VLCState.Error,
+    }
+    final_states: tuple[VLCState, ...] = (VLCState.Ended, VLCState.Stopped, VLCState.Error)
+
+    player: MediaPlayer
+    loop: AbstractEventLoop
+    state: VLCState
+    state_time: float
+    listeners: list[Callable[[PlayerEvents, VLCState, float], None]]
+    _generation: int
+    _wakeup: Future[None] | None
+
+    def __init__(self, player: MediaPlayer, loop: AbstractEventLoop | None = None):
+        self.player = player
+        self.loop = loop if loop is not None else get_event_loop()
+        self.state = VLCState.NothingSpecial
+        self.state_time = monotonic()
+        self.listeners = []
+        self._generation = 0
+        self._wakeup = None
+
+        event_manager = player.event_manager()
+        for event_type, state in self._event_states.items():
+            event_manager.event_attach(event_type, self._vlc_callback, state)
+
+    def _vlc_callback(self, _event, state: VLCState) -> None:
+        # Called from a libvlc thread: read the generation here so that events belonging to a previous media are
+        # recognisable once they reach the event loop
+        self.loop.call_soon_threadsafe(self._set_state, self._generation, state, monotonic())
+
+    def _set_state(self, generation: int, state: VLCState, time: float) -> None:
+        if generation != self._generation:
+            return
+        self.state = state
+        self.state_time = time
+        for listener in self.listeners:
+            listener(self, state, time)
+        if state in self.final_states:
+            self.wake()
+
+    @property
+    def finished(self) -> bool:
+        return self.state in self.final_states
+
+    def play(self) -> None:
+        self._generation += 1
+        self.state = VLCState.Opening
+        self.state_time = monotonic()
+        self.player.play()
+
+    def stop(self) -> None:
+        if not self.finished:
+            self.player.stop()
+            self.state = VLCState.Stopped
+            self.state_time = monotonic()
+
+    def wake(self) -> None:
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    async def wait(self, timeout: float | None = None) -> None:
+        if self.finished:
+            return
+        self._wakeup = self.loop.create_future()
+        try:
+            await wait([self._wakeup], timeout=timeout)
+        finally:
+            self._wakeup = None
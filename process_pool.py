@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import importlib
+import multiprocessing
+from asyncio import Future, Queue, get_event_loop, wait_for, to_thread
+from collections.abc import Callable
+from multiprocessing.connection import Connection
+from multiprocessing.context import BaseContext
+from multiprocessing.process import BaseProcess
+from sys import stderr
+from typing import Any
+
+
+class WorkerDied(Exception):
+    pass
+
+
+def _worker_main(connection: Connection, preload: tuple[str, ...]) -> None:
+    for module_name in preload:
+        importlib.import_module(module_name)
+    while True:
+        try:
+            func, args = connection.recv()
+        except EOFError:
+            return
+        try:
+            result: tuple[bool, Any] = (True, func(*args))
+        except Exception as e:
+            result = (False, e)
+        try:
+            connection.send(result)
+        except Exception as e:
+            # The result or exception couldn't be pickled
+            connection.send((False, RuntimeError(f"Couldn't return the result of {func.__name__}: {e!r}")))
+
+
+class ProcessPool:
+    """
+    A fixed number of long-lived worker processes for CPU-bound jobs. Workers are forked from a forkserver that has
+    already imported the preload modules, so they start warm and don't inherit the bot's threads. Each job runs on a
+    worker of its own: if the job is cancelled (e.g. its element is skipped) or times out, that worker is killed and
+    replaced without disturbing the others, which concurrent.futures.ProcessPoolExecutor can't do.
+
+    Workers are started in the background when the first job is run, since starting the forkserver blocks until it has
+    imported the preload modules.
+    """
+
+    class _Worker:
+        process: BaseProcess
+        connection: Connection
+
+        def __init__(self, context: BaseContext, preload: tuple[str, ...]):
+            self.connection, child_connection = context.Pipe()
+            self.process = context.Process(target=_worker_main, args=(child_connection, preload), daemon=True)
+            self.process.start()
+            child_connection.close()
+
+        async def receive(self) -> Any:
+            readable: Future[None] = get_event_loop().create_future()
+            file_descriptor: int = self.connection.fileno()
+            get_event_loop().add_reader(
+                file_descriptor, lambda: readable.set_result(None) if not readable.done() else None
+            )
+            try:
+                await readable
+            finally:
+                get_event_loop().remove_reader(file_descriptor)
+            try:
+                return self.connection.recv()
+            except EOFError:
+                raise WorkerDied(f"Worker process exited with code {self.process.exitcode}")
+
+        def kill(self) -> None:
+            self.connection.close()
+            if self.process.is_alive():
+                self.process.kill()
+            self.process.join()
+
+    workers: int
+    preload: tuple[str, ...]
+    _context: BaseContext
+    _idle: Queue[_Worker]
+    _all: set[_Worker]
+    _starting: int
+    _shut_down: bool
+
+    def __init__(self, workers: int, preload: tuple[str, ...] = ()):
+        self.workers = workers
+        self.preload = preload
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload(list(preload))
+        self._idle = Queue()
+        self._all = set()
+        self._starting = 0
+        self._shut_down = False
+
+    def _fill(self) -> None:
+        while not self._shut_down and len(self._all) + self._starting < self.workers:
+            self._starting += 1
+            get_event_loop().create_task(self._start_worker())
+
+    async def _start_worker(self) -> None:
+        try:
+            worker: ProcessPool._Worker = await to_thread(ProcessPool._Worker, self._context, self.preload)
+        except Exception as e:
+            print(f"Warning: couldn't start a worker process: {e!r}", file=stderr)
+            return
+        finally:
+            self._starting -= 1
+        if self._shut_down:
+            worker.kill()
+            return
+        self._all.add(worker)
+        self._idle.put_nowait(worker)
+
+    def _replace(self, worker: _Worker) -> None:
+        self._all.discard(worker)
+        worker.kill()
+        self._fill()
+
+    async def run[T](self, func: Callable[..., T], *args, timeout: float | None = None) -> T:
+        """Runs func(*args) on a worker; func, its arguments and its result must all be picklable."""
+        self._fill()
+        worker: ProcessPool._Worker = await self._idle.get()
+        try:
+            worker.connection.send((func, args))
+            succeeded, value = await wait_for(worker.receive(), timeout)
+        except BaseException:
+            # Cancelled, timed out or crashed, so the worker may still be busy (or gone)
+            self._replace(worker)
+            raise
+        self._idle.put_nowait(worker)
+        if not succeeded:
+            raise value
+        return value
+
+    def shutdown(self) -> None:
+        self._shut_down = True
+        for worker in self._all:
+            worker.kill()
+        self._all.clear()
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from sys import stderr
+
+from audio_processing import AudioProcessingSettings, VLCModificationSettings
+
+
+class ProcessedAudioCache:
+    """
+    Persistent cache of processed audio, content-addressed by the source's cache key and the normalised processing
+    settings, and evicted least recently used first once it grows past its byte budget. Hits are hard-linked (or
+    copied, across filesystems) into the element's own resource, so evicting an entry never pulls a file out from under
+    a queued element.
+    """
+
+    index_name: str = "index.json"
+
+    @dataclass
+    class _Entry:
+        file_name: str
+        size: int
+        tempo_scale: float
+
+    directory: Path
+    max_bytes: int
+    _entries: OrderedDict[str, _Entry]
+    _total_bytes: int
+
+    def __init__(self, directory: os.PathLike | str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def key(source_key: str, settings: AudioProcessingSettings) -> str:
+        canonical: str = json.dumps([source_key, settings.canonical_dict()], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _load(self) -> None:
+        index_path: Path = self.directory / ProcessedAudioCache.index_name
+        try:
+            index: list[dict] = json.loads(index_path.read_text()) if index_path.is_file() else []
+        except json.JSONDecodeError:
+            print("Warning: ignoring corrupt processed audio cache index", file=stderr)
+            index = []
+        for record in index:
+            entry: ProcessedAudioCache._Entry = ProcessedAudioCache._Entry(
+                record["file_name"], record["size"], record["tempo_scale"]
+            )
+            if (self.directory / entry.file_name).is_file():
+                self._entries[record["key"]] = entry
+                self._total_bytes += entry.size
+        # Files the index doesn't know about were written by a crash between storing them and saving the index
+        known: set[str] = {entry.file_name for entry in self._entries.values()} | {ProcessedAudioCache.index_name}
+        for path in self.directory.iterdir():
+            if path.name not in known:
+                path.unlink() if path.is_file() else shutil.rmtree(path)
+        self._evict()
+
+    def _save(self) -> None:
+        index_path: Path = self.directory / ProcessedAudioCache.index_name
+        partial_path: Path = index_path.with_suffix(index_path.suffix + ".tmp")
+        partial_path.write_text(json.dumps([{"key": key} | asdict(entry) for key, entry in self._entries.items()]))
+        os.replace(partial_path, index_path)
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry.size
+            (self.directory / entry.file_name).unlink(missing_ok=True)
+
+    @staticmethod
+    def _link(source: Path, dest: Path) -> None:
+        dest.unlink(missing_ok=True)
+        try:
+            os.link(source, dest)
+        except OSError:
+            shutil.copyfile(source, dest)
+
+    def get(self, source_key: str, settings: AudioProcessingSettings, dest_path: Path) -> \
+            VLCModificationSettings | None:
+        """Places the cached render at dest_path and returns its playback settings, or returns None on a miss."""
+        key: str = ProcessedAudioCache.key(source_key, settings)
+        entry: ProcessedAudioCache._Entry | None = self._entries.get(key)
+        if entry is None:
+            return None
+        try:
+            ProcessedAudioCache._link(self.directory / entry.file_name, dest_path)
+        except OSError:
+            del self._entries[key]
+            self._total_bytes -= entry.size
+            self._save()
+            return None
+        self._entries.move_to_end(key)
+        self._save()
+        return VLCModificationSettings(entry.tempo_scale)
+
+    def put(self, source_key: str, settings: AudioProcessingSettings, path: Path,
+            vlc_settings: VLCModificationSettings) -> None:
+        key: str = ProcessedAudioCache.key(source_key, settings)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self._save()
+            return
+        size: int = path.stat().st_size
+        if size > self.max_bytes:
+            return
+        entry: ProcessedAudioCache._Entry = ProcessedAudioCache._Entry(
+            key + path.suffix, size, vlc_settings.tempo_scale
+        )
+        try:
+            ProcessedAudioCache._link(path, self.directory / entry.file_name)
+        except OSError as e:
+            # Failing to cache a render must never fail its playback
+            print(f"Warning: couldn't add {path} to the processed audio cache: {e}", file=stderr)
+            return
+        self._entries[key] = entry
+        self._total_bytes += size
+        self._evict()
+        self._save()
+
+    def __contains__(self, item: tuple[str, AudioProcessingSettings]) -> bool:
+        return ProcessedAudioCache.key(*item) in self._entries
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
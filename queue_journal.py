@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from queue import SimpleQueue
+from sys import stderr
+from threading import Thread
+from typing import Any, TextIO
+
+
+@dataclass
+class JournalEntry:
+    element_id: int
+    source: dict[str, Any]
+    processing: dict[str, Any]
+    status: dict[str, Any]
+    zone: str | None = None
+    resource_path: Path | None = None
+    downloaded_path: Path | None = None
+    processed_path: Path | None = None
+    tempo_scale: float = 1
+    position: int = 0
+    finished: bool = False
+
+    def records(self) -> list[dict[str, Any]]:
+        out: list[dict[str, Any]] = [{
+            "event": "add",
+            "element_id": self.element_id,
+            "zone": self.zone,
+            "source": self.source,
+            "processing": self.processing,
+            "status": self.status
+        }]
+        if self.downloaded_path is not None:
+            out.append({
+                "event": "downloaded",
+                "element_id": self.element_id,
+                "path": str(self.downloaded_path)
+            })
+        if self.processed_path is not None:
+            out.append({
+                "event": "processed",
+                "element_id": self.element_id,
+                "resource": str(self.resource_path),
+                "path": str(self.processed_path),
+                "tempo_scale": self.tempo_scale
+            })
+        if self.position:
+            out.append({"event": "position", "element_id": self.element_id, "position": self.position})
+        return out
+
+
+class QueueJournal:
+    """
+    Append-only log of queue events, fsynced so that it survives the bot being killed at any point. Records are written
+    by a background thread in batches, one fsync per batch, and position snapshots (superseded every few seconds anyway)
+    are not fsynced on their own. On startup it is replayed into one JournalEntry per unfinished element and rewritten
+    in compacted form, and it is compacted again whenever it grows past compact_bytes (or twice its compacted size, if
+    that is larger).
+    """
+
+    path: Path
+    compact_bytes: int
+    _file: TextIO | None
+    _compacted_bytes: int
+    # Unfinished elements as of the last record written, which is all that compaction keeps
+    _entries: dict[int, JournalEntry]
+    # Records waiting for the writer thread, then None once closed
+    _pending: SimpleQueue[dict[str, Any] | None]
+    _writer: Thread | None
+
+    def __init__(self, path: os.PathLike | str, compact_bytes: int = 1 << 20):
+        self.path = Path(path)
+        self.compact_bytes = compact_bytes
+        self._file = None
+        self._compacted_bytes = 0
+        self._entries = {}
+        self._pending = SimpleQueue()
+        self._writer = None
+
+    def replay(self) -> list[JournalEntry]:
+        entries: dict[int, JournalEntry] = {}
+        if self.path.is_file():
+            with open(self.path, "r") as journal_file:
+                for line_number, line in enumerate(journal_file, 1):
+                    try:
+                        record: dict[str, Any] = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn write from a crash can only ever affect the last record
+                        print(f"Warning: ignoring corrupt queue journal record on line {line_number}", file=stderr)
+                        continue
+                    QueueJournal._apply(entries, record)
+        live_entries: list[JournalEntry] = [entry for entry in entries.values() if not entry.finished]
+        self._compact(live_entries)
+        self._entries = {entry.element_id: JournalEntry(**vars(entry)) for entry in live_entries}
+        return live_entries
+
+    @staticmethod
+    def _apply(entries: dict[int, JournalEntry], record: dict[str, Any]) -> None:
+        element_id: int = record["element_id"]
+        if record["event"] == "add":
+            entries[element_id] = JournalEntry(
+                element_id, record["source"], record["processing"], record["status"], record.get("zone")
+            )
+            return
+        entry: JournalEntry | None = entries.get(element_id)
+        if entry is None:
+            return
+        match record["event"]:
+            case "downloaded":
+                entry.downloaded_path = Path(record["path"])
+            case "processed":
+                entry.resource_path = Path(record["resource"])
+                entry.processed_path = Path(record["path"])
+                entry.tempo_scale = record["tempo_scale"]
+            case "position":
+                entry.position = record["position"]
+            case "skipped" | "played":
+                entry.finished = True
+
+    def _compact(self, entries: list[JournalEntry]) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        compacted_path: Path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(compacted_path, "w") as compacted_file:
+            for entry in entries:
+                for record in entry.records():
+                    compacted_file.write(json.dumps(record) + "\n")
+            compacted_file.flush()
+            os.fsync(compacted_file.fileno())
+            self._compacted_bytes = compacted_file.tell()
+        os.replace(compacted_path, self.path)
+
+    def record(self, event: str, element_id: int, **data: Any) -> None:
+        self._pending.put({"event": event, "element_id": element_id} | data)
+        if self._writer is None:
+            self._writer = Thread(target=self._write_pending, name="queue journal", daemon=True)
+            self._writer.start()
+
+    def _write_pending(self) -> None:
+        closed: bool = False
+        while not closed:
+            batch: list[dict[str, Any]] = []
+            record: dict[str, Any] | None = self._pending.get()
+            while True:
+                if record is None:
+                    closed = True
+                else:
+                    batch.append(record)
+                if self._pending.empty():
+                    break
+                record = self._pending.get()
+            try:
+                self._write(batch)
+            except OSError as e:
+                print(f"Warning: couldn't write to the queue journal: {e!r}", file=stderr)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, batch: list[dict[str, Any]]) -> None:
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a")
+        for record in batch:
+            self._file.write(json.dumps(record) + "\n")
+            QueueJournal._apply(self._entries, record)
+            entry: JournalEntry | None = self._entries.get(record["element_id"])
+            if entry is not None and entry.finished:
+                del self._entries[record["element_id"]]
+        self._file.flush()
+        if any(record["event"] != "position" for record in batch):
+            os.fsync(self._file.fileno())
+        if self._file.tell() > max(self.compact_bytes, 2 * self._compacted_bytes):
+            self._compact(list(self._entries.values()))
+
+    def close(self) -> None:
+        """Writes out every record made so far and stops the writer thread."""
+        if self._writer is not None:
+            self._pending.put(None)
+            self._writer.join()
+            self._writer = None
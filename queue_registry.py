@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+from asyncio import Future, CancelledError, get_event_loop
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Iterator
+from time import monotonic
+from typing import Any
+
+import metrics
+from audio_processing.beat_analysis import BeatAnalysisIndex
+from audio_queue import AudioQueue
+from download_cache import DownloadCache
+from pipeline_scheduler import PipelineScheduler, PipelineStage
+from process_pool import ProcessPool
+from processed_cache import ProcessedAudioCache
+from queue_journal import QueueJournal
+from resource_handler import ResourceHandler
+from settings import Settings
+
+
+class QueueRegistry(Iterable[AudioQueue]):
+    """
+    One AudioQueue per zone (a room with its own speakers, driven from its own chat). Zones have separate players and
+    volumes, but share the pipeline scheduler, the download, processed audio and metadata caches and the beat
+    analysis index.
+    """
+
+    primary_zone: str = "primary"
+
+    scheduler: PipelineScheduler
+    download_cache: DownloadCache
+    processed_cache: ProcessedAudioCache | None
+    beat_index: BeatAnalysisIndex | None
+    journal: QueueJournal | None
+    zones: dict[str, AudioQueue]
+    _zone_chats: dict[int, str]
+    _metadata_cache: OrderedDict[str, tuple[float, Future[dict[str, Any]]]]
+
+    def __init__(self, resource_handler: ResourceHandler, journal: QueueJournal | None = None):
+        self.scheduler = PipelineScheduler({
+            PipelineStage.METADATA: Settings.metadata_workers,
+            PipelineStage.DOWNLOAD: Settings.download_workers,
+            PipelineStage.PROCESSING: Settings.processing_workers
+        }, ProcessPool(
+            Settings.processing_processes, preload=("audio_processing.syncopation",)
+        ) if Settings.processing_processes > 0 else None)
+        self.download_cache = DownloadCache(resource_handler, self.scheduler)
+        self.processed_cache = ProcessedAudioCache(
+            Settings.processed_cache_path, Settings.processed_cache_max_bytes
+        ) if Settings.processed_cache_path is not None else None
+        self.beat_index = BeatAnalysisIndex(
+            Settings.beat_analysis_path, Settings.beat_analysis_max_entries
+        ) if Settings.beat_analysis_path is not None else None
+        if self.processed_cache is not None:
+            metrics.processed_cache_bytes.set_function(lambda: self.processed_cache.total_bytes)
+        self.journal = journal
+        self.zones = {}
+        self._zone_chats = {}
+        self._metadata_cache = OrderedDict()
+        for zone, chat_id in zone_chat_ids().items():
+            self.zones[zone] = AudioQueue(
+                zone, self.download_cache, journal, Settings.zone_audio_devices.get(zone), self.processed_cache,
+                self.beat_index
+            )
+            self._zone_chats[chat_id] = zone
+        for stage in PipelineStage:
+            metrics.pipeline_active.labels(str(stage)).set_function(lambda stage=stage: self.scheduler.active(stage))
+            metrics.pipeline_waiting.labels(str(stage)).set_function(lambda stage=stage: self.scheduler.waiting(stage))
+
+    @property
+    def primary(self) -> AudioQueue:
+        return self.zones[QueueRegistry.primary_zone]
+
+    def get(self, zone: str | None) -> AudioQueue:
+        return self.zones.get(zone, self.primary)
+
+    def for_chat(self, chat_id: int) -> AudioQueue:
+        return self.get(self._zone_chats.get(chat_id))
+
+    async def resolve_metadata[** P](self, query_text: str, resolve: Callable[P, dict[str, Any]], *args: P.args) -> \
+            dict[str, Any]:
+        """
+        Runs resolve in a metadata worker thread, so it must not touch the event loop; the audio source is built from
+        the metadata it returns back on the loop.
+        """
+        cached: tuple[float, Future[dict[str, Any]]] | None = self._metadata_cache.get(query_text)
+        if cached is not None and monotonic() - cached[0] < Settings.metadata_cache_ttl:
+            self._metadata_cache.move_to_end(query_text)
+            return await cached[1]
+        future: Future[dict[str, Any]] = get_event_loop().create_future()
+        self._metadata_cache[query_text] = (monotonic(), future)
+        while len(self._metadata_cache) > Settings.metadata_cache_size:
+            self._metadata_cache.popitem(last=False)
+        try:
+            future.set_result(await self.scheduler.run_in_thread(PipelineStage.METADATA, resolve, *args))
+        except BaseException as e:
+            # Don't cache failures; anyone already waiting on this lookup still sees the error
+            if self._metadata_cache.get(query_text, (None, None))[1] is future:
+                del self._metadata_cache[query_text]
+            if isinstance(e, CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()
+            raise
+        return future.result()
+
+    def __iter__(self) -> Iterator[AudioQueue]:
+        return iter(self.zones.values())
+
+
+def zone_chat_ids() -> dict[str, int]:
+    return {QueueRegistry.primary_zone: Settings.registered_primary_chat_id} | Settings.zone_chat_ids
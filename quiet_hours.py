@@ -3,12 +3,32 @@ from datetime import datetime, timedelta
 from settings import Settings
 
 
+def is_quiet_hours_at(time: datetime) -> bool:
+    weekend: bool = (time + timedelta(hours=9)).weekday() >= 5
+    start_hour: float = Settings.weekend_quiet_hours_start_time if weekend else Settings.normal_quiet_hours_start_time
+    end_hour: float = Settings.quiet_hours_end_time
+    current_hour: float = time.hour + time.minute / 60 + time.second / 3600
+    return 0 <= (current_hour - start_hour) % 24 <= (end_hour - start_hour) % 24
+
+
 def is_quiet_hours() -> bool:
     if Settings.debug:
         return False
+    return is_quiet_hours_at(datetime.now())
+
+
+def seconds_until_quiet_hours() -> float | None:
+    if Settings.debug:
+        return None
     now: datetime = datetime.now()
-    weekend: bool = (now + timedelta(hours=9)).weekday() >= 5
-    start_hour: float = Settings.weekend_quiet_hours_start_time if weekend else Settings.normal_quiet_hours_start_time
-    end_hour: float = Settings.quiet_hours_end_time
-    current_hour: float = now.hour + now.minute / 60 + now.second / 3600
-    return 0 <= (current_hour - start_hour) % 24 <= (end_hour - start_hour) % 24
+    midnight: datetime = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    candidates: list[datetime] = [
+        midnight + timedelta(days=day, hours=start_hour)
+        for day in range(3)
+        for start_hour in (Settings.normal_quiet_hours_start_time, Settings.weekend_quiet_hours_start_time)
+    ]
+    start: datetime | None = min(
+        (candidate for candidate in candidates if candidate > now and is_quiet_hours_at(candidate)),
+        default=None
+    )
+    return (start - now).total_seconds() if start is not None else None
@@ -6,12 +6,12 @@ from typing import TextIO
 
 class ResourceHandler:
     class Resource:
-        def __init__(self, path: Path):
+        def __init__(self, path: Path, exist_ok: bool = False):
             self.path: Path = path
             self.claimed: bool = True
             self.io_wrapper: TextIO | None = None
             self.is_open = True
-            self.path.mkdir()
+            self.path.mkdir(exist_ok=exist_ok)
 
         def open(self, *args, **kwargs) -> TextIO:
             if self.claimed:
@@ -37,11 +37,15 @@ class ResourceHandler:
             else:
                 raise RuntimeError(f"Resource at {self.path} has already been freed")
 
-    def __init__(self, directory: str):
+    def __init__(self, directory: str, preserve: bool = False):
         self.directory = directory
         self.next_id = 0
         self.claims = []
-        self.free_all()
+        if preserve and os.path.isdir(directory):
+            # Keep existing downloads until the caller knows which of them are still needed (see free_unused)
+            self.next_id = max((int(name) for name in os.listdir(directory) if name.isdigit()), default=-1) + 1
+        else:
+            self.free_all()
 
     def free_all(self):
         for claim in self.claims:
@@ -50,7 +54,22 @@ class ResourceHandler:
         shutil.rmtree(self.directory)
         os.mkdir(self.directory)
 
-    def claim(self):
+    def free_unused(self, keep: set[Path]):
+        claimed: set[Path] = {claim.path for claim in self.claims if claim.claimed}
+        for name in os.listdir(self.directory):
+            path: Path = Path(self.directory) / name
+            if path in keep or path in claimed:
+                continue
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
+    def claim(self, existing_path: Path | None = None):
+        if existing_path is not None and existing_path.is_dir():
+            claim = ResourceHandler.Resource(existing_path, exist_ok=True)
+            self.claims.append(claim)
+            return claim
         resource_path = os.path.join(self.directory, str(self.next_id))
         self.next_id += 1
         claim = ResourceHandler.Resource(Path(resource_path))
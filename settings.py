@@ -16,6 +16,10 @@ class Settings:
     owner_id: int
     comptroller_ids: list[int] = []
 
+    # Additional zones (zone name -> chat id and VLC audio output device), alongside the primary chat's zone
+    zone_chat_ids: dict[str, int] = {}
+    zone_audio_devices: dict[str, str] = {}
+
     # Volume control
     max_absolute_volume: float = 1
     hundred_percent_volume_value: float = 0.75
@@ -28,6 +32,90 @@ class Settings:
     # Waiting refresh rates
     async_sleep_refresh_rate: float = 0.25
 
+    # Track transitions
+    crossfade_duration: float = 0
+    crossfade_step_duration: float = 0.05
+    track_gap_history_length: int = 100
+
+    # Pipeline worker budgets
+    metadata_workers: int = 4
+    download_workers: int = 2
+    processing_workers: int = 2
+
+    # Worker processes for CPU-bound processing (syncopation), and how long one job may run (None for no limit)
+    processing_processes: int = 2
+    processing_job_timeout: float | None = 600
+
+    # Tracks at least this many seconds long (None to disable) are rendered as segment_render_seconds segments, in as
+    # many parallel ffmpeg processes as there are free processing slots, up to segment_render_max_parallelism
+    segment_render_threshold: float | None = 20 * 60
+    segment_render_seconds: float = 120
+    segment_render_max_parallelism: int = 4
+
+    # Songs whose offline render is expected to take at least draft_render_min_seconds (None to disable), and not to be
+    # done by the time they're due, start on a quick draft of their first draft_render_seconds
+    draft_render_min_seconds: float | None = 5
+    draft_render_seconds: float = 45
+    # Crossfade from the draft to the full render, once the full render has been lined up with it
+    draft_switch_crossfade_duration: float = 0.25
+
+    # Metadata cache shared between zones (TTL in seconds, since resolved stream URLs expire)
+    metadata_cache_size: int = 256
+    metadata_cache_ttl: float = 3600
+
+    # Queue ordering: "fifo", "round_robin" between requesters, or "duration" (round robin weighted by queued minutes)
+    fair_share_mode: str = "fifo"
+
+    # Admission limits for each zone's queue, checked when a song is requested (None for unlimited)
+    queue_max_length: int | None = None
+    queue_max_songs_per_user: int | None = None
+    queue_max_minutes: float | None = None
+    # Whether a song that doesn't fit waits for room in the queue instead of being refused
+    queue_wait_when_full: bool = False
+
+    # Look-ahead horizon for downloads and processing (None for unlimited)
+    download_horizon_tracks: int | None = 5
+    download_horizon_minutes: float | None = None
+
+    # Streaming playback (network caching in milliseconds)
+    stream_unprocessed: bool = True
+    stream_network_caching: int = 1000
+
+    # Streaming effects pipeline (download -> ffmpeg -> player), sizes in bytes
+    stream_processing: bool = True
+    stream_processing_buffer_size: int = 256 * 1024
+    stream_processing_chunk_size: int = 64 * 1024
+    # Start playing syncopated tracks once stream_processing_buffer_size bytes have been rendered
+    stream_syncopation: bool = True
+
+    # Apply echo, metal and reverb while the song plays (so they can be toggled), rather than rendering them
+    realtime_effects: bool = True
+    # Let VLC shift the pitch at playback when an offline render would hold the song up by more than
+    # offline_render_budget seconds (as estimated from its duration and effects)
+    realtime_pitch: bool = True
+    offline_render_budget: float = 10
+
+    # Persistent cache of processed audio, shared by every zone (None to disable), budget in bytes
+    processed_cache_path: str | None = "store/processed_cache"
+    processed_cache_max_bytes: int = 2 * 1024 ** 3
+
+    # Beat-tracking results for syncopation, keyed by source (None to disable), optionally computed in advance while
+    # the processing stage is idle (off by default, since most songs are never syncopated)
+    beat_analysis_path: str | None = "store/beat_analysis.json"
+    beat_analysis_max_entries: int = 4096
+    beat_analysis_prefetch: bool = False
+
+    # Crash-safe queue journal (None to disable), position snapshots in seconds, and the size it is compacted at
+    queue_journal_path: str | None = "store/queue_journal.jsonl"
+    queue_journal_position_interval: float = 5
+    queue_journal_compact_bytes: int = 1024 ** 2
+
+    # Metrics (None to disable the endpoint or the dump file)
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int | None = 9464
+    metrics_dump_path: str | None = "store/metrics.prom"
+    metrics_dump_interval: float = 60
+
     # Automated error recovery
     flood_control_buffer_time: float = 1
     max_telegram_flood_control_retries: int = 4
@@ -0,0 +1,123 @@
+"""
+The vectorised time-map construction in audio_processing.syncopation must produce exactly the same time maps as the
+previous pure-Python implementation, frozen below as the reference (benchmarks/syncopation_benchmark.py times the two
+against each other).
+"""
+
+import random
+from collections.abc import Iterable, Sequence
+from itertools import accumulate
+
+import numpy as np
+import pytest
+
+from audio_processing.syncopation import even_syncopation, flexible_syncopation, interpolate_indices
+
+PATTERNS: tuple[tuple[float, ...], ...] = ((2, 1), (1, 1), (3, 2, 1), (1.5, 1, 0.5, 2))
+
+
+def legacy_interpolate_index(seq: Sequence[float], x: float) -> float:
+    i: int = int(x)
+    if x == i:
+        return seq[i]
+    else:
+        return seq[i] * (i - x + 1) + seq[i + 1] * (x - i)
+
+
+def legacy_rescale_beats(sample_space_beats: Sequence[float], quantization_scale: int) -> list[float]:
+    return [
+        float(legacy_interpolate_index(sample_space_beats, x))
+        for x in np.linspace(0, len(sample_space_beats) - 1, len(sample_space_beats) * quantization_scale)
+    ]
+
+
+def legacy_even_syncopation(beats: list[float], num_samples: int, pattern: Iterable[float] = (2, 1)) -> \
+        list[tuple[float, float]]:
+    pattern_integral: list[float] = list(accumulate(pattern))
+    pattern_len: int = len(pattern_integral)
+    pattern_sum = pattern_integral[-1]
+    pattern_integral.insert(0, 0)
+
+    beat_start = beats[0]
+    beat_duration = beats[-1] - beats[0]
+
+    syncopation: list[float] = [
+        pattern_sum * (i // pattern_len) + pattern_integral[i % pattern_len]
+        for i in range(len(beats))
+    ]
+
+    max_syncopation_space_value = max(syncopation)
+
+    return (
+            [(0, 0)] +
+            [(round(beats[n]), round(syncopation[n] * beat_duration / max_syncopation_space_value + beat_start))
+             for n in range(len(beats))] +
+            [(num_samples, num_samples)]
+    )
+
+
+def legacy_flexible_syncopation(beats: list[float], num_samples: int, pattern: Sequence[float] = (2, 1)) -> \
+        list[tuple[float, float]]:
+    pattern_len: int = len(pattern)
+    pattern_integral: list[float] = [0] + list(x / sum(pattern) for x in accumulate(pattern))
+
+    time_map = [(0, 0)]
+    for measure in range(len(beats) // pattern_len):
+        measure_start: float = beats[measure * pattern_len]
+
+        measure_duration: float = (
+            beats[(measure + 1) * pattern_len] - beats[measure * pattern_len]
+            if (measure + 1) * pattern_len < len(beats) else
+            beats[measure * pattern_len] - beats[(measure - 1) * pattern_len]
+        )
+
+        for i in range(pattern_len):
+            time_map.append((
+                round(beats[measure * pattern_len + i]),
+                round(measure_start + measure_duration * pattern_integral[i])
+            ))
+    time_map.append((num_samples, num_samples))
+    return time_map
+
+
+def random_beats(count: int, sample_rate: int = 44100) -> list[float]:
+    beats: list[float] = [random.uniform(0, sample_rate)]
+    for _ in range(count - 1):
+        beats.append(beats[-1] + random.uniform(0.3, 0.7) * sample_rate)
+    return beats
+
+
+def legacy_time_map(beats: list[float], num_samples: int, quantization_scale: int, pattern: tuple[float, ...],
+                    flexible: bool) -> list[tuple[float, float]]:
+    generator = legacy_flexible_syncopation if flexible else legacy_even_syncopation
+    return generator(legacy_rescale_beats(beats, quantization_scale), num_samples, pattern)
+
+
+def vectorised_time_map(beats: list[float], num_samples: int, quantization_scale: int, pattern: tuple[float, ...],
+                        flexible: bool) -> list[tuple[int, int]]:
+    sample_space_beats: np.ndarray = np.asarray(beats, dtype=np.float64)
+    rescaled_beats: np.ndarray = interpolate_indices(
+        sample_space_beats, np.linspace(0, len(sample_space_beats) - 1, len(sample_space_beats) * quantization_scale)
+    )
+    generator = flexible_syncopation if flexible else even_syncopation
+    return generator(rescaled_beats, num_samples, pattern)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_random_time_maps_match_legacy(seed: int) -> None:
+    random.seed(seed)
+    for case in range(100):
+        beats: list[float] = random_beats(random.randint(2, 300))
+        num_samples: int = round(beats[-1]) + random.randint(0, 100_000)
+        args = (beats, num_samples, random.randint(1, 8), random.choice(PATTERNS), random.random() < 0.5)
+        assert vectorised_time_map(*args) == legacy_time_map(*args), f"case {case}: {args!r}"
+
+
+@pytest.mark.parametrize("flexible", (False, True))
+@pytest.mark.parametrize("pattern", PATTERNS)
+def test_short_beat_tracks_match_legacy(pattern: tuple[float, ...], flexible: bool) -> None:
+    # From fewer beats than a measure up to just over two measures
+    for count in range(2, 2 * len(pattern) + 2):
+        beats: list[float] = [44100 * 0.5 * i + 1000 for i in range(count)]
+        args = (beats, round(beats[-1]) + 44100, 1, pattern, flexible)
+        assert vectorised_time_map(*args) == legacy_time_map(*args)
@@ -1,6 +1,6 @@
 import sys
 from collections import deque
-from collections.abc import Callable, Iterable, Generator, Collection, Sequence
+from collections.abc import Callable, Iterable, Generator, Collection
 from enum import Enum
 from itertools import islice, chain, repeat
 from numbers import Number
@@ -168,11 +168,3 @@ def trim_docstring(docstring) -> str:
         trimmed.pop(0)
     # Return a single string:
     return "\n".join(trimmed).rstrip()
-
-
-def interpolate_index(seq: Sequence[float], x: float) -> float:
-    i: int = int(x)
-    if x == i:
-        return seq[i]
-    else:
-        return seq[i] * (i - x + 1) + seq[i + 1] * (x - i)